@@ -0,0 +1,98 @@
+"""Benchmark del motor de OCR: imágenes por segundo sobre una carpeta de capturas de ejemplo.
+
+Uso: python benchmark_ocr.py carpeta_con_capturas [--workers N] [--usuarios N]
+     python benchmark_ocr.py carpeta_con_capturas --precision
+
+Con --precision cada imagen debe tener al lado su transcripción (captura.png -> captura.txt).
+Se compara OCR sin preprocesar contra OCR_PREPROCESS_STEPS: CPU por imagen (incluye el
+proceso de tesseract), precisión por caracteres y cuántas URLs y teléfonos se recuperan.
+"""
+import argparse
+import asyncio
+import os
+import re
+import resource
+import time
+
+import main
+import ocr
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+async def run(folder: str, users: int):
+    paths = sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(IMAGE_EXTENSIONS))
+    if not paths:
+        raise SystemExit(f"No hay imágenes en {folder}")
+    main.ocr_engine.start()
+    started_at = time.monotonic()
+    results = await asyncio.gather(
+        *(main.ocr_engine.ocr(path, f"usuario_{i % users}") for i, path in enumerate(paths)),
+        return_exceptions=True,
+    )
+    elapsed = time.monotonic() - started_at
+    snapshot = main.ocr_engine.snapshot()
+    await main.ocr_engine.stop()
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    print(f"Imágenes: {len(paths)}  errores: {len(errors)}  tiempo: {elapsed:.2f} s  ->  {len(paths) / elapsed:.2f} img/s")
+    print(f"OCR p50 {snapshot['ocr_seconds_p50']} s, p95 {snapshot['ocr_seconds_p95']} s, espera en cola p95 {snapshot['queue_wait_seconds_p95']} s")
+    for error in errors[:5]:
+        print(f"  error: {error!r}")
+
+URL_OR_PHONE_PATTERN = re.compile(r"(?:https?://|www\.)\S+|[a-z0-9-]+\.(?:com|co|ly|net|org)\S*|\+?\d[\d ]{6,}\d", re.IGNORECASE)
+
+def edit_distance(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+def normalize_for_accuracy(text: str) -> str:
+    return " ".join(text.split())
+
+def cpu_seconds() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def run_accuracy(folder: str):
+    samples = []
+    for name in sorted(os.listdir(folder)):
+        base, extension = os.path.splitext(name)
+        truth_path = os.path.join(folder, base + ".txt")
+        if extension.lower() in IMAGE_EXTENSIONS and os.path.exists(truth_path):
+            with open(truth_path, encoding="utf-8") as f:
+                samples.append((os.path.join(folder, name), f.read()))
+    if not samples:
+        raise SystemExit(f"No hay pares imagen/.txt en {folder}")
+
+    for label, steps in (("sin preprocesar", ()), ("preprocesado " + ",".join(ocr.OCR_PREPROCESS_STEPS), ocr.OCR_PREPROCESS_STEPS)):
+        cpu_total, errors, chars, found, expected = 0.0, 0, 0, 0, 0
+        for path, truth in samples:
+            cpu_before = cpu_seconds()
+            text = ocr.ocr_image_file_sync(path, steps)
+            cpu_total += cpu_seconds() - cpu_before
+            truth_norm, text_norm = normalize_for_accuracy(truth), normalize_for_accuracy(text)
+            errors += edit_distance(truth_norm, text_norm)
+            chars += len(truth_norm)
+            targets = URL_OR_PHONE_PATTERN.findall(truth)
+            expected += len(targets)
+            found += sum(1 for target in targets if target.replace(" ", "") in text.replace(" ", ""))
+        print(f"{label}: CPU {cpu_total / len(samples):.3f} s/img, precisión por caracteres {1 - errors / max(chars, 1):.1%}, "
+              f"URLs/teléfonos recuperados {found}/{expected}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("carpeta")
+    parser.add_argument("--workers", type=int, default=ocr.OCR_WORKERS)
+    parser.add_argument("--usuarios", type=int, default=8, help="usuarios simulados entre los que se reparten las imágenes")
+    parser.add_argument("--precision", action="store_true", help="medir CPU y precisión contra las transcripciones .txt")
+    args = parser.parse_args()
+    if args.precision:
+        run_accuracy(args.carpeta)
+        raise SystemExit
+    main.ocr_engine = ocr.OCREngine(args.workers, max(ocr.OCR_QUEUE_MAX, 1), main.STAGE_OCR_QUEUE_WAIT, main.STAGE_OCR)
+    asyncio.run(run(args.carpeta, args.usuarios))
@@ -0,0 +1,974 @@
+"""Banco de carga del webhook sin red: Graph API, CDN de media y DeepSeek simulados en el mismo proceso.
+
+Uso: python benchmark_webhook.py [--usuarios 50] [--turnos 6] [--imagenes 0.1] [--duplicados 0.05] [--rafagas 0.1]
+     python benchmark_webhook.py --escenario 200-remitentes
+     python benchmark_webhook.py --replay capturas.jsonl [--velocidad 1]
+     python benchmark_webhook.py --intenciones | --respuestas | --registro
+     python benchmark_webhook.py --senales [--mensajes 200000 | --corpus mensajes.txt]
+     python benchmark_webhook.py --escrituras
+     python benchmark_webhook.py --streaming [--latencia-token 10]
+
+La carga generada simula usuarios que hacen el registro completo (hola, ACEPTO, nombre, edad,
+conocimiento) y luego conversan: textos sospechosos con sus preguntas de seguimiento, preguntas
+de seguridad, saludos, imágenes, reintentos de Meta con el mismo message_id y ráfagas (varios
+mensajes seguidos, a veces en un mismo POST). Cada usuario espera la primera respuesta antes de
+volver a escribir. Con --replay se envían tal cual cuerpos de webhook guardados, uno por línea
+(o {"t": segundos, "cuerpo": {...}} para respetar los tiempos originales).
+
+`app` se maneja con un cliente ASGI y http_client se cambia por uno cuyo transporte responde
+como Graph, la CDN y DeepSeek, con latencia y tasa de errores configurables. Cada envío a Graph
+se atribuye al mensaje que lo originó por su correlation id. El bot usa su configuración normal
+(variables de entorno) con las bases SQLite e imágenes en un directorio temporal; el OCR es el
+real, así que sin tesseract las imágenes terminan en el mensaje de error (y así se reporta).
+
+Reporta msg/s, latencia hasta la primera y la última respuesta de cada mensaje, p50/p95/p99 de
+las etapas de /metrics, CPU y memoria. Sale con código 1 si algún mensaje quedó sin respuesta o
+se procesó dos veces, algún POST no devolvió 200, hay trabajos en dead-letter, quedaron locks
+tomados o no se cumplen --max-p99-ms / --max-post-p99-ms / --min-msg-s; así sirve como prueba en CI.
+Los escenarios de ESCENARIOS fijan esos valores (los argumentos explícitos mandan); con
+200-remitentes y WEBHOOK_INGEST_MODE=inline se ve la diferencia con procesar dentro del POST.
+
+Con --intenciones se mide cuántos de LABELED_INTENTS (tests/labeled_messages.py, el mismo conjunto
+que usa la carga generada como textos de los usuarios y como respuesta de DeepSeek en "intencion")
+resuelve el clasificador local y cuánto tarda; que acierte lo verifican los tests con pytest.
+--respuestas hace lo mismo con LABELED_REPLIES y las respuestas en los estados de espera, y
+--registro con LABELED_ONBOARDING y la extracción de nombre, edad y conocimiento.
+Con --senales se mide el escáner de señales de estafa sobre un corpus (un mensaje por línea, o
+uno sintético armado con los textos de arriba) y se muestra cómo quedaría el triage; con
+LABELED_SCAM_MESSAGES se cuentan las estafas que cada umbral de SCAM_SIGNAL_BENIGN_MAX_SCORE
+daría por benignas (falsos negativos) y falla si el umbral configurado deja pasar alguna.
+Con --escrituras se miden escrituras por segundo de db_update_user (DB_BENCH_TURNS turnos de 3
+cambios bajo el lock del usuario) y cuánto se frena el event loop mientras tanto, contra el
+esquema anterior de una conexión sqlite3 por llamada abierta en el mismo event loop.
+Con --streaming se mide, con DEEPSEEK_STREAMING apagado y encendido, cuánto tarda en llegar el
+resumen de un análisis de phishing (el segundo mensaje del turno, después del "estoy revisando").
+Con --descargas se mide la memoria pico por imagen en cada paso que corre en este proceso
+(descarga, firma de OCRCache, re-codificación del almacén) para una captura y una foto: el pico
+de RSS (VmHWM tras reiniciarlo con /proc/self/clear_refs) y el pico del heap de Python (tracemalloc).
+"""
+import argparse
+import asyncio
+import atexit
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from collections import Counter
+
+# Antes de importar main: bases SQLite e imágenes en un directorio temporal, credenciales falsas
+# (nada sale a la red) y logs en WARNING para que no tapen el reporte.
+WORKDIR = tempfile.mkdtemp(prefix="benchmark_webhook_")
+atexit.register(shutil.rmtree, WORKDIR, True)
+os.chdir(WORKDIR)
+for variable in ("VERIFY_TOKEN", "ACCESS_TOKEN", "PHONE_NUMBER_ID", "DEEPSEEK_API_KEY"):
+    os.environ[variable] = "benchmark"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import httpx
+from PIL import Image, ImageDraw, ImageFont
+
+import main
+from tests.labeled_messages import LABELED_INTENTS, LABELED_ONBOARDING, LABELED_REPLIES
+
+LABELED_INTENT_BY_TEXT = {" ".join(text.split()): intent for text, intent in LABELED_INTENTS}
+ONBOARDING_LABELS = {(" ".join(text.split()), field): label for text, field, label in LABELED_ONBOARDING}
+INTENT_TIMING_ROUNDS = 200
+REPLY_LABELS = {(" ".join(text.split()), mode): label for text, mode, label in LABELED_REPLIES}
+SCAN_TIMING_SAMPLE = 20000 # Mensajes cronometrados uno a uno para los percentiles
+DB_BENCH_TURNS = 2000 # Turnos de --escrituras, repartidos entre DB_BENCH_USERS usuarios
+DB_BENCH_USERS = 100
+LEGACY_DB_PATH = "usuarios_conexion_por_llamada.db"
+# Análisis por ronda de --streaming, uno a la vez: con varios simultáneos manda el límite de
+# concurrencia del gateway de DeepSeek y no lo que tarda en salir el resumen
+STREAMING_BENCH_MESSAGES = 10
+MEDIA_BENCH_ROUNDS = 3 # Imágenes distintas por tipo y por pasada de --descargas
+
+# El registro usa las respuestas etiquetadas que lo hacen avanzar al siguiente paso
+NAME_REPLIES = [text for text, field, label in LABELED_ONBOARDING if field == "nombre" and label.startswith("NOMBRE_VALIDO:")]
+AGE_REPLIES = [text for text, field, label in LABELED_ONBOARDING if field == "edad" and label.startswith("EDAD_VALIDA:")]
+KNOWLEDGE_REPLIES = [text for text, field, label in LABELED_ONBOARDING if field == "conocimiento" and label in ("Sí", "No", "Poco")]
+DETAIL_REPLIES = [text for text, mode, label in LABELED_REPLIES if mode == "decision_ver_detalles" and label == "QUIERE_DETALLES"]
+POST_ANALYSIS_REPLIES = [text for text, mode, label in LABELED_REPLIES if label in ("RESPUESTA_SI", "RESPUESTA_NO", "PIDE_AYUDA")]
+BURST_TEXTS = [text for text, intent in LABELED_INTENTS if intent in ("saludo", "pregunta_seguridad", "meta_pregunta")]
+# (mensaje reenviado por el usuario, es estafa). Incluye estafas con pocas o ninguna de las frases
+# del léxico, que son las que el atajo de "sin señales" podría dar por benignas.
+LABELED_SCAM_MESSAGES = [
+    ("Soy del banco, necesito que me digas la clave que te llegó", True),
+    ("Hola mamá, cambié de número, guarda este y bórrame el otro", True),
+    ("Hola, ¿me puedes prestar 200 mil? mañana te los devuelvo, es urgente", True),
+    ("Buenas, le escribimos de Bancolombia, su cuenta presenta un bloqueo, responda con su número de documento", True),
+    ("Te llegó un código de 6 dígitos por error a tu celular, me lo reenvías porfa", True),
+    ("Felicidades ganaste un iPhone, reclámalo respondiendo este mensaje", True),
+    ("Soy el asesor de Nequi, para activar el beneficio dígame el código que le llegó por SMS", True),
+    ("Papá se me dañó el celular, escríbeme a este número que necesito un favor", True),
+    ("Estamos contratando, trabajo desde casa ganando 300 mil diarios, solo da likes", True),
+    ("Tienes una multa pendiente con la Policía, paga hoy para evitar embargo", True),
+    ("Hola, soy de soporte de WhatsApp, envíame el código de verificación para no cerrar tu cuenta", True),
+    ("Su paquete está retenido en aduana, debe cancelar 35.000 para liberarlo", True),
+    ("Invierte 500 mil y en una semana recibes 2 millones, es seguro", True),
+    ("Hola amiga, estoy en una emergencia, me consignas a este Nequi y te explico después", True),
+    ("Buen día, somos de la DIAN, tiene un saldo a favor, confirme sus datos bancarios", True),
+    ("Oiga vecino, le mando un link para que vote por mi hija en el concurso, le va a llegar un código", True),
+    ("Hola, ¿nos vemos mañana a las 3 en el parque?", False),
+    ("Mamá ya llegué a la casa, te llamo más tarde", False),
+    ("Recuerda que la reunión de padres es el jueves a las 7", False),
+    ("Feliz cumpleaños tía, que Dios la bendiga", False),
+    ("Ya pagué el recibo de la luz, te mando la foto", False),
+    ("El médico dijo que la cita quedó para el lunes", False),
+    ("¿Qué vamos a almorzar hoy?", False),
+    ("Te dejé las llaves con el portero", False),
+    ("Gracias por el almuerzo de ayer, estuvo delicioso", False),
+    ("Bancolombia le informa compra por $45.000 en Éxito con su tarjeta terminada en 1234", False),
+]
+SCREENSHOT_TEXTS = [
+    "Bancolombia: Su cuenta fue bloqueada. Ingrese a bancolombia-seguro.co/login para activarla hoy.",
+    "Servientrega: su paquete esta retenido. Pague 3.500 en entregas-col.com o sera devuelto.",
+    "Felicitaciones! Gano un subsidio de $1.200.000. Reclame en subsidio-gov.co con su cedula.",
+    "Hola mami, este es mi numero nuevo. Necesito que me consignes urgente a Nequi 3001234567.",
+]
+
+# Segundos sin envíos a Graph (y sin nada en cola) para dar la carga por terminada
+IDLE_SECONDS = 0.5
+LONG_LIVED_TASKS = {"webhook_queue_worker", "webhook_shard_lease_task", "image_store_sweep_task", "_dispatch", "wait"}
+
+# Cargas con nombre (--escenario) y los límites que deben cumplir; valores de los argumentos de abajo
+ESCENARIOS = {
+    # 200 remitentes a la vez y DeepSeek lento: el 200 de /webhook no puede esperar al turno.
+    # Medido con la cola fuera del event loop: POST p99 5.8 ms (local) y 8.5 ms (WEBHOOK_SHARD_MODE=lease,
+    # 8 workers), 7.6 s con WEBHOOK_INGEST_MODE=inline; primera respuesta p99 16 s en ambos modos de shard.
+    "200-remitentes": {
+        "usuarios": 200, "arranque": 0.0, "pausa": 0.0, "latencia_llm": 500, "max_post_p99_ms": 50, "max_p99_ms": 20000,
+    },
+}
+
+def percentile(sorted_values: list[float], q: float) -> float | None:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def format_ms(seconds: float | None) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+def cpu_seconds() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def rss_mib() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_rss_high_water() -> bool:
+    """Reinicia VmHWM al RSS actual (Linux >= 4.0); False si no se puede."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def rss_high_water_mib() -> float | None:
+    try:
+        with open("/proc/self/status") as f:
+            match = re.search(r"^VmHWM:\s+(\d+) kB", f.read(), re.MULTILINE)
+    except OSError:
+        return None
+    return int(match.group(1)) / 1024 if match else None
+
+def render_screenshot(text: str) -> bytes:
+    """Captura de chat sintética (PNG): burbuja gris con el texto, del tamaño de una pantalla de teléfono."""
+    img = Image.new("RGB", (1080, 1600), (236, 229, 221))
+    draw = ImageDraw.Draw(img)
+    try:
+        font = ImageFont.load_default(size=40)
+    except TypeError: # Pillow < 10.1 no acepta size
+        font = ImageFont.load_default()
+    lines, line = [], ""
+    for word in text.split():
+        if len(line) + len(word) > 36:
+            lines.append(line)
+            line = ""
+        line = f"{line} {word}".strip()
+    lines.append(line)
+    draw.rounded_rectangle((60, 300, 1020, 360 + 60 * len(lines)), radius=24, fill=(255, 255, 255))
+    for i, text_line in enumerate(lines):
+        draw.text((90, 330 + 60 * i), text_line, fill=(20, 20, 20), font=font)
+    buffer = io.BytesIO()
+    img.save(buffer, "PNG")
+    return buffer.getvalue()
+
+def fake_llm_answer(mode: str, text: str) -> str:
+    """Respuesta de DeepSeek para cada modo, con los formatos que espera main."""
+    words = re.findall(r"[a-z0-9ñ]+", main.normalize_text(text))
+    if (" ".join(text.split()), mode) in ONBOARDING_LABELS:
+        return ONBOARDING_LABELS[(" ".join(text.split()), mode)]
+    if mode == "nombre":
+        name = next((word for word in reversed(text.split()) if word.isalpha()), "")
+        return f"NOMBRE_VALIDO:{name}" if name else "NOMBRE_CONFUSO"
+    if mode == "edad":
+        age = re.search(r"\d+", text)
+        return f"EDAD_VALIDA:{age.group()}" if age else "EDAD_NO_CLARA"
+    if mode == "conocimiento":
+        if {"poco", "algo", "regular"} & set(words):
+            return "Poco"
+        if words[:1] == ["no"]:
+            return "No"
+        return "Sí" if words[:1] in (["si"], ["claro"]) else "CONOCIMIENTO_AMBIGUO"
+    if mode == "intencion":
+        return LABELED_INTENT_BY_TEXT.get(" ".join(text.split()), "analizar" if len(words) >= 15 else "irrelevante")
+    if (" ".join(text.split()), mode) in REPLY_LABELS: # main le pasa normalize_text; también se prueba el original
+        return REPLY_LABELS[(" ".join(text.split()), mode)]
+    if mode == "decision_ver_detalles":
+        return "QUIERE_DETALLES" if words[:1] in (["si"], ["claro"], ["dale"], ["bueno"]) else "OTRA_COSA"
+    if mode == "decision_post_phishing_interaction":
+        if "ayuda" in words:
+            return "PIDE_AYUDA"
+        if words[:1] in (["si"], ["no"]):
+            return "RESPUESTA_SI" if words[0] == "si" else "RESPUESTA_NO"
+        return "ES_PREGUNTA" if "?" in text else "ES_COMENTARIO"
+    if mode == "phishing":
+        return (
+            "*Resumen Breve*:\nEste mensaje parece una estafa de suplantación. No abras el enlace ni compartas tus datos. "
+            "¿Quieres ver el análisis completo?---DETALLES_SIGUEN---🔍 *Análisis del mensaje recibido*\n✅ *Resultado*: Sí, parece una estafa\n"
+            + "📌 *Mi opinión detallada*: " + "El remitente presiona con urgencia y pide datos por un enlace que no es del banco. " * 6
+            + "\n¿llegaste a hacer clic en algún enlace de ese mensaje? Responde sí o no, o escribe ayuda si necesitas los pasos a seguir."
+        )
+    return "Con gusto te explico. " + "Nunca compartas claves ni códigos que te lleguen por SMS y verifica siempre por los canales oficiales. " * 5
+
+class ReplyTracker:
+    """Relaciona cada envío a Graph con el mensaje entrante que lo originó (correlation id = message_id)."""
+
+    def __init__(self):
+        self.posted_at: dict[str, float] = {}
+        self.first_reply: dict[str, float] = {}
+        self.second_reply: dict[str, float] = {} # En un análisis, el resumen (el primero es el aviso de que lo revisa)
+        self.last_reply: dict[str, float] = {}
+        self.duplicates_posted = 0
+        self.unattributed = 0
+        self.last_activity = 0.0
+        self.waiters: dict[str, asyncio.Future] = {}
+
+    def posted(self, message_id: str):
+        if message_id in self.posted_at:
+            self.duplicates_posted += 1
+        else:
+            self.posted_at[message_id] = time.perf_counter()
+
+    def replied(self, correlation_id: str):
+        now = self.last_activity = time.perf_counter()
+        if correlation_id not in self.posted_at:
+            self.unattributed += 1
+            return
+        if correlation_id in self.first_reply:
+            self.second_reply.setdefault(correlation_id, now)
+        self.first_reply.setdefault(correlation_id, now)
+        self.last_reply[correlation_id] = now
+        waiter = self.waiters.pop(correlation_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+
+    async def wait_first_reply(self, message_id: str, timeout: float) -> bool:
+        if message_id in self.first_reply:
+            return True
+        waiter = self.waiters[message_id] = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.waiters.pop(message_id, None)
+            return False
+
+class FakeUpstreams:
+    """Graph API, CDN de media y DeepSeek dentro del transporte de httpx (nunca se abre un socket)."""
+
+    CDN_URL = "https://cdn.benchmark.local/media/"
+
+    def __init__(self, args, tracker: ReplyTracker):
+        self.latency = {"graph": args.latencia_graph / 1000, "cdn": args.latencia_cdn / 1000, "llm": args.latencia_llm / 1000}
+        self.token_seconds = args.latencia_token / 1000
+        self.error_rate = args.errores
+        self.rng = random.Random(args.semilla + 1)
+        self.tracker = tracker
+        self.calls = Counter()
+        self.injected_errors = Counter()
+        self.modes_by_prompt = {template.system_prefix: mode for mode, template in main.PROMPT_REGISTRY.items()}
+        self.images = [(image, hashlib.sha256(image).hexdigest()) for image in map(render_screenshot, SCREENSHOT_TEXTS)]
+
+    async def delay(self, upstream: str):
+        if self.latency[upstream] > 0:
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.latency[upstream])
+
+    def should_fail(self, upstream: str) -> bool:
+        if self.error_rate > 0 and self.rng.random() < self.error_rate:
+            self.injected_errors[upstream] += 1
+            return True
+        return False
+
+    def image_for(self, media_id: str) -> tuple[bytes, str]:
+        # Pocas capturas distintas, como las campañas reenviadas por muchos usuarios
+        return self.images[zlib.crc32(media_id.encode()) % len(self.images)]
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        if url == main.DEEPSEEK_API_URL:
+            return await self.deepseek(json.loads(request.content))
+        if url.startswith(self.CDN_URL):
+            return await self.cdn(url[len(self.CDN_URL):])
+        if url.startswith(main.GRAPH_API_URL):
+            path = url[len(main.GRAPH_API_URL):].strip("/")
+            if request.method == "POST" and path.endswith("/messages"):
+                return await self.graph_send()
+            if request.method == "GET":
+                return await self.graph_media_info(path)
+        return httpx.Response(404, json={"error": {"message": f"sin simulador para {request.method} {url}"}})
+
+    async def graph_send(self) -> httpx.Response:
+        self.calls["graph_send"] += 1
+        await self.delay("graph")
+        if self.should_fail("graph"):
+            return httpx.Response(self.rng.choice((429, 500)), headers={"Retry-After": "1"}, json={"error": {"message": "error simulado"}})
+        # El sender de main pone el correlation id del mensaje que originó este envío
+        self.tracker.replied(main.current_correlation_id.get())
+        return httpx.Response(200, json={"messaging_product": "whatsapp", "messages": [{"id": f"wamid.salida.{self.calls['graph_send']}"}]})
+
+    async def graph_media_info(self, media_id: str) -> httpx.Response:
+        self.calls["graph_media"] += 1
+        await self.delay("graph")
+        if self.should_fail("graph"):
+            return httpx.Response(500, json={"error": {"message": "error simulado"}})
+        image, sha256 = self.image_for(media_id)
+        return httpx.Response(200, json={
+            "messaging_product": "whatsapp", "id": media_id, "url": self.CDN_URL + media_id,
+            "mime_type": "image/png", "sha256": sha256, "file_size": len(image),
+        })
+
+    async def cdn(self, media_id: str) -> httpx.Response:
+        self.calls["cdn"] += 1
+        await self.delay("cdn")
+        if self.should_fail("cdn"):
+            return httpx.Response(500)
+        return httpx.Response(200, content=self.image_for(media_id)[0], headers={"content-type": "image/png"})
+
+    async def deepseek(self, payload: dict) -> httpx.Response:
+        mode = self.modes_by_prompt.get(payload["messages"][0]["content"], "desconocido")
+        self.calls[f"llm_{mode}"] += 1
+        await self.delay("llm")
+        if self.should_fail("llm"):
+            return httpx.Response(503, json={"error": {"message": "error simulado"}})
+        answer = fake_llm_answer(mode, payload["messages"][-1]["content"])
+        if not payload.get("stream"):
+            if self.token_seconds: # Sin streaming la respuesta sale cuando terminó de generarse
+                await asyncio.sleep(self.token_seconds * len(answer.split(" ")))
+            return httpx.Response(200, json={"choices": [{"message": {"role": "assistant", "content": answer}}]})
+        return httpx.Response(200, content=self.stream_tokens(answer), headers={"content-type": "text/event-stream"})
+
+    async def stream_tokens(self, answer: str):
+        words = answer.split(" ")
+        for i, word in enumerate(words):
+            if self.token_seconds:
+                await asyncio.sleep(self.token_seconds)
+            delta = word if i == len(words) - 1 else word + " "
+            yield f"data: {json.dumps({'choices': [{'delta': {'content': delta}}]}, ensure_ascii=False)}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+
+def text_message(phone: str, message_id: str, text: str) -> dict:
+    return {"from": phone, "id": message_id, "timestamp": str(int(time.time())), "type": "text", "text": {"body": text}}
+
+def image_message(phone: str, message_id: str) -> dict:
+    return {"from": phone, "id": message_id, "timestamp": str(int(time.time())), "type": "image",
+            "image": {"id": f"media.{message_id}", "mime_type": "image/png"}}
+
+def webhook_body(messages: list[dict]) -> dict:
+    contacts = [{"wa_id": phone, "profile": {"name": "Usuario de prueba"}} for phone in dict.fromkeys(m["from"] for m in messages)]
+    return {"object": "whatsapp_business_account", "entry": [{"id": "benchmark", "changes": [{"field": "messages", "value": {
+        "messaging_product": "whatsapp", "metadata": {"phone_number_id": main.PHONE_NUMBER_ID},
+        "contacts": contacts, "messages": messages,
+    }}]}]}
+
+def build_session(user_num: int, args, rng: random.Random) -> list[dict]:
+    """Turnos de un usuario: registro completo y luego args.turnos mensajes de conversación.
+
+    Cada turno es {"mensajes": [...], "un_post": bool, "duplicar": bool}; una ráfaga son varios
+    mensajes seguidos (en un solo POST si un_post, como los agrupa Meta).
+    """
+    phone = f"5730{user_num:08d}"
+    counter = iter(range(10**6))
+    def text(body):
+        return text_message(phone, f"wamid.bench.{user_num}.{next(counter)}", body)
+    def reply(body): # Respuestas en los estados de espera, para medirlas aparte
+        return text_message(phone, f"wamid.bench.{user_num}.respuesta.{next(counter)}", body)
+
+    onboarding = ["hola", "acepto", rng.choice(NAME_REPLIES), rng.choice(AGE_REPLIES), rng.choice(KNOWLEDGE_REPLIES)]
+    turns = [[text_message(phone, f"wamid.bench.{user_num}.registro.{step}", body)] for step, body in enumerate(onboarding)]
+    conversation = []
+    while len(conversation) < args.turnos:
+        roll = rng.random()
+        if roll < args.imagenes:
+            conversation.append([image_message(phone, f"wamid.bench.{user_num}.{next(counter)}")])
+            analysis = True
+        elif roll < args.imagenes + args.rafagas:
+            conversation.append([text(body) for body in rng.sample(BURST_TEXTS, rng.randint(2, 4))])
+            analysis = False
+        else:
+            body, intent = rng.choice(LABELED_INTENTS)
+            conversation.append([text(body)])
+            analysis = intent == "analizar"
+        if analysis and rng.random() < 0.6: # Pide los detalles y responde si hizo clic
+            conversation += [[reply(rng.choice(DETAIL_REPLIES))], [reply(rng.choice(POST_ANALYSIS_REPLIES))]]
+    turns += conversation[:args.turnos]
+    return [{"mensajes": messages, "un_post": len(messages) > 1 and rng.random() < 0.5, "duplicar": rng.random() < args.duplicados}
+            for messages in turns]
+
+class LoadStats:
+    def __init__(self):
+        self.post_latencies: list[float] = []
+        self.post_errors = Counter()
+        self.turns_without_reply = 0
+        self.background: list[asyncio.Task] = []
+
+async def post_webhook(client: httpx.AsyncClient, body: dict, stats: LoadStats):
+    started = time.perf_counter()
+    response = await client.post("/webhook", json=body)
+    stats.post_latencies.append(time.perf_counter() - started)
+    if response.status_code != 200:
+        stats.post_errors[response.status_code] += 1
+
+async def resend_later(client: httpx.AsyncClient, tracker: ReplyTracker, bodies: list[dict], delay: float, stats: LoadStats):
+    """Reintento de Meta: el mismo cuerpo (mismos message_id) un rato después."""
+    await asyncio.sleep(delay)
+    for body in bodies:
+        for message in main.extract_webhook_messages(body):
+            tracker.posted(message["id"])
+        await post_webhook(client, body, stats)
+
+async def run_session(client: httpx.AsyncClient, tracker: ReplyTracker, session: list[dict], args, rng: random.Random, stats: LoadStats):
+    await asyncio.sleep(rng.uniform(0, args.arranque)) # Los usuarios llegan escalonados
+    for turn in session:
+        messages = turn["mensajes"]
+        bodies = [webhook_body(messages)] if turn["un_post"] else [webhook_body([message]) for message in messages]
+        for message in messages:
+            tracker.posted(message["id"])
+        for body in bodies:
+            await post_webhook(client, body, stats)
+        if turn["duplicar"]:
+            stats.background.append(asyncio.create_task(resend_later(client, tracker, bodies, rng.uniform(0, 2), stats)))
+        for message in messages:
+            if not await tracker.wait_first_reply(message["id"], args.espera_max):
+                stats.turns_without_reply += 1
+                break
+        if args.pausa:
+            await asyncio.sleep(rng.expovariate(1 / args.pausa)) # Tiempo de lectura y escritura del usuario
+
+def load_replay(path: str) -> list[tuple[float | None, dict]]:
+    events = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                events.append((record.get("t"), record["cuerpo"]) if "cuerpo" in record else (None, record))
+    if not events:
+        raise SystemExit(f"No hay cuerpos de webhook en {path}")
+    return events
+
+async def run_replay(client: httpx.AsyncClient, tracker: ReplyTracker, events: list[tuple[float | None, dict]], speed: float, stats: LoadStats):
+    started = time.perf_counter()
+    first_t = next((t for t, _ in events if t is not None), None)
+    for t, body in events:
+        if t is not None:
+            wait = (t - first_t) / speed - (time.perf_counter() - started)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        for message in main.extract_webhook_messages(body):
+            if message.get("id"):
+                tracker.posted(message["id"])
+        await post_webhook(client, body, stats)
+
+def busy_task_count() -> int:
+    """Tareas con trabajo de un turno en curso (imágenes, detalles en streaming).
+
+    No cuenta los workers de la cola, la limpieza de imágenes ni los dispatchers del OCR y del
+    sender, que viven hasta el apagado, ni el Event.wait con que los workers esperan trabajo nuevo.
+    """
+    current = asyncio.current_task()
+    return sum(1 for task in asyncio.all_tasks() if task is not current and task.get_coro().__name__ not in LONG_LIVED_TASKS)
+
+async def wait_until_idle(tracker: ReplyTracker, timeout: float) -> bool:
+    """Espera a que no quede nada en la cola, en el OCR ni por enviar, y a que dejen de llegar respuestas."""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        busy = (main.webhook_queue.pending_count() if main.webhook_queue else 0) + main.whatsapp_sender.unfinished + busy_task_count()
+        if not busy and time.perf_counter() - tracker.last_activity >= IDLE_SECONDS:
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+def record_stage_samples() -> dict:
+    """Guarda cada duración que observan las etapas de main.metrics, para percentiles exactos."""
+    samples: dict[main.MetricStage, list[float]] = {}
+    observe = main.MetricStage.observe
+    def observe_and_keep(stage, seconds):
+        samples.setdefault(stage, []).append(seconds)
+        observe(stage, seconds)
+    main.MetricStage.observe = observe_and_keep
+    return samples
+
+def latency_line(label: str, values: list[float]) -> str:
+    values = sorted(values)
+    return (f"{label:<28} n {len(values):>6}   p50 {format_ms(percentile(values, 0.5)):>8} ms   "
+            f"p95 {format_ms(percentile(values, 0.95)):>8} ms   p99 {format_ms(percentile(values, 0.99)):>8} ms")
+
+async def run_load(args) -> list[str]:
+    tracker = ReplyTracker()
+    upstreams = FakeUpstreams(args, tracker)
+    stats = LoadStats()
+    stage_samples = record_stage_samples()
+    rss_before, cpu_before = rss_mib(), cpu_seconds()
+
+    async with main.lifespan(main.app):
+        await main.http_client.aclose()
+        main.http_client = httpx.AsyncClient(timeout=45.0, transport=httpx.MockTransport(upstreams.handle))
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://benchmark") as client:
+            started = time.perf_counter()
+            if args.replay:
+                events = load_replay(args.replay)
+                await run_replay(client, tracker, events, args.velocidad, stats)
+                users = len({m.get("from") for _, body in events for m in main.extract_webhook_messages(body)})
+            else:
+                rng = random.Random(args.semilla)
+                sessions = [build_session(user_num, args, rng) for user_num in range(args.usuarios)]
+                await asyncio.gather(*(
+                    run_session(client, tracker, session, args, random.Random(args.semilla * 7919 + i), stats)
+                    for i, session in enumerate(sessions)
+                ))
+                await asyncio.gather(*stats.background)
+                users = args.usuarios
+            idle = await wait_until_idle(tracker, args.espera_max)
+            elapsed = max(tracker.last_activity, started) - started
+        dead_letters = main.webhook_queue.conn.execute("SELECT COUNT(*) FROM cola_webhook_fallidos").fetchone()[0] if main.webhook_queue else 0
+        held_locks = main.user_locks.held_count()
+        cpu_used = cpu_seconds() - cpu_before
+
+    unique = len(tracker.posted_at)
+    unanswered = [message_id for message_id in tracker.posted_at if message_id not in tracker.first_reply]
+    processed_twice = max(0, main.message_dedupe.stats["claimed"] - unique)
+    throughput = unique / elapsed if elapsed > 0 else 0.0
+    first_reply = [tracker.first_reply[m] - tracker.posted_at[m] for m in tracker.first_reply]
+    last_reply = [tracker.last_reply[m] - tracker.posted_at[m] for m in tracker.last_reply]
+
+    print(f"Mensajes: {unique} únicos de {users} usuarios en {len(stats.post_latencies)} POSTs "
+          f"({tracker.duplicates_posted} reenvíos con message_id repetido, {upstreams.calls['cdn']} descargas de imagen)")
+    print(f"Tiempo: {elapsed:.2f} s  ->  {throughput:.1f} msg/s   CPU: {cpu_used:.2f} s ({cpu_used / max(unique, 1) * 1000:.2f} ms por mensaje)")
+    print(latency_line("POST /webhook", stats.post_latencies))
+    print(latency_line("Primera respuesta", first_reply))
+    print(latency_line("Última respuesta", last_reply))
+    registration = {} # usuario -> (primer "hola" enviado, respuesta al último paso)
+    for message_id in tracker.first_reply:
+        if ".registro." in message_id:
+            user, step = message_id.rsplit(".registro.", 1)
+            started_at, finished_at = registration.get(user, (None, None))
+            registration[user] = (tracker.posted_at[message_id] if step == "0" else started_at,
+                                  tracker.first_reply[message_id] if step == "4" else finished_at)
+    print(latency_line("Paso del registro (2-4)", [tracker.first_reply[m] - tracker.posted_at[m] for m in tracker.first_reply
+                                                    if m.rsplit(".registro.", 1)[-1] in ("2", "3", "4")]))
+    print(latency_line("Registro completo", [end - start for start, end in registration.values() if start is not None and end is not None]))
+    print(latency_line("Respuesta a sí/no/ayuda", [tracker.first_reply[m] - tracker.posted_at[m] for m in tracker.first_reply if ".respuesta." in m]))
+    print("Etapas:")
+    for name, by_mode in main.metrics.stages.items():
+        for mode, stage in by_mode.items():
+            errors = ", ".join(f"{error_type} {count}" for error_type, count in sorted(stage.errors.items()))
+            print("  " + latency_line(f"{name} {mode}".strip(), stage_samples.get(stage, [])) + (f"   errores: {errors}" if errors else ""))
+    print(f"Intención: {main.intent_classifier_stats['local']} resueltas localmente, {main.intent_classifier_stats['llm']} con DeepSeek")
+    print(f"Respuestas sí/no/ayuda: {main.reply_classifier_stats['local']} resueltas localmente, {main.reply_classifier_stats['llm']} con DeepSeek")
+    onboarding_local = sum(count for key, count in main.onboarding_extractor_stats.items() if key.endswith("_local"))
+    onboarding_total = sum(main.onboarding_extractor_stats.values())
+    print(f"Registro (nombre, edad, conocimiento): {onboarding_local} de {onboarding_total} "
+          f"({onboarding_local / max(onboarding_total, 1):.0%}) resueltos localmente, {onboarding_total - onboarding_local} con DeepSeek")
+    image_stats = main.image_store.stats
+    print(f"Almacén de imágenes: {main.image_store.files} archivos, {main.image_store.total_bytes / 1024:.0f} KiB en disco "
+          f"({image_stats['stored']} guardadas, {image_stats['deduplicated'] + image_stats['reused']} repetidas, "
+          f"{image_stats['compacted']} re-codificadas)")
+    print(f"Simuladores: {dict(sorted(upstreams.calls.items()))}  errores inyectados: {dict(upstreams.injected_errors)}")
+    print(f"Memoria: RSS inicial {rss_before:.0f} MiB, final {rss_mib():.0f} MiB, pico {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+    print(f"Estado final: {'en reposo' if idle else 'NO quedó en reposo'}, dead-letter {dead_letters}, locks tomados {held_locks}, "
+          f"envíos sin atribuir {tracker.unattributed}, OCR fallidos {main.ocr_engine.stats['failed']}")
+    if main.ocr_engine.stats["failed"] and not shutil.which("tesseract"):
+        print("  (tesseract no está instalado: las imágenes terminan en el mensaje de error del OCR)")
+
+    failures = []
+    if unanswered:
+        failures.append(f"{len(unanswered)} mensajes sin respuesta (p. ej. {', '.join(unanswered[:3])})")
+    if processed_twice:
+        failures.append(f"{processed_twice} mensajes procesados más de una vez")
+    if stats.post_errors:
+        failures.append(f"POST /webhook sin 200: {dict(stats.post_errors)}")
+    if dead_letters:
+        failures.append(f"{dead_letters} trabajos en dead-letter")
+    if held_locks:
+        failures.append(f"{held_locks} locks de usuario siguen tomados")
+    if not idle:
+        failures.append(f"el bot no quedó en reposo tras {args.espera_max} s")
+    p99 = percentile(sorted(first_reply), 0.99)
+    if args.max_p99_ms and (p99 is None or p99 * 1000 > args.max_p99_ms):
+        failures.append(f"p99 de primera respuesta {format_ms(p99)} ms > {args.max_p99_ms} ms")
+    post_p99 = percentile(sorted(stats.post_latencies), 0.99)
+    if args.max_post_p99_ms and (post_p99 is None or post_p99 * 1000 > args.max_post_p99_ms):
+        failures.append(f"p99 de POST /webhook {format_ms(post_p99)} ms > {args.max_post_p99_ms} ms")
+    if args.min_msg_s and throughput < args.min_msg_s:
+        failures.append(f"{throughput:.1f} msg/s < {args.min_msg_s} msg/s")
+    return failures
+
+def evaluate_intents() -> list[str]:
+    """Cobertura y tiempo del clasificador local; la precisión la verifica tests/test_local_classifiers.py."""
+    local = sum(main.classify_intent_local(text)[1] >= main.INTENT_LOCAL_MIN_CONFIDENCE for text, _ in LABELED_INTENTS)
+    started = time.perf_counter()
+    for _ in range(INTENT_TIMING_ROUNDS):
+        for text, _ in LABELED_INTENTS:
+            main.classify_intent_local(text)
+    micros = (time.perf_counter() - started) / (INTENT_TIMING_ROUNDS * len(LABELED_INTENTS)) * 1e6
+    print(f"Intenciones: {local}/{len(LABELED_INTENTS)} ({local / len(LABELED_INTENTS):.0%}) resueltas sin DeepSeek, "
+          f"{micros:.1f} µs por mensaje")
+    return []
+
+def evaluate_replies() -> list[str]:
+    """Cobertura y tiempo del clasificador de respuestas; la precisión la verifican los tests."""
+    local = sum(main.classify_reply_local(text, mode)[1] >= main.REPLY_LOCAL_MIN_CONFIDENCE for text, mode, _ in LABELED_REPLIES)
+    started = time.perf_counter()
+    for _ in range(INTENT_TIMING_ROUNDS):
+        for text, mode, _ in LABELED_REPLIES:
+            main.classify_reply_local(text, mode)
+    micros = (time.perf_counter() - started) / (INTENT_TIMING_ROUNDS * len(LABELED_REPLIES)) * 1e6
+    print(f"Respuestas sí/no/ayuda: {local}/{len(LABELED_REPLIES)} ({local / len(LABELED_REPLIES):.0%}) resueltas sin DeepSeek, "
+          f"{micros:.1f} µs por mensaje")
+    return []
+
+def evaluate_onboarding() -> list[str]:
+    """Cobertura y tiempo de la extracción local del registro; la precisión la verifican los tests."""
+    by_field = Counter(field for text, field, _ in LABELED_ONBOARDING
+                       if main.ONBOARDING_LOCAL_EXTRACTORS[field](text)[1] >= main.ONBOARDING_LOCAL_MIN_CONFIDENCE)
+    local = sum(by_field.values())
+    started = time.perf_counter()
+    for _ in range(INTENT_TIMING_ROUNDS):
+        for text, field, _ in LABELED_ONBOARDING:
+            main.ONBOARDING_LOCAL_EXTRACTORS[field](text)
+    micros = (time.perf_counter() - started) / (INTENT_TIMING_ROUNDS * len(LABELED_ONBOARDING)) * 1e6
+    fields = Counter(field for _, field, _ in LABELED_ONBOARDING)
+    print(f"Registro: {local}/{len(LABELED_ONBOARDING)} ({local / len(LABELED_ONBOARDING):.0%}) resueltas sin DeepSeek "
+          f"({', '.join(f'{field} {by_field[field]}/{total}' for field, total in fields.items())}), {micros:.1f} µs por mensaje")
+    return []
+
+def legacy_db_update_user(telefono: str, data: dict):
+    """db_update_user de antes de la capa de datos: abre, escribe, hace commit y cierra, en el event loop."""
+    conn = sqlite3.connect(LEGACY_DB_PATH, check_same_thread=False)
+    try:
+        conn.execute(f"UPDATE usuarios SET {', '.join(f'{key} = ?' for key in data)} WHERE telefono = ?", (*data.values(), telefono))
+        conn.commit()
+    finally:
+        conn.close()
+
+async def measure_db_writes(legacy: bool) -> tuple[float, list[float]]:
+    """(escrituras por segundo, retrasos del event loop) para DB_BENCH_TURNS turnos concurrentes."""
+    phones = [f"5731{i:08d}" for i in range(DB_BENCH_USERS)]
+    if legacy:
+        schema = main.db.conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'usuarios'").fetchone()[0]
+        with sqlite3.connect(LEGACY_DB_PATH) as conn: # Modo de journal por defecto, como la base de antes
+            conn.execute(schema)
+            conn.executemany("INSERT OR IGNORE INTO usuarios (telefono) VALUES (?)", [(phone,) for phone in phones])
+        conn.close()
+    else:
+        for phone in phones:
+            if await main.db_get_user(phone) is None:
+                await main.db_create_user(phone)
+
+    stop = asyncio.Event()
+    lags = []
+    async def probe_loop():
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - started - 0.001)
+
+    async def turn(i: int):
+        phone = phones[i % len(phones)]
+        changes = [{"estado": main.ESTADO_ESPERANDO_MAS_DETALLES, "last_analyzed_url": f"https://bit.ly/{i}"},
+                   {"last_analysis_details": f"detalles del turno {i}"}, {"estado": main.ESTADO_ESPERANDO_RESPUESTA_PHISHING}]
+        async with main.user_locks.acquire(phone):
+            if legacy:
+                for data in changes:
+                    legacy_db_update_user(phone, data)
+            else:
+                async with main.db_turn():
+                    for data in changes:
+                        await main.db_update_user(phone, data)
+
+    probe = asyncio.create_task(probe_loop())
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    await asyncio.gather(*(turn(i) for i in range(DB_BENCH_TURNS)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    return 3 * DB_BENCH_TURNS / elapsed, sorted(lags)
+
+async def evaluate_db_writes(args) -> list[str]:
+    results = {}
+    for label, legacy in (("Antes (conexión por llamada)", True), ("Ahora (Database + db_turn)", False)):
+        rate, lags = await measure_db_writes(legacy)
+        results[legacy] = rate
+        print(f"{label:<30} {rate:>8,.0f} escrituras/s   event loop frenado: p99 {format_ms(percentile(lags, 0.99))} ms, "
+              f"máximo {format_ms(lags[-1] if lags else None)} ms ({len(lags)} muestras)")
+    print(f"Mejora: x{results[False] / results[True]:.1f} en escrituras por segundo")
+    return [f"{results[False]:,.0f} escrituras/s < {args.min_msg_s:,.0f}"] if args.min_msg_s and results[False] < args.min_msg_s else []
+
+async def measure_summary_latency(client: httpx.AsyncClient, tracker: ReplyTracker, streaming: bool, args) -> list[float]:
+    """Segundos hasta el resumen de STREAMING_BENCH_MESSAGES análisis de phishing, de a uno."""
+    main.DEEPSEEK_STREAMING = streaming
+    texts = [text for text, intent in LABELED_INTENTS if intent == "analizar"]
+    message_ids = []
+    for i in range(STREAMING_BENCH_MESSAGES):
+        phone = f"5732{int(streaming)}{i:07d}"
+        if await main.db_get_user(phone) is None:
+            await main.db_create_user(phone)
+        await main.db_update_user(phone, {"estado": main.ESTADO_REGISTRADO, "nombre": "Ana", "edad": 62, "conocimiento": "Poco"})
+        message = text_message(phone, f"wamid.bench.streaming.{int(streaming)}.{i}", texts[i % len(texts)])
+        tracker.posted(message["id"])
+        message_ids.append(message["id"])
+        await client.post("/webhook", json=webhook_body([message]))
+        await wait_until_idle(tracker, args.espera_max) # También los detalles que siguen en segundo plano
+    return [tracker.second_reply[m] - tracker.posted_at[m] for m in message_ids if m in tracker.second_reply]
+
+async def evaluate_streaming(args) -> list[str]:
+    tracker = ReplyTracker()
+    upstreams = FakeUpstreams(args, tracker)
+    # Que cada análisis llegue a DeepSeek: sin caché de veredictos ni resumen inmediato por señales
+    main.VERDICT_CACHE_MIN_TEXT_LENGTH = 10 ** 9
+    main.SCAM_SIGNAL_FAST_REPLY_SCORE = 2.0
+    results = {}
+    async with main.lifespan(main.app):
+        await main.http_client.aclose()
+        main.http_client = httpx.AsyncClient(timeout=45.0, transport=httpx.MockTransport(upstreams.handle))
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://benchmark") as client:
+            for streaming in (False, True):
+                results[streaming] = await measure_summary_latency(client, tracker, streaming, args)
+    print(f"DeepSeek simulado: {args.latencia_llm:.0f} ms hasta el primer byte, {args.latencia_token:.0f} ms por token; "
+          f"{STREAMING_BENCH_MESSAGES} análisis de a uno")
+    print(latency_line("Resumen, sin streaming", results[False]))
+    print(latency_line("Resumen, con streaming", results[True]))
+    failures = [f"{STREAMING_BENCH_MESSAGES - len(values)} análisis sin resumen ({'con' if streaming else 'sin'} streaming)"
+                for streaming, values in results.items() if len(values) < STREAMING_BENCH_MESSAGES]
+    p99 = percentile(sorted(results[True]), 0.99)
+    if args.max_p99_ms and (p99 is None or p99 * 1000 > args.max_p99_ms):
+        failures.append(f"p99 hasta el resumen con streaming {format_ms(p99)} ms > {args.max_p99_ms} ms")
+    return failures
+
+def render_photo(seed: int) -> bytes:
+    """Foto de cámara sintética (JPEG 3000x4000): degradado con ruido, unos 4-5 MB."""
+    gradient = Image.linear_gradient("L").resize((3000, 4000))
+    noise = Image.effect_noise((3000, 4000), 25)
+    photo = Image.merge("RGB", (gradient, noise, Image.blend(gradient, noise, 0.5)))
+    photo.paste((255, 0, 0), (seed * 16, 0, seed * 16 + 16, 16)) # Distinta de las demás aunque el ruido se repita
+    buffer = io.BytesIO()
+    photo.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+async def measure_image_peaks(upstreams: FakeUpstreams, image: bytes, media_id: str, traced: bool) -> dict[str, float]:
+    """MiB por encima del punto de partida en el pico de cada paso de una imagen (RSS o heap de Python)."""
+    upstreams.images = [(image, hashlib.sha256(image).hexdigest())]
+    peaks = {}
+    async def step(name: str, coro):
+        if traced:
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+        else:
+            reset_rss_high_water()
+            start = rss_mib()
+        result = await coro
+        peak = tracemalloc.get_traced_memory()[1] if traced else rss_high_water_mib() * 2**20
+        peaks[name] = max(0.0, (peak - (start if traced else start * 2**20)) / 2**20)
+        return result
+
+    path = main.image_store.incoming_path()
+    sha256 = await step("descarga", main.download_image_from_whatsapp(media_id, path))
+    if not sha256:
+        return {}
+    await step("firma", main.ocr_cache.lookup(sha256, path))
+    relative_path = await main.image_store.store("573300000000", path, sha256)
+    await step("re-codificación", main.image_store.compact(sha256, relative_path))
+    return peaks
+
+async def evaluate_media_memory(args) -> list[str]:
+    if not reset_rss_high_water():
+        print("Aviso: /proc/self/clear_refs no está disponible; el pico de RSS es el del proceso completo.")
+    upstreams = FakeUpstreams(args, ReplyTracker())
+    main.http_client = httpx.AsyncClient(timeout=45.0, transport=httpx.MockTransport(upstreams.handle))
+    if await main.db_get_user("573300000000") is None:
+        await main.db_create_user("573300000000")
+    kinds = {
+        "captura PNG 1080x1600": [render_screenshot(f"{SCREENSHOT_TEXTS[i % len(SCREENSHOT_TEXTS)]} ref {i}") for i in range(2 * MEDIA_BENCH_ROUNDS)],
+        "foto JPEG 3000x4000": [render_photo(i) for i in range(2 * MEDIA_BENCH_ROUNDS)],
+    }
+    failures = []
+    print(f"Pico por encima del inicio de cada paso, MiB (máximo de {MEDIA_BENCH_ROUNDS} imágenes distintas; "
+          f"bloques de descarga de {main.MEDIA_DOWNLOAD_CHUNK_BYTES // 1024} KiB)")
+    for kind, images in kinds.items():
+        results = {}
+        # Dos pasadas: tracemalloc infla el RSS, así que no se mide a la vez que VmHWM
+        for traced, batch in ((False, images[:MEDIA_BENCH_ROUNDS]), (True, images[MEDIA_BENCH_ROUNDS:])):
+            if traced:
+                tracemalloc.start()
+            for i, image in enumerate(batch):
+                peaks = await measure_image_peaks(upstreams, image, f"bench-media-{kind[:4]}-{int(traced)}-{i}", traced)
+                if not peaks:
+                    failures.append(f"no se descargó una imagen de tipo {kind}")
+                for name, value in peaks.items():
+                    results[name, traced] = max(results.get((name, traced), 0.0), value)
+            if traced:
+                tracemalloc.stop()
+        size_mib = sum(map(len, images)) / len(images) / 2**20
+        print(f"  {kind} (~{size_mib:.2f} MiB en disco)")
+        for name in ("descarga", "firma", "re-codificación"):
+            if (name, False) in results:
+                print(f"    {name:<16} RSS +{results[name, False]:6.1f}   heap Python +{results.get((name, True), 0.0):6.2f}")
+    await main.http_client.aclose()
+    return failures
+
+def build_scan_corpus(size: int, rng: random.Random) -> list[str]:
+    """Mensajes de 1 a 3 textos etiquetados y capturas pegados, con números cambiados."""
+    texts = [text for text, _ in LABELED_INTENTS] + SCREENSHOT_TEXTS
+    corpus = []
+    for _ in range(size):
+        message = " ".join(rng.sample(texts, rng.randint(1, 3)))
+        corpus.append(re.sub(r"\d+", lambda m: str(rng.randrange(10 ** len(m.group()))), message))
+    return corpus
+
+def evaluate_scam_scanner(args) -> list[str]:
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = [line.strip() for line in f if line.strip()]
+    else:
+        corpus = build_scan_corpus(args.mensajes, random.Random(args.semilla))
+    scanner = main.scam_signal_scanner
+    for text in corpus[:1000]:
+        scanner.scan(text) # Calentamiento
+    started = time.perf_counter()
+    scores = [scanner.scan(text).score for text in corpus]
+    elapsed = time.perf_counter() - started
+    timings = []
+    for text in corpus[:SCAN_TIMING_SAMPLE]:
+        scan_started = time.perf_counter()
+        scanner.scan(text)
+        timings.append(time.perf_counter() - scan_started)
+    timings.sort()
+    megabytes = sum(len(text.encode("utf-8")) for text in corpus) / 2 ** 20
+    fast = sum(score >= main.SCAM_SIGNAL_FAST_REPLY_SCORE for score in scores)
+    benign = sum(score <= main.SCAM_SIGNAL_BENIGN_MAX_SCORE for score in scores)
+    rate = len(corpus) / elapsed
+    print(f"Léxico {scanner.version}: {len(scanner.patterns)} frases, {len(scanner.transitions)} estados del autómata")
+    print(f"Corpus: {len(corpus)} mensajes, {megabytes:.1f} MiB")
+    print(f"Throughput: {rate:,.0f} msg/s, {megabytes / elapsed:.1f} MiB/s")
+    print(f"Por mensaje: p50 {percentile(timings, 0.5) * 1e6:.1f} µs, p99 {percentile(timings, 0.99) * 1e6:.1f} µs")
+    print(f"Triage: {fast / len(corpus):.1%} respuesta inmediata, {benign / len(corpus):.1%} sin señales, "
+          f"{1 - (fast + benign) / len(corpus):.1%} a DeepSeek con pistas")
+    print("Mensajes etiquetados (puntaje por intención):")
+    by_intent = {}
+    for text, intent in LABELED_INTENTS:
+        by_intent.setdefault(intent, []).append(scanner.scan(text).score)
+    for intent, intent_scores in sorted(by_intent.items()):
+        print(f"  {intent:24} promedio {sum(intent_scores) / len(intent_scores):.2f}  máximo {max(intent_scores):.2f}")
+    failures = [f"throughput del escáner {rate:,.0f} msg/s < {args.min_msg_s:,.0f}"] if args.min_msg_s and rate < args.min_msg_s else []
+    return failures + evaluate_benign_skip(scanner)
+
+def evaluate_benign_skip(scanner) -> list[str]:
+    """Falsos negativos del atajo "sin señales" sobre LABELED_SCAM_MESSAGES (ninguno trae enlaces)."""
+    labeled = [(scanner.scan(text).score, is_scam, text) for text, is_scam in LABELED_SCAM_MESSAGES]
+    scams = sum(is_scam for _, is_scam, _ in labeled)
+    legit = len(labeled) - scams
+    configured = main.SCAM_SIGNAL_BENIGN_MAX_SCORE
+    print(f"Corpus etiquetado: {scams} estafas, {legit} mensajes legítimos")
+    for threshold in sorted({-1.0, 0.0, 0.1, 0.2, 0.3, configured}):
+        missed = [text for score, is_scam, text in labeled if is_scam and score <= threshold]
+        skipped_legit = sum(not is_scam and score <= threshold for score, is_scam, _ in labeled)
+        label = "desactivado" if threshold < 0 else f"<= {threshold:.2f}"
+        marker = "  (configurado)" if threshold == configured else ""
+        print(f"  sin DeepSeek si puntaje {label:<12} estafas dadas por benignas {len(missed)}/{scams} ({len(missed) / scams:.0%}), "
+              f"legítimos resueltos sin DeepSeek {skipped_legit}/{legit}{marker}")
+        for text in missed if threshold == configured else []:
+            print(f"    falso negativo: {text}")
+    fast_legit = sum(not is_scam and score >= main.SCAM_SIGNAL_FAST_REPLY_SCORE for score, is_scam, _ in labeled)
+    fast_scams = sum(is_scam and score >= main.SCAM_SIGNAL_FAST_REPLY_SCORE for score, is_scam, _ in labeled)
+    print(f"  respuesta inmediata (>= {main.SCAM_SIGNAL_FAST_REPLY_SCORE:.2f}): {fast_scams}/{scams} estafas, {fast_legit}/{legit} legítimos")
+    missed_configured = sum(is_scam and score <= configured for score, is_scam, _ in labeled)
+    failures = []
+    if missed_configured:
+        failures.append(f"SCAM_SIGNAL_BENIGN_MAX_SCORE={configured} da por benignas {missed_configured} estafa(s) etiquetada(s)")
+    if fast_legit:
+        failures.append(f"SCAM_SIGNAL_FAST_REPLY_SCORE={main.SCAM_SIGNAL_FAST_REPLY_SCORE} marca {fast_legit} mensaje(s) legítimo(s) como estafa")
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=50)
+    parser.add_argument("--turnos", type=int, default=6, help="mensajes de conversación por usuario después del registro")
+    parser.add_argument("--imagenes", type=float, default=0.1, help="fracción de turnos que son una imagen")
+    parser.add_argument("--rafagas", type=float, default=0.1, help="fracción de turnos con 2-4 mensajes seguidos")
+    parser.add_argument("--duplicados", type=float, default=0.05, help="fracción de turnos que Meta reenvía con el mismo message_id")
+    parser.add_argument("--pausa", type=float, default=1.0, help="segundos promedio entre la respuesta del bot y el siguiente mensaje (0 = sin pausa)")
+    parser.add_argument("--arranque", type=float, default=5.0, help="segundos en los que van llegando los usuarios")
+    parser.add_argument("--replay", help="archivo .jsonl con cuerpos de webhook a reenviar en orden")
+    parser.add_argument("--velocidad", type=float, default=1.0, help="factor de velocidad del replay con tiempos (2 = el doble de rápido)")
+    parser.add_argument("--latencia-graph", type=float, default=80, help="ms promedio de Graph API")
+    parser.add_argument("--latencia-cdn", type=float, default=150, help="ms promedio de la CDN de media")
+    parser.add_argument("--latencia-llm", type=float, default=400, help="ms promedio hasta el primer byte de DeepSeek")
+    parser.add_argument("--latencia-token", type=float, default=10, help="ms por token de DeepSeek (sin streaming se esperan todos antes de responder)")
+    parser.add_argument("--errores", type=float, default=0.0, help="fracción de llamadas a cada simulador que fallan (429/5xx)")
+    parser.add_argument("--espera-max", type=float, default=60.0, help="segundos máximos esperando una respuesta o el reposo final")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--escenario", choices=sorted(ESCENARIOS), help="carga predefinida con sus límites (ver ESCENARIOS)")
+    parser.add_argument("--max-p99-ms", type=float, help="falla si el p99 hasta la primera respuesta lo supera")
+    parser.add_argument("--max-post-p99-ms", type=float, help="falla si el p99 de POST /webhook lo supera")
+    parser.add_argument("--min-msg-s", type=float, help="falla si el throughput queda por debajo")
+    parser.add_argument("--intenciones", action="store_true", help="solo medir el clasificador local de intención")
+    parser.add_argument("--respuestas", action="store_true", help="solo medir el clasificador local de respuestas sí/no/ayuda")
+    parser.add_argument("--registro", action="store_true", help="solo medir la extracción local de nombre, edad y conocimiento")
+    parser.add_argument("--senales", action="store_true", help="solo medir el escáner de señales de estafa (--min-msg-s aplica a él)")
+    parser.add_argument("--mensajes", type=int, default=200000, help="tamaño del corpus sintético con --senales")
+    parser.add_argument("--corpus", help="archivo de texto con un mensaje por línea para --senales")
+    parser.add_argument("--streaming", action="store_true", help="solo comparar el tiempo hasta el resumen de phishing con y sin streaming (--max-p99-ms aplica con streaming)")
+    parser.add_argument("--escrituras", action="store_true", help="solo medir escrituras por segundo a la base y el freno del event loop (--min-msg-s aplica a ellas)")
+    parser.add_argument("--descargas", action="store_true", help="solo medir la memoria pico por imagen (descarga, firma de OCR, re-codificación)")
+    args = parser.parse_args()
+    if args.escenario:
+        parser.set_defaults(**ESCENARIOS[args.escenario])
+        args = parser.parse_args()
+
+    if args.intenciones:
+        failures = evaluate_intents()
+    elif args.respuestas:
+        failures = evaluate_replies()
+    elif args.registro:
+        failures = evaluate_onboarding()
+    elif args.senales:
+        failures = evaluate_scam_scanner(args)
+    elif args.escrituras:
+        failures = asyncio.run(evaluate_db_writes(args))
+    elif args.streaming:
+        failures = asyncio.run(evaluate_streaming(args))
+    elif args.descargas:
+        failures = asyncio.run(evaluate_media_memory(args))
+    else:
+        failures = asyncio.run(run_load(args))
+    for failure in failures:
+        print(f"FALLA: {failure}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,234 @@
+"""Almacén de las imágenes recibidas por contenido (sha256), con re-codificación a WebP
+después del OCR y limpieza por retención, referencias y presupuesto de disco. main.py crea
+la instancia (image_store) con su base de datos y la función que registra cada imagen a
+nombre del usuario (db_save_image_record).
+"""
+import io
+import os
+import time
+import uuid
+import sqlite3
+import asyncio
+import logging
+from collections import Counter
+from typing import TYPE_CHECKING
+
+from PIL import Image, features
+from dotenv import load_dotenv
+
+if TYPE_CHECKING:
+    from main import Database
+
+load_dotenv()
+
+# Almacén de imágenes por contenido (IMAGES_DIR/ab/cd/<sha256>, ver ImageStore)
+IMAGE_RETENTION_DAYS = float(os.getenv("IMAGE_RETENTION_DAYS", "30"))
+IMAGE_STORE_MAX_BYTES = int(float(os.getenv("IMAGE_STORE_MAX_MB", "2048")) * 1024 * 1024)
+IMAGE_STORE_SWEEP_SECONDS = float(os.getenv("IMAGE_STORE_SWEEP_SECONDS", "3600")) # 0 desactiva la limpieza
+# Calidad WebP con la que se re-codifica cada imagen nueva después del OCR (0 = se guarda tal cual llegó)
+IMAGE_STORE_WEBP_QUALITY = int(os.getenv("IMAGE_STORE_WEBP_QUALITY", "70"))
+IMAGE_STORE_GRACE_SECONDS = 600 # La limpieza no toca archivos usados hace menos (imágenes en proceso)
+IMAGE_STORE_STALE_TEMP_SECONDS = 3600 # Descargas a medias que quedaron por un reinicio
+
+media_log = logging.getLogger("bot.media")
+
+class ImageStore:
+    """Imágenes recibidas guardadas por contenido en IMAGES_DIR/ab/cd/<sha256>.
+
+    La clave es el sha256 del archivo que entregó Graph (el mismo de OCRCache): la misma
+    captura reenviada por cien usuarios ocupa un solo archivo, y cada fila de
+    imagenes_procesadas que la usa suma una referencia en imagenes_almacenadas. Después del
+    OCR el archivo se re-codifica a WebP con IMAGE_STORE_WEBP_QUALITY si así pesa menos (la
+    clave no cambia). sweep() borra las filas más viejas que IMAGE_RETENTION_DAYS, los archivos
+    que quedaron sin referencias y, si el total supera IMAGE_STORE_MAX_BYTES, los usados hace
+    más tiempo; con dos niveles de 256 directorios que se borran al quedar vacíos, el disco,
+    los archivos por directorio y los inodos quedan acotados.
+    """
+
+    def __init__(self, database: "Database", root: str, save_record):
+        self.db = database
+        self.root = root
+        self.save_record = save_record # async (telefono, ruta relativa, sha256): fila en imagenes_procesadas
+        self.incoming_dir = os.path.join(root, "entrantes")
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        self.stats = Counter()
+        self.format = "WEBP" if features.check("webp") else "JPEG"
+        self.files = 0
+        self.total_bytes = 0
+        self._refresh_totals_sync()
+
+    @staticmethod
+    def relative_path(sha256: str) -> str:
+        return os.path.join(sha256[:2], sha256[2:4], sha256)
+
+    def path(self, relative_path: str) -> str:
+        return os.path.join(self.root, relative_path)
+
+    def incoming_path(self) -> str:
+        """Ruta para descargar una imagen antes de guardarla (mismo disco: se mueve sin copiar)."""
+        return os.path.join(self.incoming_dir, uuid.uuid4().hex)
+
+    def _refresh_totals_sync(self):
+        self.files, self.total_bytes = self.db.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM imagenes_almacenadas"
+        ).fetchone()
+
+    def _store_sync(self, temp_path: str, sha256: str) -> str:
+        row = self.db.conn.execute("SELECT ruta, bytes FROM imagenes_almacenadas WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is not None and os.path.exists(self.path(row["ruta"])):
+            os.remove(temp_path)
+            self.stats["deduplicated"] += 1
+            return row["ruta"]
+        relative = self.relative_path(sha256)
+        final_path = self.path(relative)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, final_path)
+        now = time.time()
+        try:
+            # Si la fila existía pero el archivo se perdió, se rehace conservando las referencias
+            self.db.conn.execute(
+                "INSERT INTO imagenes_almacenadas (sha256, ruta, formato, bytes, bytes_originales, creado_en, usado_en) "
+                "VALUES (?, ?, 'original', ?, ?, ?, ?) ON CONFLICT (sha256) DO UPDATE SET ruta = excluded.ruta, "
+                "formato = 'original', bytes = excluded.bytes, bytes_originales = excluded.bytes_originales, usado_en = excluded.usado_en",
+                (sha256, relative, size, size, now, now)
+            )
+        except sqlite3.Error:
+            os.remove(final_path)
+            raise
+        self.files += row is None
+        self.total_bytes += size - (row["bytes"] if row is not None else 0)
+        self.stats["stored"] += 1
+        return relative
+
+    async def store(self, telefono: str, temp_path: str, sha256: str) -> str:
+        """Guarda la imagen descargada en temp_path y la registra a nombre del usuario; devuelve su ruta relativa."""
+        relative = await self.db.run(self._store_sync, temp_path, sha256)
+        await self.save_record(telefono, relative, sha256)
+        return relative
+
+    def _exists_sync(self, relative_path: str) -> str | None:
+        row = self.db.conn.execute("SELECT sha256 FROM imagenes_almacenadas WHERE ruta = ?", (relative_path,)).fetchone()
+        return row["sha256"] if row is not None and os.path.exists(self.path(relative_path)) else None
+
+    async def reuse(self, telefono: str, relative_path: str) -> bool:
+        """Registra al usuario una imagen ya guardada (casi-duplicado de OCRCache) si sigue en el almacén."""
+        sha256 = await self.db.run(self._exists_sync, relative_path)
+        if sha256 is None:
+            return False
+        await self.save_record(telefono, relative_path, sha256)
+        self.stats["reused"] += 1
+        return True
+
+    def _compact_file(self, path: str) -> int | None:
+        with Image.open(path) as img:
+            if img.format == self.format:
+                return None
+            img = img.convert("RGBA" if self.format == "WEBP" and "A" in img.getbands() else "RGB")
+        buffer = io.BytesIO()
+        img.save(buffer, self.format, quality=IMAGE_STORE_WEBP_QUALITY)
+        if buffer.tell() >= os.path.getsize(path):
+            return None
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(buffer.getbuffer())
+        os.replace(temp_path, path)
+        return buffer.tell()
+
+    def _set_format_sync(self, sha256: str, image_format: str, size: int):
+        old = self.db.conn.execute("SELECT bytes FROM imagenes_almacenadas WHERE sha256 = ?", (sha256,)).fetchone()
+        self.db.conn.execute("UPDATE imagenes_almacenadas SET formato = ?, bytes = ? WHERE sha256 = ?", (image_format, size, sha256))
+        if old is not None:
+            self.total_bytes -= old["bytes"] - size
+            self.stats["compact_bytes_saved"] += old["bytes"] - size
+
+    async def compact(self, sha256: str, relative_path: str):
+        """Re-codifica la imagen una vez terminado el OCR; si no gana espacio, la deja como está."""
+        if IMAGE_STORE_WEBP_QUALITY <= 0:
+            return
+        try:
+            size = await asyncio.to_thread(self._compact_file, self.path(relative_path))
+            if size is not None:
+                await self.db.run(self._set_format_sync, sha256, self.format.lower(), size)
+                self.stats["compacted"] += 1
+        except (OSError, sqlite3.Error) as e:
+            self.stats["errors"] += 1
+            media_log.error("No se pudo re-codificar la imagen %s: %s", relative_path, e)
+
+    def _select_victims_sync(self) -> list[tuple[str, str]]:
+        """Quita de la base las filas vencidas y los archivos a borrar; devuelve (sha256, ruta) de estos."""
+        conn = self.db.conn
+        retention = f"-{int(IMAGE_RETENTION_DAYS * 86400)} seconds"
+        grace_cutoff = time.time() - IMAGE_STORE_GRACE_SECONDS
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            expired = conn.execute(
+                "SELECT sha256, COUNT(*) FROM imagenes_procesadas WHERE timestamp < datetime('now', ?) AND sha256 IS NOT NULL GROUP BY sha256",
+                (retention,)
+            ).fetchall()
+            self.stats["rows_expired"] += conn.execute("DELETE FROM imagenes_procesadas WHERE timestamp < datetime('now', ?)", (retention,)).rowcount
+            conn.executemany("UPDATE imagenes_almacenadas SET referencias = MAX(referencias - ?, 0) WHERE sha256 = ?",
+                             [(count, sha256) for sha256, count in expired])
+            victims = conn.execute(
+                "SELECT sha256, ruta, bytes FROM imagenes_almacenadas WHERE referencias = 0 AND usado_en < ?", (grace_cutoff,)
+            ).fetchall()
+            self.stats["deleted_unreferenced"] += len(victims)
+            # Presupuesto de disco: se sacrifican las usadas hace más tiempo aunque tengan referencias
+            remaining = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM imagenes_almacenadas").fetchone()[0] - sum(v["bytes"] for v in victims)
+            if remaining > IMAGE_STORE_MAX_BYTES:
+                oldest = conn.execute(
+                    "SELECT sha256, ruta, bytes FROM imagenes_almacenadas WHERE referencias > 0 AND usado_en < ? ORDER BY usado_en", (grace_cutoff,)
+                )
+                for row in oldest:
+                    if remaining <= IMAGE_STORE_MAX_BYTES:
+                        break
+                    victims.append(row)
+                    remaining -= row["bytes"]
+                    self.stats["deleted_over_budget"] += 1
+                oldest.close()
+            conn.executemany("DELETE FROM imagenes_procesadas WHERE sha256 = ?", [(v["sha256"],) for v in victims])
+            conn.executemany("DELETE FROM imagenes_almacenadas WHERE sha256 = ?", [(v["sha256"],) for v in victims])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._refresh_totals_sync()
+        return [(v["sha256"], v["ruta"]) for v in victims]
+
+    def _delete_files(self, victims: list[tuple[str, str]]):
+        for _, relative in victims:
+            path = self.path(relative)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            for directory in (os.path.dirname(path), os.path.dirname(os.path.dirname(path))):
+                try:
+                    os.rmdir(directory) # Solo si quedó vacío
+                except OSError:
+                    break
+        # Descargas a medias, y las imágenes sueltas del esquema anterior ({telefono}_{uuid}.jpg en la raíz)
+        now = time.time()
+        for directory, max_age in ((self.incoming_dir, IMAGE_STORE_STALE_TEMP_SECONDS), (self.root, IMAGE_RETENTION_DAYS * 86400)):
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    age_limit = IMAGE_STORE_STALE_TEMP_SECONDS if entry.name.startswith(".") else max_age
+                    if now - entry.stat(follow_symlinks=False).st_mtime > age_limit:
+                        try:
+                            os.remove(entry.path)
+                            self.stats["deleted_loose"] += 1
+                        except FileNotFoundError:
+                            pass
+
+    async def sweep(self):
+        try:
+            victims = await self.db.run(self._select_victims_sync)
+            await asyncio.to_thread(self._delete_files, victims)
+            self.stats["sweeps"] += 1
+            if victims:
+                media_log.info("Limpieza de imágenes: %s archivos borrados; quedan %s (%.1f MB).", len(victims), self.files, self.total_bytes / 1048576)
+        except (OSError, sqlite3.Error) as e:
+            self.stats["errors"] += 1
+            media_log.error("Error en la limpieza del almacén de imágenes: %s", e)
@@ -0,0 +1,220 @@
+"""Gateway hacia la API de chat de DeepSeek: concurrencia por modo, fusión de peticiones
+idénticas en vuelo, reintentos con jitter y circuit breaker. main.py crea la instancia
+(llm_gateway) con el cliente HTTP compartido.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from collections import Counter
+from contextlib import asynccontextmanager
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Gateway de LLM: límites de concurrencia, reintentos y circuit breaker hacia DeepSeek
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_MODE_MAX_CONCURRENCY = int(os.getenv("LLM_MODE_MAX_CONCURRENCY", "8"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.5"))
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+# Las clasificaciones cortas no deberían tardar lo mismo que un análisis completo
+LLM_MODE_TIMEOUTS = {
+    "nombre": 15.0, "edad": 15.0, "conocimiento": 15.0, "intencion": 15.0,
+    "decision_ver_detalles": 15.0, "decision_post_phishing_interaction": 15.0,
+    "phishing": 45.0, "ayuda_post_estafa": 45.0, "cyber_pregunta": 45.0,
+}
+LLM_DEFAULT_TIMEOUT = 45.0
+
+llm_log = logging.getLogger("bot.llm")
+
+class LLMUnavailableError(Exception):
+    """El circuit breaker está abierto: DeepSeek falló repetidamente y se rechaza sin llamar."""
+
+class LLMGateway:
+    """Capa entre analyze_with_deepseek/stream_deepseek y el cliente HTTP.
+
+    - Semáforo global y uno por modo (la espera se mide como queue wait).
+    - Las peticiones idénticas en vuelo (mismo modo y payload) se fusionan en una sola llamada.
+    - Reintentos con jitter en 429/5xx y errores de red, respetando Retry-After.
+    - Circuit breaker: tras LLM_BREAKER_FAILURE_THRESHOLD fallos seguidos rechaza de inmediato
+      durante LLM_BREAKER_RESET_SECONDS y luego deja pasar una petición de prueba (half-open).
+    - Timeout por modo (LLM_MODE_TIMEOUTS).
+    """
+
+    RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, client_getter, api_url: str, api_key_getter):
+        self.client_getter = client_getter
+        self.api_url = api_url
+        self.api_key_getter = api_key_getter
+        self.global_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        self.mode_semaphores: dict[str, asyncio.Semaphore] = {}
+        self.inflight: dict[tuple[str, str], asyncio.Future] = {}
+        self.breaker_state = "closed"
+        self.breaker_opened_at = 0.0
+        self.consecutive_failures = 0
+        self.half_open_probe_running = False
+        self.stats = Counter()
+        self.seconds = Counter() # Sumas de tiempos: queue_wait.<modo>, upstream.<modo>
+
+    def _headers(self, stream: bool = False) -> dict:
+        headers = {"Authorization": f"Bearer {self.api_key_getter()}", "Content-Type": "application/json"}
+        if stream:
+            headers["Accept"] = "text/event-stream"
+        return headers
+
+    def _check_breaker(self):
+        if self.breaker_state == "open":
+            if time.monotonic() - self.breaker_opened_at < LLM_BREAKER_RESET_SECONDS:
+                self.stats["rejected_breaker_open"] += 1
+                raise LLMUnavailableError("Circuit breaker abierto para DeepSeek")
+            self.breaker_state = "half_open"
+        if self.breaker_state == "half_open":
+            if self.half_open_probe_running:
+                self.stats["rejected_breaker_open"] += 1
+                raise LLMUnavailableError("Circuit breaker en prueba (half-open) para DeepSeek")
+            self.half_open_probe_running = True
+
+    def _record_success(self):
+        self.consecutive_failures = 0
+        self.half_open_probe_running = False
+        if self.breaker_state != "closed":
+            llm_log.info("Gateway LLM: circuit breaker cerrado, DeepSeek responde de nuevo.")
+        self.breaker_state = "closed"
+
+    def _record_failure(self):
+        self.consecutive_failures += 1
+        self.half_open_probe_running = False
+        if self.breaker_state == "half_open" or self.consecutive_failures >= LLM_BREAKER_FAILURE_THRESHOLD:
+            if self.breaker_state != "open":
+                llm_log.error("Gateway LLM: circuit breaker ABIERTO tras %s fallos seguidos.", self.consecutive_failures)
+                self.stats["breaker_opened"] += 1
+            self.breaker_state = "open"
+            self.breaker_opened_at = time.monotonic()
+
+    def _retry_delay(self, attempt: int, response: httpx.Response | None) -> float:
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), 30.0)
+        return random.uniform(0, LLM_RETRY_BASE_SECONDS * (2 ** attempt)) # full jitter
+
+    @asynccontextmanager
+    async def _slot(self, mode: str):
+        semaphore = self.mode_semaphores.get(mode)
+        if semaphore is None:
+            semaphore = self.mode_semaphores[mode] = asyncio.Semaphore(LLM_MODE_MAX_CONCURRENCY)
+        wait_started = time.perf_counter()
+        async with self.global_semaphore, semaphore:
+            self.seconds[f"queue_wait.{mode}"] += time.perf_counter() - wait_started
+            yield
+
+    async def complete(self, mode: str, payload: dict) -> dict:
+        """POST de chat completions; devuelve el JSON. Fusiona peticiones idénticas en vuelo."""
+        key = (mode, json.dumps(payload, sort_keys=True, ensure_ascii=False))
+        shared = self.inflight.get(key)
+        if shared is not None:
+            self.stats[f"coalesced.{mode}"] += 1
+            return await asyncio.shield(shared)
+        shared = self.inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._complete_uncoalesced(mode, payload)
+            shared.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            shared.cancel()
+            raise
+        except Exception as e:
+            shared.set_exception(e)
+            shared.exception() # Marcar como consultada si nadie más la espera
+            raise
+        finally:
+            del self.inflight[key]
+
+    async def _complete_uncoalesced(self, mode: str, payload: dict) -> dict:
+        self._check_breaker()
+        self.stats[f"requests.{mode}"] += 1
+        timeout = LLM_MODE_TIMEOUTS.get(mode, LLM_DEFAULT_TIMEOUT)
+        try:
+            return await self._post_with_retries(mode, payload, timeout)
+        finally:
+            self.half_open_probe_running = False # Cualquier salida (incluso inesperada) libera la prueba
+
+    async def _post_with_retries(self, mode: str, payload: dict, timeout: float) -> dict:
+        async with self._slot(mode):
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                response = None
+                started = time.perf_counter()
+                try:
+                    response = await self.client_getter().post(self.api_url, json=payload, headers=self._headers(), timeout=timeout)
+                    self.seconds[f"upstream.{mode}"] += time.perf_counter() - started
+                    response.raise_for_status()
+                    self._record_success()
+                    return response.json()
+                except (httpx.HTTPStatusError, httpx.RequestError) as e:
+                    retryable = isinstance(e, httpx.RequestError) or e.response.status_code in self.RETRYABLE_STATUS
+                    if not retryable:
+                        self._record_success() # Un 4xx es culpa de la petición, no de la salud del servicio
+                        raise
+                    if attempt == LLM_MAX_RETRIES:
+                        self.stats[f"failures.{mode}"] += 1
+                        self._record_failure()
+                        raise
+                    self.stats[f"retries.{mode}"] += 1
+                    await asyncio.sleep(self._retry_delay(attempt, response))
+
+    @asynccontextmanager
+    async def stream(self, mode: str, payload: dict):
+        """Abre una respuesta SSE (reintenta solo antes del primer byte) y la entrega abierta."""
+        self._check_breaker()
+        self.stats[f"requests.{mode}"] += 1
+        timeout = LLM_MODE_TIMEOUTS.get(mode, LLM_DEFAULT_TIMEOUT)
+        async with self._slot(mode):
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                started = time.perf_counter()
+                request = self.client_getter().build_request("POST", self.api_url, json=payload, headers=self._headers(stream=True), timeout=timeout)
+                try:
+                    response = await self.client_getter().send(request, stream=True)
+                except httpx.RequestError:
+                    if attempt == LLM_MAX_RETRIES:
+                        self.stats[f"failures.{mode}"] += 1
+                        self._record_failure()
+                        raise
+                    self.stats[f"retries.{mode}"] += 1
+                    await asyncio.sleep(self._retry_delay(attempt, None))
+                    continue
+                if response.status_code in self.RETRYABLE_STATUS and attempt < LLM_MAX_RETRIES:
+                    await response.aclose()
+                    self.stats[f"retries.{mode}"] += 1
+                    await asyncio.sleep(self._retry_delay(attempt, response))
+                    continue
+                try:
+                    response.raise_for_status()
+                    yield response
+                    self.seconds[f"upstream.{mode}"] += time.perf_counter() - started
+                    self._record_success()
+                except (httpx.HTTPStatusError, httpx.RequestError) as e:
+                    if isinstance(e, httpx.RequestError) or e.response.status_code in self.RETRYABLE_STATUS:
+                        self.stats[f"failures.{mode}"] += 1
+                        self._record_failure()
+                    else:
+                        self._record_success()
+                    raise
+                finally:
+                    await response.aclose()
+                    self.half_open_probe_running = False
+                return
+
+    def snapshot(self) -> dict:
+        return {
+            "breaker_state": self.breaker_state,
+            "consecutive_failures": self.consecutive_failures,
+            "inflight_coalescing_keys": len(self.inflight),
+            "stats": dict(self.stats),
+            "seconds": {k: round(v, 3) for k, v in self.seconds.items()},
+        }
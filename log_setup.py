@@ -0,0 +1,137 @@
+"""Logging del bot: una línea JSON por registro con el correlation id de la conversación.
+
+Los registros se recortan y redactan en el hilo que registra y se dejan en una cola acotada;
+el formateo y la escritura a stdout los hace un QueueListener en otro hilo. main.py llama a
+setup_logging() al importarse y publica el handler en /metrics (registros descartados).
+"""
+import os
+import sys
+import json
+import zlib
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import contextvars
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Logging: una línea JSON por registro; el formateo y la escritura a stdout ocurren en otro hilo
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "") # Por módulo, p. ej. "bot.ocr=DEBUG,bot.whatsapp=WARNING"
+# Fracción de conversaciones (por correlation id) cuyos DEBUG se registran; el resto se descarta
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+LOG_FIELD_MAX_CHARS = int(os.getenv("LOG_FIELD_MAX_CHARS", "200"))
+LOG_QUEUE_MAX = 10000
+# Texto del usuario, OCR y respuestas del LLM dentro de dicts registrados: solo se anota su tamaño
+LOG_REDACTED_KEYS = {"text", "body", "texto", "payload", "ocr_text_original", "last_image_ocr_text", "last_analysis_details", "last_image_analysis_raw"}
+
+# Id que une los registros de un mismo POST, mensaje de WhatsApp o trabajo de la cola
+current_correlation_id: contextvars.ContextVar[str] = contextvars.ContextVar("current_correlation_id", default="-")
+
+def redact_log_value(value, depth: int = 0):
+    """Recorta textos largos y oculta los campos de LOG_REDACTED_KEYS antes de registrar un valor."""
+    if isinstance(value, str):
+        if len(value) <= LOG_FIELD_MAX_CHARS:
+            return value
+        return f"{value[:LOG_FIELD_MAX_CHARS]}…(+{len(value) - LOG_FIELD_MAX_CHARS})"
+    if isinstance(value, dict):
+        if depth >= 3:
+            return f"<dict de {len(value)} claves>"
+        return {
+            key: f"<{len(item)} caracteres>" if key in LOG_REDACTED_KEYS and isinstance(item, str) else redact_log_value(item, depth + 1)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        if depth >= 3 or len(value) > 20:
+            return f"<{type(value).__name__} de {len(value)}>"
+        return [redact_log_value(item, depth + 1) for item in value]
+    return value
+
+LOG_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "correlation_id"}
+LOG_RECORD_BASE_SIZE = len(vars(logging.LogRecord("", 0, "", 0, "", None, None)))
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "cid": getattr(record, "correlation_id", "-"),
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in LOG_RECORD_ATTRS: # Campos pasados con extra={...}
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DebugSamplingFilter(logging.Filter):
+    """Deja pasar los DEBUG de una fracción de correlation ids (todos los de esa conversación o ninguno)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or LOG_DEBUG_SAMPLE_RATE >= 1:
+            return True
+        correlation_id = current_correlation_id.get()
+        bucket = zlib.crc32(correlation_id.encode()) if correlation_id != "-" else random.getrandbits(32)
+        return bucket % 10000 < LOG_DEBUG_SAMPLE_RATE * 10000
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Deja el registro en una cola acotada sin bloquear el event loop; si está llena lo descarta.
+
+    En el hilo que registra solo se arma el mensaje (con los argumentos ya recortados) y se
+    anota el correlation id; el JSON y el write a stdout los hace el QueueListener.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.correlation_id = current_correlation_id.get()
+        if record.args:
+            args = record.args
+            record.msg = str(record.msg) % (redact_log_value(args) if isinstance(args, dict) else tuple(redact_log_value(arg) for arg in args))
+            record.args = None
+        if len(record.__dict__) > LOG_RECORD_BASE_SIZE + 1: # Solo si vinieron campos con extra={...}
+            for key, value in list(record.__dict__.items()):
+                if key not in LOG_RECORD_ATTRS:
+                    record.__dict__[key] = redact_log_value(value)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging() -> NonBlockingQueueHandler:
+    # El JSON no usa archivo/línea, hilo ni proceso: no calcularlos en cada registro
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    root = logging.getLogger("bot")
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False # uvicorn configura el logger raíz; no duplicar
+    for spec in LOG_LEVELS.split(","):
+        name, _, level = spec.partition("=")
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonLogFormatter())
+    log_queue = queue.Queue(LOG_QUEUE_MAX)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(DebugSamplingFilter())
+    root.handlers = [handler]
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop) # Vacía la cola al salir
+    return handler
@@ -1,21 +1,41 @@
 import os
+import logging
 import sqlite3
 import asyncio
 import httpx
 import uuid
 import re
+import json
+import time
 import datetime
+import contextvars
+import hashlib
+import math
+import socket
+import zlib
+import bisect
+import mmap
+import struct
+import ipaddress
+import importlib.util
+import base64
 import random # Para los consejos de seguridad
 import unicodedata # Para normalizar texto
-from collections import defaultdict, deque
+from array import array
+from collections import Counter, OrderedDict, deque
 from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import PlainTextResponse, JSONResponse
-from io import BytesIO
-from PIL import Image
 import pytesseract
 from dotenv import load_dotenv
 
+from images import IMAGE_STORE_SWEEP_SECONDS, ImageStore
+from llm import LLMGateway, LLMUnavailableError
+from log_setup import current_correlation_id, setup_logging
+from ocr import OCR_QUEUE_MAX, OCR_WORKERS, OCRCache, OCREngine, OCRQueueFullError
+
 load_dotenv()
 
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
@@ -23,6 +43,27 @@ ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v18.0") # Se puede apuntar a un mock local
+# Cliente HTTP compartido (Graph API y DeepSeek): HTTP/2 si está instalado h2 (httpx[http2])
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1"
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+# Envío de mensajes de WhatsApp: cola en memoria con orden por destinatario, límite de tasa y reintentos
+WHATSAPP_SEND_WORKERS = int(os.getenv("WHATSAPP_SEND_WORKERS", "16")) # Envíos en vuelo (destinatarios distintos)
+WHATSAPP_SEND_RATE_PER_SECOND = float(os.getenv("WHATSAPP_SEND_RATE_PER_SECOND", "80")) # Tier por defecto de Cloud API
+WHATSAPP_SEND_BURST = int(os.getenv("WHATSAPP_SEND_BURST", "10"))
+WHATSAPP_SEND_MAX_RETRIES = int(os.getenv("WHATSAPP_SEND_MAX_RETRIES", "5"))
+WHATSAPP_SEND_RETRY_BASE_SECONDS = float(os.getenv("WHATSAPP_SEND_RETRY_BASE_SECONDS", "1.0"))
+WHATSAPP_SEND_DRAIN_SECONDS = float(os.getenv("WHATSAPP_SEND_DRAIN_SECONDS", "10")) # Espera al apagar
+# Unir en un solo mensaje los textos que ya esperan al mismo destinatario (menos viajes, menos burbujas)
+WHATSAPP_SEND_COALESCE = os.getenv("WHATSAPP_SEND_COALESCE", "0") == "1"
+WHATSAPP_TEXT_MAX_CHARS = 4096
+# Descarga de imágenes: límite de tamaño y tamaño de bloque al escribir a disco
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(10 * 1024 * 1024)))
+MEDIA_DOWNLOAD_CHUNK_BYTES = 64 * 1024
+MEDIA_URL_EXPIRED_STATUS = {403, 404, 410}
+# Streaming (SSE) para el análisis de phishing: el resumen se envía sin esperar los detalles
+DEEPSEEK_STREAMING = os.getenv("DEEPSEEK_STREAMING", "1") == "1"
+DEEPSEEK_DETAILS_WAIT_SECONDS = float(os.getenv("DEEPSEEK_DETAILS_WAIT_SECONDS", "60"))
 
 # Estados del usuario
 ESTADO_PENDIENTE_TERMINOS = 0
@@ -33,8 +74,205 @@ ESTADO_REGISTRADO = 4
 ESTADO_ESPERANDO_RESPUESTA_PHISHING = 5
 ESTADO_ESPERANDO_MAS_DETALLES = 6
 
+# Cola de webhooks: "queue" responde 200 de inmediato y procesa en segundo plano,
+# "inline" conserva el comportamiento anterior (procesar dentro de la petición).
+WEBHOOK_INGEST_MODE = os.getenv("WEBHOOK_INGEST_MODE", "queue").lower()
+WEBHOOK_QUEUE_WORKERS = int(os.getenv("WEBHOOK_QUEUE_WORKERS", "8"))
+WEBHOOK_QUEUE_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_QUEUE_MAX_ATTEMPTS", "4"))
+WEBHOOK_QUEUE_RETRY_BASE_SECONDS = float(os.getenv("WEBHOOK_QUEUE_RETRY_BASE_SECONDS", "2.0"))
+WEBHOOK_QUEUE_RETRY_MAX_SECONDS = float(os.getenv("WEBHOOK_QUEUE_RETRY_MAX_SECONDS", "120.0"))
+WEBHOOK_QUEUE_POLL_SECONDS = float(os.getenv("WEBHOOK_QUEUE_POLL_SECONDS", "1.0"))
+WEBHOOK_QUEUE_DB = os.getenv("WEBHOOK_QUEUE_DB", "cola_webhook.db")
+# Reparto de remitentes entre procesos: cada remitente cae siempre en el mismo shard y cada
+# shard lo atiende un solo proceso a la vez. "local" = este proceso atiende todos los shards
+# (un solo worker, pruebas); "lease" = los procesos se reparten los shards con leases en SQLite.
+WEBHOOK_SHARD_MODE = os.getenv("WEBHOOK_SHARD_MODE", "local").lower()
+WEBHOOK_SHARDS = int(os.getenv("WEBHOOK_SHARDS", "16"))
+WEBHOOK_SHARD_LEASE_SECONDS = float(os.getenv("WEBHOOK_SHARD_LEASE_SECONDS", "15"))
+
+# Deduplicación de message_id compartida entre workers y reinicios (Meta reintenta hasta ~7 días)
+MESSAGE_DEDUPE_DB = os.getenv("MESSAGE_DEDUPE_DB", "mensajes_procesados.db")
+MESSAGE_DEDUPE_TTL_SECONDS = float(os.getenv("MESSAGE_DEDUPE_TTL_SECONDS", str(7 * 24 * 3600)))
+MESSAGE_DEDUPE_LOCAL_SIZE = int(os.getenv("MESSAGE_DEDUPE_LOCAL_SIZE", "10000"))
+
+# Caché en memoria de perfiles de usuario (fila de la tabla usuarios)
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "600"))
+# Procesos que sirven el webhook (uvicorn y gunicorn toman --workers de la misma variable)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# La caché de perfiles y los detalles de análisis pendientes viven en la memoria de cada proceso
+# y nada los invalida desde otro. Solo se usan si un usuario siempre cae en el mismo proceso
+# (uno solo, o la cola con leases por shard); si no, se desactivan en lugar de versionar cada lectura.
+PROCESS_LOCAL_USER_STATE = WEB_CONCURRENCY <= 1 or (WEBHOOK_INGEST_MODE == "queue" and WEBHOOK_SHARD_MODE == "lease")
+# Espera máxima por el lock de un usuario (0 = sin límite); al vencer, el trabajo de la cola se reintenta
+USER_LOCK_TIMEOUT_SECONDS = float(os.getenv("USER_LOCK_TIMEOUT_SECONDS", "120"))
+
+# Clasificador local de intención: por debajo de esta confianza se consulta a DeepSeek
+INTENT_LOCAL_MIN_CONFIDENCE = float(os.getenv("INTENT_LOCAL_MIN_CONFIDENCE", "0.85"))
+# Igual para las respuestas sí/no/ayuda en los estados de espera (más detalles, ¿hiciste clic?)
+REPLY_LOCAL_MIN_CONFIDENCE = float(os.getenv("REPLY_LOCAL_MIN_CONFIDENCE", "0.85"))
+# Y para nombre, edad y conocimiento en el registro
+ONBOARDING_LOCAL_MIN_CONFIDENCE = float(os.getenv("ONBOARDING_LOCAL_MIN_CONFIDENCE", "0.85"))
+
+# Caché de veredictos de phishing (mensajes repetidos de campañas de estafa)
+VERDICT_CACHE_TTL_SECONDS = float(os.getenv("VERDICT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+VERDICT_CACHE_MAX_ENTRIES = int(os.getenv("VERDICT_CACHE_MAX_ENTRIES", "50000"))
+VERDICT_CACHE_MIN_TEXT_LENGTH = int(os.getenv("VERDICT_CACHE_MIN_TEXT_LENGTH", "40"))
+VERDICT_CACHE_SIMHASH_MAX_DISTANCE = int(os.getenv("VERDICT_CACHE_SIMHASH_MAX_DISTANCE", "7"))
+
+# Reputación de URLs: listas locales (un dominio por línea, también formato hosts o URLs completas)
+# que se compilan a un índice ordenado en disco (<lista>.idx) y marcas que los estafadores imitan.
+URL_BLOCKLIST_PATH = os.getenv("URL_BLOCKLIST_PATH", "dominios_bloqueados.txt")
+URL_ALLOWLIST_PATH = os.getenv("URL_ALLOWLIST_PATH", "dominios_confiables.txt")
+URL_BRAND_DOMAINS = [d.strip().lower() for d in os.getenv("URL_BRAND_DOMAINS", ",".join([
+    "bancolombia.com", "grupobancolombia.com", "transaccionesbancolombia.com", "davivienda.com", "daviplata.com", "nequi.com.co", "bancodebogota.com",
+    "bancodeoccidente.com.co", "bancopopular.com.co", "avvillas.com.co", "bbva.com.co", "scotiabankcolpatria.com",
+    "bancocajasocial.com", "bancofalabella.com.co", "itau.co", "bancoagrario.gov.co", "dian.gov.co", "registraduria.gov.co",
+    "policia.gov.co", "mintic.gov.co", "simit.org.co", "servientrega.com", "interrapidisimo.com", "coordinadora.com",
+    "4-72.com.co", "mercadolibre.com.co", "falabella.com.co", "exito.com", "rappi.com", "claro.com.co", "movistar.co",
+    "tigo.com.co", "whatsapp.com", "facebook.com", "instagram.com", "google.com", "microsoft.com", "apple.com",
+    "netflix.com", "paypal.com", "pse.com.co",
+])).split(",") if d.strip()]
+URL_TYPOSQUAT_MAX_DISTANCE = int(os.getenv("URL_TYPOSQUAT_MAX_DISTANCE", "2"))
+URL_MAX_PER_MESSAGE = int(os.getenv("URL_MAX_PER_MESSAGE", "10"))
+# Con esta confianza (dominio bloqueado o escrito casi igual al de una marca) se responde sin DeepSeek; >1 lo desactiva
+URL_SHORT_CIRCUIT_MIN_CONFIDENCE = float(os.getenv("URL_SHORT_CIRCUIT_MIN_CONFIDENCE", "0.9"))
+
+# Triage por señales de estafa (SCAM_LEXICON): desde este puntaje el resumen sale al instante y
+# DeepSeek escribe los detalles en segundo plano (>1 lo desactiva); con puntaje <= al mínimo, sin
+# enlaces y sin imagen de por medio, el mensaje se da por benigno sin llamar a DeepSeek (<0 lo desactiva).
+# Apagado por defecto: con 0, 2 de 16 estafas del corpus etiquetado de benchmark_webhook.py --senales
+# ("se me dañó el celular, escríbeme a este número", inversiones) se daban por benignas.
+SCAM_SIGNAL_FAST_REPLY_SCORE = float(os.getenv("SCAM_SIGNAL_FAST_REPLY_SCORE", "0.85"))
+SCAM_SIGNAL_BENIGN_MAX_SCORE = float(os.getenv("SCAM_SIGNAL_BENIGN_MAX_SCORE", "-1"))
+
+# Logging: JSON por línea con correlation id, escrito desde otro hilo (ver log_setup.py)
+log_handler = setup_logging()
+log = logging.getLogger("bot")
+webhook_log = logging.getLogger("bot.webhook")
+queue_log = logging.getLogger("bot.cola")
+conversation_log = logging.getLogger("bot.conversacion")
+db_log = logging.getLogger("bot.db")
+cache_log = logging.getLogger("bot.cache")
+llm_log = logging.getLogger("bot.llm")
+whatsapp_log = logging.getLogger("bot.whatsapp")
+media_log = logging.getLogger("bot.media")
+ocr_log = logging.getLogger("bot.ocr")
+url_log = logging.getLogger("bot.url")
+
+# --- Métricas (/metrics en formato de texto de Prometheus) ---
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def metrics_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class MetricStage:
+    """Histograma de duración y errores por tipo de una etapa (y modo) del turno.
+
+    Las etiquetas se arman una sola vez al crear la etapa; observe() y el timer solo suman
+    enteros, así que medir en caliente no crea dicts ni strings.
+    """
+
+    __slots__ = ("labels", "counts", "total", "count", "errors")
+
+    def __init__(self, stage: str, mode: str = ""):
+        self.labels = f'stage="{metrics_label_value(stage)}"' + (f',mode="{metrics_label_value(mode)}"' if mode else "")
+        self.counts = [0] * (len(METRICS_LATENCY_BUCKETS) + 1) # El último es +Inf
+        self.total = 0.0
+        self.count = 0
+        self.errors = Counter() # tipo de excepción -> veces
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(METRICS_LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def record_error(self, error: BaseException):
+        error_type = type(error).__name__
+        if isinstance(error, httpx.HTTPStatusError):
+            error_type = f"{error_type}_{error.response.status_code}"
+        self.errors[error_type] += 1
+
+    def time(self) -> "StageTimer":
+        return StageTimer(self)
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        buckets, running = [], 0
+        for bound, count in zip(METRICS_LATENCY_BUCKETS + (float("inf"),), self.counts):
+            running += count
+            buckets.append(("+Inf" if bound == float("inf") else repr(bound), running))
+        return buckets
+
+class StageTimer:
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: MetricStage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stage.observe(time.perf_counter() - self.started)
+        if exc is not None and not isinstance(exc, asyncio.CancelledError):
+            self.stage.record_error(exc)
+        return False
+
+class Metrics:
+    def __init__(self):
+        self.stages: dict[str, dict[str, MetricStage]] = {}
+        self.collectors = [] # Funciones que al hacer scrape devuelven [(nombre, tipo, ayuda, [(etiquetas, valor)])]
+
+    def stage(self, name: str, mode: str = "") -> MetricStage:
+        """Devuelve (creándola la primera vez) la etapa; buscarla de nuevo no reserva memoria."""
+        by_mode = self.stages.get(name)
+        if by_mode is None:
+            by_mode = self.stages[name] = {}
+        stage = by_mode.get(mode)
+        if stage is None:
+            stage = by_mode[mode] = MetricStage(name, mode)
+        return stage
+
+    def render(self) -> str:
+        lines = [
+            "# HELP bot_stage_seconds Duración de cada etapa del procesamiento de un mensaje.",
+            "# TYPE bot_stage_seconds histogram",
+        ]
+        stages = [stage for by_mode in self.stages.values() for stage in by_mode.values()]
+        for stage in stages:
+            for bound, count in stage.cumulative():
+                lines.append(f'bot_stage_seconds_bucket{{{stage.labels},le="{bound}"}} {count}')
+            lines.append(f"bot_stage_seconds_sum{{{stage.labels}}} {stage.total:.6f}")
+            lines.append(f"bot_stage_seconds_count{{{stage.labels}}} {stage.count}")
+        lines += ["# HELP bot_stage_errors_total Excepciones por etapa y tipo.", "# TYPE bot_stage_errors_total counter"]
+        for stage in stages:
+            for error_type, count in sorted(stage.errors.items()):
+                lines.append(f'bot_stage_errors_total{{{stage.labels},type="{metrics_label_value(error_type)}"}} {count}')
+        for collector in self.collectors:
+            for name, metric_type, help_text, samples in collector():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+                for labels, value in samples:
+                    label_text = ",".join(f'{key}="{metrics_label_value(item)}"' for key, item in labels.items())
+                    lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+STAGE_WEBHOOK_PARSE = metrics.stage("webhook_parse")
+STAGE_DEDUPE = metrics.stage("dedupe")
+STAGE_LOCK_WAIT = metrics.stage("lock_wait")
+STAGE_DB = metrics.stage("db")
+STAGE_WEBHOOK_QUEUE = metrics.stage("webhook_queue") # Operaciones de la cola, incluida la espera en su hilo
+STAGE_MEDIA_DOWNLOAD = metrics.stage("media_download")
+STAGE_OCR_QUEUE_WAIT = metrics.stage("ocr_queue_wait")
+STAGE_OCR = metrics.stage("ocr")
+STAGE_WHATSAPP_SEND = metrics.stage("whatsapp_send") # Cada POST a Graph (incluye reintentos)
+STAGE_URL_REPUTATION = metrics.stage("url_reputation")
+STAGE_SCAM_SCAN = metrics.stage("scam_scan")
+STAGE_WHATSAPP_DELIVERY = metrics.stage("whatsapp_delivery") # Desde send_whatsapp_message hasta la respuesta final
+
 if not all([VERIFY_TOKEN, ACCESS_TOKEN, PHONE_NUMBER_ID, DEEPSEEK_API_KEY]):
-    print("ERROR CRÍTICO: Una o más variables de entorno no están configuradas.")
+    log.critical("Una o más variables de entorno no están configuradas.")
 
 if os.name == "nt":
     tesseract_path = os.getenv("TESSERACT_CMD_PATH", r"C:\Program Files\Tesseract-OCR\tesseract.exe")
@@ -44,27 +282,65 @@ else:
 if os.path.exists(tesseract_path):
     pytesseract.pytesseract.tesseract_cmd = tesseract_path
 else:
-    print(f"ADVERTENCIA: Tesseract OCR no encontrado en {tesseract_path}.")
+    log.warning("Tesseract OCR no encontrado en %s.", tesseract_path)
 
 http_client: httpx.AsyncClient = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global http_client
-    print("Iniciando aplicación y cliente HTTP...")
-    http_client = httpx.AsyncClient(timeout=45.0)
+    log.info("Iniciando aplicación y cliente HTTP...")
+    use_http2 = HTTP2_ENABLED and importlib.util.find_spec("h2") is not None
+    if HTTP2_ENABLED and not use_http2:
+        log.warning("El paquete h2 no está instalado (httpx[http2]); se usará HTTP/1.1.")
+    http_client = httpx.AsyncClient(timeout=45.0, http2=use_http2, limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS))
+    global webhook_queue
+    if WEBHOOK_INGEST_MODE == "queue":
+        webhook_queue = WebhookQueue(WEBHOOK_QUEUE_DB)
+        await webhook_queue.run(webhook_queue.setup)
+        if WEBHOOK_SHARD_MODE == "lease":
+            await webhook_queue.refresh_leases()
+        for worker_num in range(WEBHOOK_QUEUE_WORKERS):
+            webhook_queue_workers.append(asyncio.create_task(webhook_queue_worker(worker_num)))
+        if WEBHOOK_SHARD_MODE == "lease":
+            webhook_queue_workers.append(asyncio.create_task(webhook_shard_lease_task()))
+        log.info("Cola de webhooks activa con %s workers (%s trabajos pendientes).", WEBHOOK_QUEUE_WORKERS, await webhook_queue.run(webhook_queue.pending_count))
+    elif WEBHOOK_SHARD_MODE == "lease":
+        log.warning("WEBHOOK_SHARD_MODE=lease requiere WEBHOOK_INGEST_MODE=queue; en modo inline no se garantiza el orden entre procesos.")
+    if not PROCESS_LOCAL_USER_STATE:
+        log.warning("WEB_CONCURRENCY=%s sin cola con leases: caché de perfiles desactivada y detalles de análisis dentro del turno.", WEB_CONCURRENCY)
+    image_sweeper = asyncio.create_task(image_store_sweep_task()) if IMAGE_STORE_SWEEP_SECONDS > 0 else None
     yield
-    print("Cerrando cliente HTTP y finalizando aplicación...")
+    log.info("Cerrando cliente HTTP y finalizando aplicación...")
+    for worker_task in webhook_queue_workers:
+        worker_task.cancel()
+    await asyncio.gather(*webhook_queue_workers, return_exceptions=True)
+    webhook_queue_workers.clear()
+    if image_sweeper:
+        image_sweeper.cancel()
+        await asyncio.gather(image_sweeper, return_exceptions=True)
+    if webhook_queue:
+        await webhook_queue.run(webhook_queue.release_leases)
+        webhook_queue.close()
+    await ocr_engine.stop()
+    await whatsapp_sender.stop(WHATSAPP_SEND_DRAIN_SECONDS)
     if http_client:
         await http_client.aclose()
 
 app = FastAPI(lifespan=lifespan)
 
-user_locks = defaultdict(asyncio.Lock)
 DB_NAME = "usuarios_bot.db"
 
-PROCESSED_MESSAGE_IDS_CACHE_SIZE = 1000
-processed_message_ids = deque(maxlen=PROCESSED_MESSAGE_IDS_CACHE_SIZE)
+# Métricas de lotes: cuántos mensajes trae cada POST de Meta (tamaño de lote -> número de POSTs)
+webhook_messages_per_post = Counter()
+webhook_messages_handled_total = 0
+
+# Turnos cuya intención resolvió el clasificador local vs. los que necesitaron DeepSeek
+intent_classifier_stats = Counter()
+# Lo mismo para las respuestas en los estados de espera (classify_reply_local)
+reply_classifier_stats = Counter()
+# Y para los datos del registro: "<campo>_local" / "<campo>_llm" (extract_onboarding_field)
+onboarding_extractor_stats = Counter()
 
 # --- Funciones Auxiliares ---
 def normalize_text(text: str) -> str:
@@ -76,14 +352,631 @@ def normalize_text(text: str) -> str:
     nfkd_form = unicodedata.normalize('NFKD', text)
     return "".join([c for c in nfkd_form if not unicodedata.combining(c)])
 
+# --- Extracción y reputación de URLs ---
+URL_DEFANG_PATTERN = re.compile(r"hxxp|\[\.\]|\(\.\)|\{\.\}|\[dot\]|\(dot\)|\[:\]", re.IGNORECASE)
+URL_CANDIDATE_PATTERN = re.compile(
+    r"(?:https?://|www\d?\.)[^\s<>\"'«»]+"
+    # Dominios sin esquema ("bancolombia-seguro.co/login"); la @ previa descarta correos
+    r"|(?<![@\w.-])(?:[^\W_](?:[\w-]{0,61}[^\W_])?\.)+(?:xn--[a-z0-9-]+|[^\W\d_]{2,24})(?![\w-])(?:/[^\s<>\"'«»]*)?",
+    re.IGNORECASE,
+)
+URL_TRAILING_PUNCTUATION = ".,;:!?)]}'\"»…*_"
+URL_HOST_PATTERN = re.compile(r"[a-z0-9_](?:[a-z0-9_-]*[a-z0-9_])?(?:\.[a-z0-9_](?:[a-z0-9_-]*[a-z0-9_])?)+")
+# TLD que se aceptan en dominios escritos sin http(s):// ni www. (con cualquiera, "hola.como" sería un enlace)
+URL_BARE_TLDS = {
+    "com", "co", "net", "org", "info", "biz", "io", "me", "ly", "gl", "gd", "to", "cc", "tk", "ml", "ga", "cf", "gq",
+    "xyz", "top", "site", "online", "store", "shop", "club", "live", "link", "click", "app", "dev", "page", "web",
+    "website", "space", "fun", "icu", "vip", "work", "support", "help", "cloud", "host", "lat", "mx", "ar", "pe",
+    "cl", "ec", "ve", "br", "es", "us", "uk", "ru", "cn", "in", "gov", "edu", "mil", "at", "ws", "su", "pw", "buzz",
+}
+# Sufijos de más de una etiqueta bajo los que cada cliente tiene su propio dominio registrable.
+# Es una aproximación a la Public Suffix List con lo que se ve en mensajes colombianos,
+# incluidos los hostings gratuitos donde se montan páginas falsas.
+URL_COUNTRY_SUFFIXES = {
+    "com.co", "gov.co", "edu.co", "org.co", "net.co", "mil.co", "nom.co", "co.uk", "org.uk", "gov.uk", "com.mx",
+    "gob.mx", "org.mx", "com.ar", "gob.ar", "com.br", "gov.br", "com.pe", "gob.pe", "com.ec", "gob.ec", "com.ve",
+    "gob.ve", "com.es", "com.cn", "co.in", "com.au", "co.za",
+}
+URL_FREE_HOSTING_SUFFIXES = {
+    "blogspot.com", "github.io", "gitlab.io", "web.app", "firebaseapp.com", "herokuapp.com", "netlify.app",
+    "vercel.app", "pages.dev", "workers.dev", "ngrok.io", "ngrok-free.app", "wixsite.com", "weebly.com",
+    "000webhostapp.com", "glitch.me", "azurewebsites.net", "appspot.com", "cloudfront.net", "repl.co",
+    "godaddysites.com", "webflow.io", "myshopify.com", "square.site", "sites.google.com",
+}
+URL_MULTI_LABEL_SUFFIXES = URL_COUNTRY_SUFFIXES | URL_FREE_HOSTING_SUFFIXES
+URL_SHORTENERS = {
+    "bit.ly", "tinyurl.com", "cutt.ly", "acortar.link", "t.co", "rb.gy", "is.gd", "shorturl.at", "ow.ly", "goo.gl",
+    "t.ly", "s.id", "v.gd", "tiny.cc", "bitly.com", "shorturl.ws", "wa.link", "linktr.ee",
+}
+# Palabras que acompañan a la marca en dominios falsos ("bancolombia-seguro", "nequi-verifica")
+URL_LURE_WORDS = (
+    "segur", "verific", "valid", "login", "cuenta", "acceso", "banca", "clave", "soporte", "ayuda", "premio",
+    "actualiza", "pago", "desbloque", "token", "online", "portal", "sucursal", "personas", "empresas", "secure",
+    "account", "update", "verify", "support", "bono", "subsidio", "reclam", "multa", "envio", "entrega",
+)
+# Otros dominios registrables de cada marca (inicio de sesión, correo, CDN, marcas hermanas) que llevan
+# su nombre y no son imitaciones: se revisan antes que URLReputation.impersonation
+URL_BRAND_OWNED_DOMAINS = {
+    "bancolombia.com": ["bancolombia.com.co", "bancolombia.co"],
+    "davivienda.com": ["davivienda.com.co"],
+    "mercadolibre.com.co": ["mercadolibre.com", "mercadopago.com", "mercadopago.com.co", "mercadolivre.com.br", "mlstatic.com"],
+    "falabella.com.co": ["falabella.com", "falabella.co"],
+    "claro.com.co": ["claro.com", "clarovideo.com", "claromusica.com"],
+    "movistar.co": ["movistar.com", "movistar.com.co"],
+    "tigo.com.co": ["tigo.com", "tigoune.co"],
+    "whatsapp.com": ["whatsapp.net", "wa.me"],
+    "facebook.com": ["facebookmail.com", "fb.com", "fbcdn.net", "fb.me", "messenger.com", "meta.com"],
+    "instagram.com": ["cdninstagram.com", "instagr.am"],
+    "google.com": ["google.com.co", "googlemail.com", "googleusercontent.com", "googleapis.com", "gstatic.com", "youtube.com", "youtu.be", "gmail.com"],
+    "microsoft.com": [
+        "microsoftonline.com", "microsoft365.com", "microsoftstore.com", "live.com", "outlook.com", "office.com",
+        "office365.com", "hotmail.com", "msn.com", "bing.com", "windows.com", "azure.com", "sharepoint.com", "onedrive.com",
+    ],
+    "apple.com": ["icloud.com", "apple.co", "appleid.com", "mzstatic.com", "cdn-apple.com"],
+    "netflix.com": ["netflix.net", "nflxext.com", "nflximg.net", "nflxvideo.net", "nflxso.net"],
+    "paypal.com": ["paypal.me", "paypalobjects.com", "paypal-communication.com"],
+}
+# Caracteres que se confunden a simple vista con letras latinas (dígitos, símbolos, cirílico y griego)
+URL_CONFUSABLES = str.maketrans({
+    "0": "o", "1": "l", "3": "e", "4": "a", "5": "s", "7": "t", "$": "s", "@": "a", "!": "i", "|": "l",
+    "а": "a", "е": "e", "о": "o", "р": "p", "с": "c", "у": "y", "х": "x", "і": "i", "ј": "j", "ѕ": "s",
+    "ԁ": "d", "ɡ": "g", "һ": "h", "ӏ": "l", "ո": "n", "ս": "u", "ν": "v", "ο": "o", "α": "a", "ε": "e",
+    "ι": "i", "κ": "k", "ρ": "p", "τ": "t", "υ": "u", "χ": "x", "ı": "i", "ɩ": "i", "ⅼ": "l", "-": "",
+})
+
+def extract_urls(text: str) -> list[str]:
+    """Extrae en orden y sin repetir las URLs y dominios de un texto.
+
+    Acepta enlaces "desactivados" como hxxp://sitio[.]com, que es como se suelen
+    reenviar las estafas para que WhatsApp no los abra.
+    """
+    if not text:
+        return []
+    text = URL_DEFANG_PATTERN.sub(lambda m: "http" if m.group().lower() == "hxxp" else (":" if ":" in m.group() else "."), text)
+    urls = []
+    for match in URL_CANDIDATE_PATTERN.finditer(text):
+        candidate = match.group().rstrip(URL_TRAILING_PUNCTUATION)
+        lowered = candidate.lower()
+        if not lowered.startswith(("http://", "https://", "www")):
+            tld = lowered.split("/", 1)[0].rsplit(".", 1)[-1]
+            if tld not in URL_BARE_TLDS and not tld.startswith("xn--"):
+                continue
+        if candidate not in urls:
+            urls.append(candidate)
+    return urls
+
 def extract_first_url(text: str) -> str | None:
     """Extrae la primera URL encontrada en un texto."""
-    if not text:
+    urls = extract_urls(text)
+    return urls[0] if urls else None
+
+def canonical_host(raw: str) -> str | None:
+    """Host en minúsculas y en punycode de una URL o dominio; None si no es un host válido."""
+    raw = raw.strip()
+    if raw.isascii() and not any(c in raw for c in "/:@?#[]"):
+        host = raw.lower().rstrip(".") # Camino rápido: dominio pelado (así vienen casi todas las líneas de las listas)
+    else:
+        try:
+            host = urlsplit(raw if "://" in raw[:12] else "http://" + raw).hostname
+        except ValueError:
+            return None
+        if not host:
+            return None
+        host = host.rstrip(".")
+        try:
+            return str(ipaddress.ip_address(host))
+        except ValueError:
+            pass
+        if not host.isascii():
+            try:
+                host = host.encode("idna").decode("ascii")
+            except UnicodeError:
+                return None
+    return host if URL_HOST_PATTERN.fullmatch(host) else None
+
+def is_ip_host(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+def registrable_domain(host: str) -> str:
+    """Dominio que registró el dueño del sitio: "pagos.bancolombia.com.co" -> "bancolombia.com.co"."""
+    labels = host.split(".")
+    if len(labels) > 2 and ".".join(labels[-2:]) in URL_MULTI_LABEL_SUFFIXES:
+        return ".".join(labels[-3:])
+    if len(labels) > 3 and ".".join(labels[-3:]) in URL_MULTI_LABEL_SUFFIXES:
+        return ".".join(labels[-4:])
+    return ".".join(labels[-2:])
+
+def domain_skeleton(label: str) -> str:
+    """Forma "a simple vista" de una etiqueta de dominio: sin tildes, homoglifos ni guiones."""
+    if label.startswith("xn--"):
+        try:
+            label = label.encode("ascii").decode("idna")
+        except UnicodeError:
+            pass
+    label = "".join(c for c in unicodedata.normalize("NFKD", label.lower()) if not unicodedata.combining(c))
+    return label.translate(URL_CONFUSABLES).replace("rn", "m").replace("vv", "w")
+
+def bounded_edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Distancia de edición con transposiciones de letras vecinas; corta en max_distance + 1."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    before_previous, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        before_previous, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+class DomainIndex:
+    """Conjunto ordenado de dominios compilado a un archivo que se lee con mmap.
+
+    Formato: cabecera (MAGIC + cantidad), cantidad + 1 desplazamientos uint32 y los
+    dominios concatenados en orden. Abrirlo no copia nada a memoria (una lista de
+    millones de dominios carga en milisegundos) y cada búsqueda es binaria sobre el
+    archivo. Los enteros van en el orden nativo: el índice se compila en la misma
+    máquina que lo usa, al arrancar, cuando falta o es más viejo que la lista.
+    """
+
+    MAGIC = b"DOMIDX1\n"
+    HEADER = struct.Struct("=8sI")
+
+    def __init__(self, source_path: str):
+        self.source_path = source_path
+        self.index_path = source_path + ".idx"
+        self.count = 0
+        self.data = None
+        self.offsets = None
+        self.base = 0
+
+    def load(self):
+        if os.path.exists(self.source_path) and (
+            not os.path.exists(self.index_path) or os.path.getmtime(self.index_path) < os.path.getmtime(self.source_path)
+        ):
+            started = time.perf_counter()
+            count = self.build(self.source_path, self.index_path)
+            url_log.info("Índice %s compilado: %s dominios en %.2f s.", self.index_path, count, time.perf_counter() - started)
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = self.HEADER.unpack_from(data, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{self.index_path} no es un índice de dominios")
+        self.base = self.HEADER.size + 4 * (count + 1)
+        self.offsets = memoryview(data)[self.HEADER.size:self.base].cast("I")
+        self.data, self.count = data, count
+
+    @classmethod
+    def build(cls, source_path: str, index_path: str) -> int:
+        domains = set()
+        with open(source_path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                fields = line.split("#", 1)[0].split()
+                if fields:
+                    host = canonical_host(fields[-1]) # Formato hosts: "0.0.0.0 dominio"
+                    if host:
+                        domains.add(host.encode("ascii"))
+        ordered = sorted(domains)
+        offsets = array("I", [0])
+        position = 0
+        for domain in ordered:
+            position += len(domain)
+            offsets.append(position)
+        temp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(ordered)))
+            offsets.tofile(f)
+            f.write(b"".join(ordered))
+        os.replace(temp_path, index_path)
+        return len(ordered)
+
+    def __contains__(self, host: str) -> bool:
+        key = host.encode("ascii")
+        data, offsets, base = self.data, self.offsets, self.base
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) >> 1
+            item = data[base + offsets[middle]:base + offsets[middle + 1]]
+            if item < key:
+                low = middle + 1
+            elif item > key:
+                high = middle
+            else:
+                return True
+        return False
+
+    def match(self, host: str) -> str | None:
+        """El dominio de la lista que cubre a host: él mismo o uno de sus dominios padre."""
+        if not self.count:
+            return None
+        labels = host.split(".")
+        for i in range(len(labels) - 1):
+            candidate = ".".join(labels[i:])
+            if candidate in self:
+                return candidate
         return None
-    # Expresión regular mejorada para URLs
-    url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-    match = re.search(url_pattern, text)
-    return match.group(0) if match else None
+
+class URLVerdict:
+    __slots__ = ("url", "host", "domain", "verdict", "reason", "confidence", "conclusive")
+
+    def __init__(self, url: str, host: str, domain: str, verdict: str, reason: str, confidence: float, conclusive: bool = False):
+        self.url = url
+        self.host = host
+        self.domain = domain
+        self.verdict = verdict # bloqueado, imitacion, sospechoso, acortador, oficial o desconocido
+        self.reason = reason # Frase que completa "el enlace <host> ..."
+        self.confidence = confidence
+        # Solo la lista de bloqueo y los parecidos letra por letra bastan para responder sin DeepSeek;
+        # la marca metida en otro dominio o con otra terminación también la usan dominios legítimos
+        self.conclusive = conclusive
+
+class URLReputation:
+    """Veredicto local de cada enlace antes de gastar una llamada a DeepSeek.
+
+    Consulta la lista de bloqueo, la de confianza y las marcas de URL_BRAND_DOMAINS:
+    un dominio que no es de la marca pero se le parece (letras cambiadas, homoglifos,
+    la marca con "-seguro" o en un hosting gratuito) se marca como imitación, salvo
+    que sea uno de los otros dominios de la marca (URL_BRAND_OWNED_DOMAINS).
+    """
+
+    def __init__(self, blocklist_path: str, allowlist_path: str, brand_domains: list[str]):
+        self.blocklist = DomainIndex(blocklist_path)
+        self.allowlist = DomainIndex(allowlist_path)
+        self.official = {registrable_domain(domain) for domain in brand_domains}
+        # (dominio, etiqueta registrada, esqueleto): "nequi.com.co" -> "nequi"
+        self.brands = [(domain, domain.split(".")[0], domain_skeleton(domain.split(".")[0])) for domain in sorted(self.official)]
+        self.owned = {
+            registrable_domain(owned): registrable_domain(brand)
+            for brand, owned_domains in URL_BRAND_OWNED_DOMAINS.items() for owned in owned_domains
+        }
+        self.stats = Counter()
+
+    def load(self):
+        for index in (self.blocklist, self.allowlist):
+            try:
+                index.load()
+            except (OSError, ValueError) as e:
+                url_log.error("No se pudo cargar la lista de dominios %s: %s", index.source_path, e)
+
+    def impersonation(self, host: str, domain: str) -> tuple[str, float, bool] | None:
+        """(motivo, confianza, concluyente) si el host imita a una de las marcas protegidas."""
+        core = domain.split(".")[0]
+        core_skeleton = domain_skeleton(core)
+        tokens = {domain_skeleton(token) for label in host.split(".")[:-1] for token in label.split("-") if token}
+        lure = any(word in host for word in URL_LURE_WORDS)
+        best = None
+        for brand_domain, brand_core, brand_skeleton in self.brands:
+            candidate = None
+            if core_skeleton == brand_skeleton:
+                if core != brand_core:
+                    candidate = (f"cambia letras por otras parecidas para hacerse pasar por {brand_domain}", 0.97, True)
+                else:
+                    # Misma marca con otra terminación: puede ser un dominio legítimo que no está en la lista,
+                    # salvo en un hosting gratuito, donde cualquiera publica una página con ese nombre
+                    hosted = domain.split(".", 1)[-1] in URL_FREE_HOSTING_SUFFIXES
+                    candidate = (f"usa el nombre de {brand_domain} pero no es ese dominio", 0.85 if hosted else 0.7, False)
+            elif len(brand_skeleton) >= 4 and brand_skeleton in tokens:
+                candidate = (f"mete el nombre de {brand_domain} en un dominio que no es de esa entidad",
+                             0.85 if lure else 0.8 if len(brand_skeleton) >= 7 else 0.7, False)
+            elif len(brand_skeleton) >= 7 and brand_skeleton in core_skeleton:
+                candidate = (f"mete el nombre de {brand_domain} en un dominio que no es de esa entidad", 0.8 if lure else 0.7, False)
+            elif len(brand_skeleton) >= 5:
+                distance = bounded_edit_distance(core_skeleton, brand_skeleton, URL_TYPOSQUAT_MAX_DISTANCE)
+                if distance == 1:
+                    candidate = (f"se escribe casi igual que {brand_domain}", 0.93 if len(brand_skeleton) >= 7 else 0.85, True)
+                elif distance == 2 <= URL_TYPOSQUAT_MAX_DISTANCE:
+                    candidate = (f"se escribe casi igual que {brand_domain}", 0.9 if len(brand_skeleton) >= 9 else 0.8, True)
+            if candidate and (best is None or candidate[1] > best[1]):
+                best = candidate
+        return best
+
+    def check(self, url: str) -> URLVerdict | None:
+        host = canonical_host(url)
+        if host is None:
+            return None
+        if is_ip_host(host):
+            return URLVerdict(url, host, host, "sospechoso", "apunta a una dirección IP en lugar de a un dominio", 0.7)
+        domain = registrable_domain(host)
+        blocked = self.blocklist.match(host)
+        if blocked:
+            return URLVerdict(url, host, domain, "bloqueado", f"está en la lista de sitios peligrosos ({blocked})", 0.99, True)
+        if "@" in url.split("//", 1)[-1].split("/", 1)[0]:
+            return URLVerdict(url, host, domain, "sospechoso", f"esconde su destino real ({host}) detrás de una @", 0.8)
+        if domain in self.official:
+            return URLVerdict(url, host, domain, "oficial", f"es un dominio oficial ({domain})", 0.9)
+        if domain in self.owned:
+            return URLVerdict(url, host, domain, "oficial", f"es un dominio de {self.owned[domain]} ({domain})", 0.9)
+        if self.allowlist.match(host):
+            return URLVerdict(url, host, domain, "oficial", "está en la lista de dominios confiables", 0.9)
+        impersonation = self.impersonation(host, domain)
+        if impersonation:
+            return URLVerdict(url, host, domain, "imitacion", *impersonation)
+        if domain in URL_SHORTENERS or host in URL_SHORTENERS:
+            return URLVerdict(url, host, domain, "acortador", "es un acortador de enlaces que oculta el destino real", 0.5)
+        if "xn--" in host:
+            return URLVerdict(url, host, domain, "sospechoso", "usa letras de otros alfabetos (punycode)", 0.6)
+        return URLVerdict(url, host, domain, "desconocido", "no aparece en las listas locales", 0.0)
+
+    def check_text(self, text: str) -> list[URLVerdict]:
+        with STAGE_URL_REPUTATION.time():
+            verdicts = [verdict for verdict in map(self.check, extract_urls(text)[:URL_MAX_PER_MESSAGE]) if verdict]
+        for verdict in verdicts:
+            self.stats[verdict.verdict] += 1
+        return verdicts
+
+def url_hints_for_prompt(verdicts: list[URLVerdict]) -> str:
+    """Resultado de la revisión local de enlaces, como pista para el análisis de DeepSeek."""
+    if not verdicts:
+        return ""
+    lines = "\n".join(f"- {v.host}: {v.reason} (confianza {v.confidence:.2f})" for v in verdicts)
+    return f"\n\nRevisión automática de los enlaces del mensaje (úsala como pista, no la cites):\n{lines}"
+
+def build_url_verdict_analysis(verdict: URLVerdict, nombre_usuario: str) -> str:
+    """Análisis de phishing armado sin DeepSeek para un enlace bloqueado o una imitación clara.
+
+    Tiene el mismo formato que la respuesta del modelo (resumen, separador y detalles
+    que terminan en la pregunta de si hizo clic) para seguir el mismo flujo de conversación.
+    """
+    return (
+        f"*Resumen Breve*:\n⚠️ {nombre_usuario}, este mensaje parece una estafa: el enlace {verdict.host} {verdict.reason}. "
+        "No lo abras ni compartas datos, claves o códigos.\n"
+        f"{PHISHING_DETAILS_SEPARATOR}\n"
+        "🔍 *Análisis del mensaje recibido*\n"
+        "✅ *Resultado*: Sí, parece una estafa\n"
+        "⚠️ *Tipo de estafa*: Phishing (suplantación de identidad)\n"
+        f"📌 *Mi opinión detallada*: El enlace lleva a {verdict.host}, que {verdict.reason}. Los estafadores copian el nombre "
+        "y la apariencia de bancos y entidades para que escribas tus datos en una página falsa.\n"
+        "🧠 *¿Cómo suelen funcionar estos engaños?* Te escriben con urgencia (cuenta bloqueada, premio, multa o paquete "
+        "retenido) para que entres al enlace sin pensarlo, y ahí te piden usuario, clave o códigos.\n"
+        f"🛡️ *Mis recomendaciones para ti, {nombre_usuario}*: No abras el enlace. Si tienes dudas, entra escribiendo tú "
+        "mismo la dirección oficial o llama a la línea que aparece en tu tarjeta. Borra el mensaje y bloquea al remitente.\n\n"
+        f"{nombre_usuario}, ¿llegaste a hacer clic en el enlace, descargaste algo o compartiste información? "
+        "Responde sí o no, o escribe AYUDA si necesitas los pasos a seguir."
+    )
+
+url_reputation = URLReputation(URL_BLOCKLIST_PATH, URL_ALLOWLIST_PATH, URL_BRAND_DOMAINS)
+url_reputation.load()
+url_log.info(
+    "Reputación de URLs: %s dominios bloqueados, %s confiables y %s marcas protegidas.",
+    url_reputation.blocklist.count, url_reputation.allowlist.count, len(url_reputation.brands),
+)
+
+# --- Señales de estafa (pre-análisis local) ---
+SCAM_LEXICON_VERSION = "2026.10.1" # Subir al cambiar frases o pesos: queda en los logs y en /metrics
+# Categoría -> (peso, frases). Las frases se comparan contra el texto sin tildes ni signos y como
+# palabras completas; un * final acepta cualquier terminación de la última palabra.
+# Cada categoría cuenta una sola vez y los pesos se combinan como probabilidades independientes.
+SCAM_LEXICON = {
+    "cuenta_bloqueada": (0.55, [
+        "cuenta ha sido bloquead*", "cuenta bloquead*", "cuenta suspendid*", "ha sido bloquead*", "ha sido suspendid*",
+        "sera bloquead*", "sera suspendid*", "sera cancelad*", "fue bloquead*", "fue suspendid*", "cuenta inhabilitad*",
+        "desbloquear su cuenta", "desbloquea tu cuenta", "para desbloquear*", "reactivar su cuenta", "reactiva tu cuenta",
+        "acceso restringid*", "actividad inusual", "movimiento inusual", "movimientos inusuales", "actividad sospechosa",
+        "compra no reconocida", "transaccion no reconocida", "intento de acceso",
+    ]),
+    "pedido_de_datos": (0.5, [
+        "actualice sus datos", "actualiza tus datos", "actualizar sus datos", "actualizar tus datos", "verifique sus datos",
+        "verifica tus datos", "verificar sus datos", "confirme sus datos", "confirma tus datos", "ingrese sus datos",
+        "ingresa tus datos", "valide sus datos", "valida tus datos", "valide su identidad", "numero de cedula",
+        "numero de tarjeta", "datos de la tarjeta", "datos de su tarjeta", "datos de tu tarjeta", "fecha de vencimiento",
+        "codigo de seguridad", "cvv", "usuario y clave", "usuario y contrasena", "datos personales",
+    ]),
+    "codigo_o_clave": (0.55, [
+        "codigo que le llego", "codigo que te llego", "codigo que le llegara", "codigo que te llegara",
+        "codigo de verificacion", "codigo de 6 digitos", "envieme el codigo", "enviame el codigo", "envie el codigo",
+        "reenvie el codigo", "reenviame el codigo", "dicte el codigo", "dictame el codigo", "comparta el codigo",
+        "clave dinamica", "clave temporal", "su clave", "tu clave", "su contrasena", "tu contrasena",
+    ]),
+    "menciona_claves": (0.15, ["clave", "contrasena", "token", "pin", "otp", "codigo"]),
+    "pedido_de_dinero": (0.45, [
+        "consigne*", "consignes", "consignar*", "consignacion", "transfiera", "transfieras", "transferir", "envie dinero",
+        "enviar dinero", "envie plata", "mande plata", "deposite", "depositar", "haga una recarga", "realice el pago",
+        "realizar el pago", "pague*", "pagar*", "cancele el valor", "cancelar el valor", "le consignara", "prestame",
+        "me prestas", "necesito plata", "necesito dinero",
+    ]),
+    "pago_anticipado": (0.5, [
+        "por concepto de impuesto*", "pago de impuesto*", "pagar el impuesto", "pagar los impuestos", "costo de envio",
+        "gastos de envio", "valor del envio", "de reenvio", "tarifa de liberacion", "para reclamar*", "para liberar*",
+        "para activar*", "envie el comprobante", "enviar el comprobante", "envia el comprobante",
+    ]),
+    "billetera_o_banco": (0.15, [
+        "nequi", "daviplata", "bancolombia", "davivienda", "banco de bogota", "bbva", "colpatria", "av villas",
+        "banco agrario", "movii", "pse", "cuenta de ahorros",
+    ]),
+    "urgencia": (0.3, [
+        "urgente", "urgencia", "inmediatamente", "de inmediato", "antes de 24 horas", "en las proximas 24 horas",
+        "en las proximas horas", "24 horas", "48 horas", "hoy mismo", "ultimo aviso", "ultima oportunidad",
+        "de lo contrario", "perdera", "perdera el acceso", "sera devuelt*", "evite embargo*", "evite sanciones",
+        "evite el bloqueo", "plazo maximo", "solo por hoy", "tiempo limitado",
+    ]),
+    "premio_o_beneficio": (0.5, [
+        "felicitaciones", "felicidades", "ha sido seleccionad*", "fue seleccionad*", "ganador*", "gano un*", "ha ganado",
+        "has ganado", "premio", "sorteo", "bono de", "bono por", "subsidio", "ingreso solidario", "devolucion del iva",
+        "reclame*", "reclama tu", "beneficiario", "regalo",
+    ]),
+    "multa_o_deuda": (0.4, [
+        "multa pendiente", "tiene una multa", "comparendo*", "embargo*", "proceso juridico", "cobro juridico",
+        "deuda pendiente", "orden de captura", "citacion judicial", "demanda en su contra", "reporte en datacredito",
+        "centrales de riesgo",
+    ]),
+    "paquete_retenido": (0.45, [
+        "paquete no pudo ser entregado", "no pudo ser entregado", "su paquete", "tu paquete", "paquete retenido",
+        "envio retenido", "esta retenido", "direccion incompleta", "pendiente de entrega", "intento de entrega",
+    ]),
+    "familiar_en_apuros": (0.45, [
+        "mi numero nuevo", "mi nuevo numero", "este es mi numero", "cambie de numero", "cambie de celular",
+        "soy tu hijo", "soy tu hija", "era mi hijo", "era mi hija", "estoy en problemas", "tuve un accidente",
+        "no le digas a nadie", "hola mami", "hola papi",
+    ]),
+    "remitente_desconocido": (0.2, ["numero desconocido", "un desconocido", "no conozco el numero", "me escribieron de"]),
+    "enlace_acortado": (0.35, [
+        "bit ly", "tinyurl com", "cutt ly", "acortar link", "rb gy", "is gd", "shorturl at", "ow ly", "t ly",
+    ]),
+    "enlace_o_ingreso": (0.2, [
+        "ingrese a", "ingresa a", "ingrese al", "ingresa al", "siguiente enlace", "siguiente link", "clic aqui",
+        "click aqui", "haga clic", "haz clic", "de clic", "da clic", "link", "enlace",
+    ]),
+    "inversion_o_empleo": (0.45, [
+        "trabajo desde casa", "gana dinero", "ganar dinero", "ganancias diarias", "ingresos extra", "inversion segura",
+        "duplica tu dinero", "duplicar su dinero", "rentabilidad garantizada", "criptomoneda*", "bitcoin", "forex",
+        "dar like", "tareas pagadas", "sin experiencia",
+    ]),
+    "soporte_falso": (0.4, [
+        "soporte tecnico", "area de seguridad", "departamento de fraude*", "departamento de seguridad",
+        "asesor del banco", "funcionario del banco", "instale la aplicacion", "descargue la aplicacion", "anydesk",
+        "teamviewer", "acceso remoto", "apk",
+    ]),
+}
+SCAM_NON_WORD_PATTERN = re.compile(r"[\W_]+")
+
+def scam_scan_text(text: str) -> str:
+    """Texto como lo recorre el escáner: sin tildes, solo letras y dígitos, y un espacio en cada borde.
+
+    Equivale a normalize_text más quitar signos, pero todo en C (encode con "ignore" descarta
+    las tildes que deja NFKD): con normalize_text el paso previo costaba más que el escaneo.
+    """
+    words = SCAM_NON_WORD_PATTERN.sub(" ", text.lower())
+    return f" {unicodedata.normalize('NFKD', words).encode('ascii', 'ignore').decode('ascii').strip()} "
+
+class ScamScan:
+    __slots__ = ("score", "signals")
+
+    def __init__(self, score: float, signals: list[tuple[str, str]]):
+        self.score = score # 0 a 1
+        self.signals = signals # (categoría, frase), de la categoría más pesada a la más liviana
+
+class ScamSignalScanner:
+    """Busca todas las frases de SCAM_LEXICON en una sola pasada (autómata de Aho-Corasick).
+
+    Los enlaces de fallo se resuelven al construirlo: cada estado guarda todas sus transiciones,
+    así que el recorrido es una consulta a un diccionario por carácter (unos 800 KiB con el
+    léxico actual).
+    """
+
+    def __init__(self, lexicon: dict[str, tuple[float, list[str]]], version: str):
+        self.version = version
+        self.weights = {category: weight for category, (weight, _) in lexicon.items()}
+        self.patterns = [] # (categoría, frase)
+        goto = [{}]
+        terminal = {}
+        for category, (_, phrases) in lexicon.items():
+            for phrase in phrases:
+                prefix_only = phrase.endswith("*")
+                key = scam_scan_text(phrase.rstrip("*"))
+                if prefix_only:
+                    key = key[:-1]
+                state = 0
+                for char in key:
+                    if char not in goto[state]:
+                        goto.append({})
+                        goto[state][char] = len(goto) - 1
+                    state = goto[state][char]
+                terminal.setdefault(state, []).append(len(self.patterns))
+                self.patterns.append((category, phrase.rstrip("*")))
+        # Enlaces de fallo en orden de profundidad; transitions[s] = las de su fallo más su goto
+        self.transitions = [goto[0]] + [None] * (len(goto) - 1)
+        self.outputs = [None] * len(goto) # Estado -> índices de los patrones que terminan ahí
+        fail = [0] * len(goto)
+        pending = deque(goto[0].values())
+        while pending:
+            state = pending.popleft()
+            inherited = self.transitions[fail[state]]
+            self.transitions[state] = {**inherited, **goto[state]}
+            matches = terminal.get(state, []) + (self.outputs[fail[state]] or [])
+            self.outputs[state] = matches or None
+            for char, child in goto[state].items():
+                fail[child] = inherited.get(char, 0)
+                pending.append(child)
+        self.stats = Counter()
+
+    def scan(self, text: str) -> ScamScan:
+        with STAGE_SCAM_SCAN.time():
+            transitions, outputs = self.transitions, self.outputs
+            state = 0
+            found = set()
+            for char in scam_scan_text(text):
+                state = transitions[state].get(char, 0)
+                if outputs[state]:
+                    found.update(outputs[state])
+            strongest = {}
+            for index in found:
+                category, phrase = self.patterns[index]
+                if category not in strongest or len(phrase) > len(strongest[category]):
+                    strongest[category] = phrase
+            benign_probability = 1.0
+            for category in strongest:
+                benign_probability *= 1.0 - self.weights[category]
+            signals = sorted(strongest.items(), key=lambda item: -self.weights[item[0]])
+        self.stats["scanned"] += 1
+        return ScamScan(round(1.0 - benign_probability, 3), signals)
+
+def scam_hints_for_prompt(scan: ScamScan) -> str:
+    """Señales encontradas por el escáner local, como pista para el análisis de DeepSeek."""
+    if not scan.signals:
+        return ""
+    signals = ", ".join(f'{category.replace("_", " ")} ("{phrase}")' for category, phrase in scan.signals)
+    return f"\n\nSeñales de estafa encontradas por el filtro automático (puntaje {scan.score:.2f} de 1): {signals}"
+
+def build_scam_signal_analysis(scan: ScamScan, nombre_usuario: str) -> str:
+    """Análisis armado con las señales encontradas, en el formato de la respuesta de DeepSeek.
+
+    El resumen se envía al instante; los detalles solo se usan si DeepSeek no logra escribir
+    los suyos (ver analyze_phishing_details).
+    """
+    signals = ", ".join(category.replace("_", " ") for category, _ in scan.signals[:4])
+    phrases = "; ".join(f'"{phrase}"' for _, phrase in scan.signals[:6])
+    return (
+        f"*Resumen Breve*:\n⚠️ {nombre_usuario}, este mensaje tiene las señales típicas de una estafa ({signals}). "
+        "No respondas, no abras enlaces y no compartas datos, claves ni códigos.\n"
+        f"{PHISHING_DETAILS_SEPARATOR}\n"
+        "🔍 *Análisis del mensaje recibido*\n"
+        "✅ *Resultado*: Sí, parece una estafa\n"
+        "⚠️ *Tipo de estafa*: Phishing / smishing (engaño por mensaje)\n"
+        f"📌 *Mi opinión detallada*: El mensaje junta varias frases que se repiten en las estafas: {phrases}. "
+        "Ninguna entidad seria te pide datos, códigos o pagos por este medio y con afán.\n"
+        "🧠 *¿Cómo suelen funcionar estos engaños?* Te asustan o te ilusionan (bloqueos, multas, premios, paquetes, un "
+        "familiar en apuros) para que actúes rápido y entregues dinero, claves o el código que te llega por SMS.\n"
+        f"🛡️ *Mis recomendaciones para ti, {nombre_usuario}*: No respondas ni entres a enlaces. Si tienes dudas, "
+        "comunícate tú mismo con la entidad o la persona por sus canales de siempre. Bloquea y reporta el número.\n\n"
+        f"{nombre_usuario}, ¿llegaste a hacer clic en algún enlace de ese mensaje, descargaste algo o compartiste "
+        "información? Responde sí o no, o escribe AYUDA si necesitas los pasos a seguir."
+    )
+
+async def analyze_phishing_details(message_text: str, user_profile: dict, hints: str, local_analysis: str) -> tuple[str, bool]:
+    """(análisis, vino de DeepSeek) para un resumen ya enviado; si DeepSeek no lo entrega completo, el análisis local."""
+    analisis = await analyze_with_deepseek(message_text, "phishing", user_profile, hints)
+    if analisis and PHISHING_DETAILS_SEPARATOR in analisis:
+        return analisis, True
+    return local_analysis, False
+
+def build_benign_scan_analysis(nombre_usuario: str) -> str:
+    """Análisis sin DeepSeek para un texto sin ninguna señal de estafa ni enlaces."""
+    return (
+        f"*Resumen Breve*:\n{nombre_usuario}, en principio este mensaje no parece una estafa: no encontré enlaces, "
+        "pedidos de dinero, claves o códigos, urgencias ni premios.\n"
+        f"{PHISHING_DETAILS_SEPARATOR}\n"
+        "🔍 *Análisis del mensaje recibido*\n"
+        "✅ *Resultado*: No, no parece una estafa\n"
+        "⚠️ *Tipo de estafa*: No aplica\n"
+        "📌 *Mi opinión detallada*: El mensaje no trae ninguna de las señales con las que suelen llegar los engaños: "
+        "enlaces para ingresar datos, pedidos de consignar o transferir, códigos que te llegan por SMS, premios, multas "
+        "o mensajes de urgencia.\n"
+        f"🛡️ *Mis recomendaciones para ti, {nombre_usuario}*: Si más adelante esa misma persona te pide dinero, claves, "
+        "códigos o que entres a un enlace, detente y verifica por otro medio antes de hacer cualquier cosa.\n\n"
+        f"¡Sigue así de alerta, {nombre_usuario}! Recuerda siempre desconfiar y verificar. 👍"
+    )
+
+scam_signal_scanner = ScamSignalScanner(SCAM_LEXICON, SCAM_LEXICON_VERSION)
+log.info("Léxico de señales de estafa %s: %s frases en %s categorías.", SCAM_LEXICON_VERSION, len(scam_signal_scanner.patterns), len(SCAM_LEXICON))
 
 SECURITY_TIPS = [
     "🛡️ Usa contraseñas únicas y fuertes para cada una de tus cuentas importantes. ¡Un gestor de contraseñas puede ayudarte mucho!",
@@ -102,20 +995,474 @@ def get_security_tip() -> str:
     """Devuelve un consejo de seguridad al azar."""
     return random.choice(SECURITY_TIPS)
 
+# --- Clasificador local de intención ---
+# Reglas deterministas sobre normalize_text para los casos obvios; lo demás va al LLM.
+INTENT_GREETING_TOKENS = {
+    "hola", "holi", "buenas", "buenos", "buen", "dias", "tardes", "noches", "gracias", "muchas",
+    "mil", "ok", "okay", "oki", "vale", "listo", "de", "nada", "chao", "adios", "saludos", "bien",
+    "perfecto", "genial", "entendido", "dale", "que", "tal", "hey", "bendiciones", "igualmente",
+}
+INTENT_GREETING_CORE = {
+    "hola", "holi", "buenas", "buenos", "gracias", "ok", "okay", "oki", "vale", "listo", "nada", "chao",
+    "adios", "saludos", "perfecto", "genial", "entendido", "dale", "hey", "bendiciones", "igualmente",
+}
+INTENT_TIP_PATTERN = re.compile(r"\b(consejos?|tips?|recomendacion(es)?|sugerencias?)\b")
+INTENT_TIP_REQUEST_PATTERN = re.compile(r"\b(dame|da|regalame|quiero|necesito|tienes|tiene|envia|enviame|manda|mandame|un|otro|algun)\b")
+INTENT_RESET_PATTERN = re.compile(r"\b(menu principal|volver al (inicio|menu)|empezar de cero|reiniciar)\b")
+INTENT_META_PATTERN = re.compile(
+    r"(que haces|para que sirves|como funcionas|quien eres|que eres|que puedes hacer|como te uso|como funciona (el|este) bot"
+    r"|(puedo|se puede|puedes) (enviar|mandar|recibir|analizar|leer)(te)? (una |un )?(imagen|imagenes|foto|fotos|captura|audio|audios)"
+    r"|(entiendes|procesas|escuchas) (los |un )?audios?)"
+)
+INTENT_QUESTION_START_PATTERN = re.compile(
+    r"^(que (es|son|significa|hago|debo)|como (puedo|evito|me protejo|protejo|se|reconozco|identifico|hago|saber|denuncio|reporto)"
+    r"|es (seguro|peligroso|normal|verdad)|por que|cual(es)? (es|son)|cuando|donde|debo|se puede|pueden)\b"
+)
+INTENT_SECURITY_LEXICON = {
+    "phishing": 2.0, "smishing": 2.0, "vishing": 2.0, "estafa": 1.5, "estafas": 1.5, "fraude": 1.5,
+    "fraudes": 1.5, "hacker": 1.5, "hackear": 1.5, "hackearon": 1.5, "hackeo": 1.5, "virus": 1.5,
+    "malware": 2.0, "contrasena": 1.5, "contrasenas": 1.5, "clave": 1.0, "claves": 1.0, "2fa": 2.0,
+    "verificacion": 1.0, "seguridad": 1.0, "ciberseguridad": 2.0, "wifi": 1.0, "antivirus": 2.0,
+    "suplantacion": 1.5, "robo": 1.0, "robaron": 1.0, "datos": 0.5, "cuenta": 0.5, "enlace": 0.5,
+    "link": 0.5, "proteger": 1.0, "protegerme": 1.0, "proteccion": 1.0, "bloquear": 0.5, "denunciar": 1.0,
+}
+INTENT_SCAM_MARKERS = {
+    "cuenta": 1.0, "bloqueada": 2.0, "bloqueado": 2.0, "suspendida": 2.0, "premio": 2.0, "ganador": 2.0,
+    "ganaste": 2.0, "felicitaciones": 1.5, "urgente": 1.5, "inmediatamente": 1.5, "verifique": 2.0,
+    "verificar": 1.0, "ingrese": 1.5, "ingresa": 1.5, "clic": 1.5, "click": 1.5, "enlace": 1.0, "link": 1.0,
+    "codigo": 1.5, "transferencia": 1.5, "consignar": 2.0, "consigne": 2.0, "nequi": 1.0, "daviplata": 1.0,
+    "bancolombia": 1.0, "banco": 1.0, "tarjeta": 1.0, "datos": 1.0, "subsidio": 1.5, "dian": 1.0,
+    "multa": 1.5, "comparendo": 1.5, "paquete": 1.0, "entrega": 1.0, "estimado": 1.5, "estimada": 1.5,
+    "cliente": 1.0, "usuario": 0.5, "pago": 1.0, "reembolso": 1.5, "sms": 1.0, "mensaje": 0.5,
+}
+
+def classify_intent_local(text: str) -> tuple[str, float]:
+    """Clasifica la intención sin LLM. Devuelve (intención, confianza entre 0 y 1)."""
+    normalized = normalize_text(text)
+    if not normalized:
+        return "irrelevante", 0.0
+    if extract_first_url(text):
+        # Un enlace casi siempre viene para que lo revisemos, aunque venga con una pregunta.
+        return "analizar", 0.95
+
+    words = re.findall(r"[a-z0-9ñ]+", normalized)
+    is_question = "?" in text or "¿" in text or bool(INTENT_QUESTION_START_PATTERN.match(normalized))
+
+    if words and len(words) <= 6 and all(w in INTENT_GREETING_TOKENS for w in words) and \
+            any(w in INTENT_GREETING_CORE for w in words):
+        return "saludo", 0.97
+    if not words: # Solo emojis o signos
+        return "saludo", 0.6
+    if INTENT_RESET_PATTERN.search(normalized) and len(words) <= 8:
+        return "comando_reset", 0.9
+    if INTENT_META_PATTERN.search(normalized) and len(words) <= 15:
+        return "meta_pregunta", 0.9
+    if INTENT_TIP_PATTERN.search(normalized) and len(words) <= 12 and \
+            (INTENT_TIP_REQUEST_PATTERN.search(normalized) or len(words) <= 2):
+        return "solicitar_tip_seguridad", 0.92
+
+    scam_score = sum(INTENT_SCAM_MARKERS.get(w, 0.0) for w in words)
+    security_score = sum(INTENT_SECURITY_LEXICON.get(w, 0.0) for w in words)
+    has_digits = any(w.isdigit() and len(w) >= 4 for w in words)
+
+    # Mensajes largos reenviados (SMS, correos) con marcas típicas de estafa
+    if len(words) >= 20 and not is_question and (scam_score >= 3.0 or (scam_score >= 1.5 and has_digits)):
+        return "analizar", 0.9
+    if is_question and security_score >= 1.5 and len(words) <= 40 and scam_score < 4.0:
+        return "pregunta_seguridad", 0.88
+
+    # Léxico con puntaje: confianza según la ventaja sobre la segunda opción
+    scores = {"analizar": scam_score + (1.0 if has_digits else 0.0), "pregunta_seguridad": security_score + (1.0 if is_question else 0.0)}
+    best_label = max(scores, key=scores.get)
+    best, other = scores[best_label], min(scores.values())
+    if best == 0:
+        return "irrelevante", 0.3
+    return best_label, round(min(0.8, best / (best + other + 2.0)), 3)
+
+# --- Respuestas cortas en los estados de espera (sí / no / ayuda) ---
+# Mismas etiquetas que devuelven los prompts decision_ver_detalles y decision_post_phishing_interaction.
+# Las palabras se comparan sin tildes y con letras repetidas colapsadas ("siii", "noo", "ayudaaa").
+REPLY_WORD_CLASSES = {
+    "ayuda": {"ayuda", "ayudame", "ayudeme", "ayudenme", "ayudar", "ayudarme", "auxilio", "socorro", "help", "sos"},
+    "no": {"no", "nop", "nope", "nel", "negativo", "nunca", "jamas", "tampoco", "nada", "ninguno", "ninguna"},
+    "si": {"si", "sip", "sep", "simon", "claro", "obvio", "afirmativo", "correcto", "exacto", "efectivamente", "yes", "aja"},
+    "acuerdo": {"ok", "okay", "oki", "okey", "dale", "bueno", "vale", "listo", "va", "perfecto", "acuerdo"},
+    "mas": {
+        "mas", "detalles", "detalle", "informacion", "info", "explicame", "expliqueme", "explica", "cuentame",
+        "cuenteme", "mandamelos", "mandalos", "mandelos", "enviamelos", "envialos", "muestrame", "ver", "saber",
+        "recomendaciones", "analisis", "completo",
+    },
+    "comentario": {
+        "gracias", "agradezco", "entendido", "entiendo", "comprendo", "genial", "excelente", "chevere", "super",
+        "peligroso", "peligrosa", "horrible", "increible", "uy", "uf", "jaja", "jajaja", "estafa", "cuidado", "bien",
+        "entendi", "vi", "miedo", "horror",
+    },
+    # Lo que hizo con el mensaje: junto a un sí o un no solo lo confirma; solo ("ya di mis datos") lo decide DeepSeek
+    "accion": {
+        "abri", "clic", "click", "di", "toque", "entre", "respondi", "conteste", "comparti", "descargue", "instale",
+        "datos", "clave", "escribi", "puse", "mande", "envie", "pague", "consigne", "transferi", "codigo",
+    },
+    "relleno": {
+        "pues", "por", "favor", "porfa", "porfavor", "ya", "eh", "ah", "mm", "hm", "este", "la", "el", "los", "las",
+        "lo", "le", "me", "mi", "mis", "yo", "te", "que", "de", "a", "y", "o", "con", "en", "un", "una", "para", "senor",
+        "senora", "amigo", "amiga", "creo", "hice", "quiero", "quisiera", "gustaria", "todo", "muchas", "mil", "verdad",
+        "tambien", "eso", "esto", "enlace", "link", "mensaje", "se", "nadita", "absolutamente", "necesito", "pido", "es",
+        "muy", "asi", "esta", "ahora", "mismo", "ese", "esa",
+    },
+}
+# Prioridad cuando una palabra cae en varias clases (p. ej. "nada" es negación antes que relleno)
+REPLY_CLASS_PRIORITY = ("ayuda", "no", "si", "accion", "mas", "acuerdo", "comentario", "relleno")
+REPLY_REPEATED_LETTERS = re.compile(r"([a-z])\1+")
+REPLY_WORD_CLASS = {
+    REPLY_REPEATED_LETTERS.sub(r"\1", word): reply_class
+    for reply_class in reversed(REPLY_CLASS_PRIORITY) for word in REPLY_WORD_CLASSES[reply_class]
+}
+# Palabras largas que se aceptan con un error de tipeo ("ayda", "clarp", "gracais")
+REPLY_TYPO_WORDS = [
+    (word, reply_class) for word, reply_class in REPLY_WORD_CLASS.items()
+    if len(word) >= 5 and reply_class not in ("relleno", "acuerdo")
+]
+REPLY_EMOJI_CLASSES = {
+    "👍": "acuerdo", "👌": "acuerdo", "🙆": "acuerdo", "✅": "si", "✔": "si", "☑": "si",
+    "👎": "no", "❌": "no", "✖": "no", "🚫": "no", "🙅": "no", "⛔": "no",
+    "🆘": "ayuda", "🚨": "ayuda", "🤔": "pregunta", "❓": "pregunta", "❔": "pregunta",
+    "🙏": "comentario", "😊": "comentario", "😀": "comentario", "😅": "comentario", "😱": "comentario", "😮": "comentario",
+}
+REPLY_QUESTION_PATTERN = re.compile(
+    r"^(que (es|son|hago|hacer|debo|pasa|paso|significa|puedo|tengo|me|le|se)|como|cual|cuales|donde|cuando|quien|por que"
+    r"|y (si|ahora|que|como|entonces|eso)"
+    r"|es (peligroso|grave|normal|seguro|verdad|cierto)|debo|puedo|tengo que|hay que)\b"
+)
+REPLY_EMPHATIC_NO_PATTERN = re.compile(r"\b(claro|obvio|por supuesto|para) que no\b")
+REPLY_UNSURE_PATTERN = re.compile(
+    r"\b(no se|no recuerdo|no me acuerdo|no estoy segur[oa]|tal vez|quizas|puede ser|a lo mejor|no creo)\b"
+)
+
+def reply_word_class(word: str) -> str | None:
+    word = REPLY_REPEATED_LETTERS.sub(r"\1", word)
+    reply_class = REPLY_WORD_CLASS.get(word)
+    if reply_class is None and len(word) >= 4:
+        reply_class = next((c for candidate, c in REPLY_TYPO_WORDS if bounded_edit_distance(word, candidate, 1) <= 1), None)
+    return reply_class
+
+def classify_reply_local(text: str, mode: str) -> tuple[str, float]:
+    """Interpreta sin LLM la respuesta a "¿quieres más detalles?" (decision_ver_detalles) o a
+    "¿llegaste a hacer clic?" (decision_post_phishing_interaction).
+
+    Devuelve la etiqueta que daría DeepSeek en ese modo y una confianza entre 0 y 1; lo dudoso
+    ("no sé", "sí, ¿y ahora qué hago?", palabras desconocidas) queda con confianza baja.
+    """
+    normalized = REPLY_EMPHATIC_NO_PATTERN.sub(" no ", normalize_text(text))
+    words = re.findall(r"[a-z0-9]+", normalized)
+    classes = Counter(reply_word_class(word) for word in words)
+    for char in text:
+        if char in REPLY_EMOJI_CLASSES:
+            classes[REPLY_EMOJI_CLASSES[char]] += 1
+    unknown = classes.pop(None, 0)
+    is_question = "?" in text or "¿" in text or classes.pop("pregunta", 0) > 0 or bool(REPLY_QUESTION_PATTERN.match(normalized))
+    if not classes and not is_question:
+        return "OTRA_COSA", 0.0
+    # Frases largas o con palabras que no conocemos: mejor que decida DeepSeek
+    certainty = 0.95 if unknown == 0 else 0.9 if unknown == 1 and len(words) >= 4 else 0.5
+    if REPLY_UNSURE_PATTERN.search(normalized) or len(words) > 12:
+        certainty = 0.5
+
+    if mode == "decision_ver_detalles":
+        if classes["si"] and not classes["no"] and not is_question:
+            return "QUIERE_DETALLES", certainty
+        if (classes["mas"] or classes["acuerdo"]) and not (classes["no"] or classes["comentario"] or classes["ayuda"] or is_question):
+            return "QUIERE_DETALLES", min(certainty, 0.9) # "más", "a ver", "ok", "dale", "explícame"
+        if classes["ayuda"]:
+            return "OTRA_COSA", 0.5 # ¿Quiere los detalles o ayuda porque ya cayó? Lo decide DeepSeek
+        if is_question and not classes["si"]:
+            return "OTRA_COSA", 0.9 # Una pregunta nueva se atiende como consulta aparte
+        return "OTRA_COSA", min(certainty, 0.9) # "no gracias", "ok gracias", "entendido"
+    if classes["ayuda"] and not classes["no"]:
+        return "PIDE_AYUDA", certainty
+    if is_question:
+        # "sí, ¿y ahora qué hago?" responde y pregunta a la vez
+        return "ES_PREGUNTA", 0.5 if classes["si"] or classes["no"] else 0.9
+    if classes["si"] and not classes["no"]:
+        return "RESPUESTA_SI", certainty
+    if classes["no"] and not classes["si"]:
+        return "RESPUESTA_NO", certainty
+    if classes["si"] or classes["ayuda"] or classes["mas"] or classes["accion"]:
+        return "OTRA_COSA", 0.3 # "sí... no", "no, ayuda": contradictorio; "más información", "ya di mis datos"
+    if not words and classes["acuerdo"]:
+        return "ES_COMENTARIO", 0.5 # Un 👍 a "¿llegaste a hacer clic?" puede ser un sí
+    if classes["comentario"] or classes["acuerdo"]:
+        return "ES_COMENTARIO", min(certainty, 0.9) # "gracias", "ok", "qué peligroso"
+    return "OTRA_COSA", 0.3
+
+async def decide_waiting_reply(text: str, mode: str, user_profile: dict) -> str | None:
+    """Etiqueta de la respuesta del usuario: local si es clara, si no con DeepSeek."""
+    decision, confidence = classify_reply_local(text, mode)
+    if confidence >= REPLY_LOCAL_MIN_CONFIDENCE:
+        reply_classifier_stats["local"] += 1
+        return decision
+    reply_classifier_stats["llm"] += 1
+    return await analyze_with_deepseek(normalize_text(text), mode, user_profile)
+
+# --- Datos del registro sin LLM (nombre, edad, conocimiento) ---
+# Cada extractor devuelve lo mismo que el prompt de ese campo ("NOMBRE_VALIDO:Ana", "EDAD_VALIDA:62",
+# "Poco"...) y una confianza; lo dudoso queda por debajo de ONBOARDING_LOCAL_MIN_CONFIDENCE y va a DeepSeek.
+ONBOARDING_WORD_PATTERN = re.compile(r"\d+|[a-z]+")
+
+# Nombres de pila frecuentes en Colombia y Latinoamérica, sin tildes
+NAME_GAZETTEER = set("""
+    abel abigail abraham adolfo adela adriana agustin aida alba albeiro alberto alejandra alejandro alexander alexandra
+    alfonso alfredo alicia alirio alonso alvaro amanda amparo ana anderson andrea andres angel angela angelica angie
+    antonia antonio arturo aurora beatriz benjamin bernardo berta blanca brayan bryan camila camilo carlos carlota
+    carmen carolina catalina cecilia celia cesar clara claudia consuelo cristian cristina cruz daniel daniela david
+    deisy diana diego dora doris edgar edilberto edith eduardo elena eliana elisa elizabeth elkin elsa elvira emilio
+    emma enrique ernesto esperanza esteban estela estefania esther eugenia eugenio eva fabian fabio fanny federico
+    felipe fernanda fernando flor francisco gabriel gabriela gerardo german gilberto gladys gloria gonzalo graciela
+    guillermo gustavo hector helena henry hernan hernando hilda hugo humberto ignacio ines ingrid irene isabel ismael
+    ivan jaime jairo javier jenny jesus jhon jimena joaquin jorge jose josefina juan juana julian juliana julio karen
+    karina katherine laura leidy leonardo leonor leticia lilia liliana lina lorena lucia lucas lucy luis luisa luz
+    magdalena manuel manuela marco marcela marcos margarita maria mariana maribel marina mario marleny marta martha
+    martin mateo matilde mauricio mercedes miguel milena miriam monica myriam natalia nelly nelson nicolas nohora norma
+    nubia octavio olga oliva omar orlando oscar pablo paola patricia paula pedro pilar rafael ramiro ramon raquel
+    raul rebeca ricardo roberto rocio rodrigo rosa rosalba rosario ruben ruth samuel sandra santiago sara sebastian
+    sergio silvia simon sofia sonia stella susana tatiana teresa tomas valentina valeria vanessa veronica victor
+    victoria viviana wilson william ximena yaneth yeison yesenia yolanda yuliana yurany zoila
+""".split())
+# Partículas de nombres y apellidos compuestos ("María de los Ángeles", "Juan de la Cruz")
+NAME_PARTICLES = {"de", "del", "la", "las", "los", "y"}
+# Lo que rodea al nombre en respuestas como "hola, me llamo Ana, mucho gusto"
+NAME_SKIP_WORDS = {
+    "hola", "buenas", "buenos", "dias", "tardes", "noches", "claro", "si", "ok", "bueno", "pues", "listo", "gracias",
+    "con", "mucho", "gusto", "un", "saludos", "don", "dona", "senor", "senora", "sr", "sra", "doctor", "doctora", "dr", "dra",
+}
+NAME_INTRO_PHRASES = [
+    phrase.split() for phrase in (
+        "yo me llamo", "me llamo", "mi nombre completo es", "mi nombre es", "mi nombre", "el nombre es", "yo soy", "soy",
+        "me dicen", "me puedes decir", "puedes llamarme", "llamame", "dime", "digame",
+    )
+]
+NAME_REFUSAL_PATTERN = re.compile(
+    r"\b(no (te |le )?(lo )?(quiero|voy a|puedo|deseo) (decir|dar|decirte|darte|decirle|darle|decirlo)|prefiero no"
+    r"|no (te |le )?(lo )?(digo|doy)|para que (quieres|necesitas|quiere|necesita)|anonim[oa]|no importa|no es necesario)\b"
+)
+
+SPANISH_UNITS = {"un": 1, "uno": 1, "una": 1, "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5, "seis": 6, "siete": 7, "ocho": 8, "nueve": 9}
+SPANISH_TENS = {
+    "diez": 10, "veinte": 20, "treinta": 30, "cuarenta": 40, "cincuenta": 50, "sesenta": 60, "setenta": 70,
+    "ochenta": 80, "noventa": 90,
+}
+# Multiplican al número que las precede ("treinta y cinco mil" no es una edad de 35)
+SPANISH_MULTIPLIERS = {"mil": 1000, "millon": 1000000, "millones": 1000000}
+SPANISH_NUMBER_WORDS = {
+    "cero": 0, **SPANISH_UNITS, **SPANISH_TENS, **SPANISH_MULTIPLIERS,
+    "once": 11, "doce": 12, "trece": 13, "catorce": 14, "quince": 15, "cien": 100, "ciento": 100,
+    **{f"dieci{unit}": 10 + value for unit, value in SPANISH_UNITS.items() if value >= 6},
+    **{f"veinti{unit}": 20 + value for unit, value in SPANISH_UNITS.items()},
+    # "treintaicinco", "cuarentaydos": así lo escriben algunos en el chat
+    **{f"{ten}{joiner}{unit}": tens + value for ten, tens in SPANISH_TENS.items() if tens >= 30
+       for joiner in ("y", "i") for unit, value in SPANISH_UNITS.items()},
+}
+AGE_CONTEXT_WORDS = {
+    "tengo", "anos", "ano", "anitos", "edad", "mi", "es", "de", "soy", "cumpli", "ya", "a", "y", "i", "un", "una",
+    "hola", "bueno", "pues", "claro", "si", "senor", "senora", "gracias", "ok", "listo", "tiene", "actualmente",
+}
+# "casi 40", "más de 60", "cuarenta y pico", "cumplo 50": la edad exacta no es ese número
+AGE_APPROXIMATE_WORDS = {
+    "casi", "mas", "menos", "unos", "unas", "como", "aproximadamente", "entre", "pasados", "pasaditos", "cerca",
+    "pico", "largos", "tantos", "alrededor", "rondando", "para", "cumplo", "cumplire", "voy", "o", "hace", "naci",
+}
+AGE_EVASIVE_PATTERN = re.compile(
+    r"\b(prefiero no|no (te |le )?(quiero|voy a|puedo) (decir|dar|decirte|darte|decirle)|no (te |le )?(la )?(digo|doy)"
+    r"|secreto|joven|viejo|vieja|mayor|adult[oa]|no importa|muchos|bastantes)\b"
+)
+
+# Respuestas a "¿qué tanto sabes sobre ciberseguridad?". Las frases se buscan antes que las
+# palabras sueltas y se quitan del texto ("no mucho" no debe contar también como "mucho").
+KNOWLEDGE_PHRASES = [
+    (re.compile(r"\b(no (entiendo|entendi|comprendo) (la|tu|su) pregunta|a veces|depende|no estoy segur[oa])\b"), "ambiguo"),
+    (re.compile(r"\b(mas o menos|masomenos|un poco|un poquito|muy poco|lo basico|no (mucho|tanto) pero algo)\b"), "Poco"),
+    (re.compile(r"\b(no (se |conozco |entiendo )?(mucho|tanto|casi nada)|casi nada|ni idea|para nada)\b"), "No"),
+    (re.compile(r"\b(si se|se bastante|se mucho|claro que si)\b"), "Sí"),
+]
+KNOWLEDGE_WORDS = {
+    "Sí": {"si", "sip", "bastante", "mucho", "muchisimo", "harto", "experto", "experta", "avanzado", "avanzada", "claro", "full", "bien"},
+    "Poco": {"poco", "poquito", "poquitico", "poquisimo", "algo", "regular", "medio", "basico", "intermedio", "normal", "maso"},
+    "No": {"no", "nada", "nadita", "cero", "ninguno", "ninguna", "nop", "negativo", "nunca", "nulo", "tampoco"},
+}
+KNOWLEDGE_WORD_CLASS = {word: label for label, words in KNOWLEDGE_WORDS.items() for word in words}
+KNOWLEDGE_FILLER_WORDS = {
+    "se", "sabo", "conozco", "entiendo", "del", "tema", "de", "eso", "la", "el", "verdad", "pues", "creo", "que", "yo",
+    "me", "mi", "muy", "lo", "sobre", "ciberseguridad", "seguridad", "estafas", "internet", "tecnologia", "en", "linea",
+    "gracias", "hola", "bueno", "ok", "casi", "y", "pero", "senor", "senora", "realmente", "tengo", "soy",
+}
+
+def parse_spanish_numbers(words: list[str]) -> list[int]:
+    """Números escritos con cifras o con palabras ("62", "sesenta y dos", "ciento cinco", "35 mil")."""
+    numbers, i = [], 0
+    while i < len(words):
+        word = words[i]
+        i += 1
+        if word.isdigit():
+            value = int(word)
+        elif word in SPANISH_MULTIPLIERS:
+            value = SPANISH_MULTIPLIERS[word] # "mil" suelto, o "un millón"
+        else:
+            value = SPANISH_NUMBER_WORDS.get(word)
+            # Sueltos, "un" y "una" son artículos: "una hija de 30"
+            if value is None or (word in ("un", "una") and not (i < len(words) and words[i] in SPANISH_MULTIPLIERS)):
+                continue
+            if word in ("un", "una"):
+                value = SPANISH_MULTIPLIERS[words[i]]
+                i += 1
+            if value == 100 and i < len(words) and SPANISH_NUMBER_WORDS.get(words[i], 100) < 100:
+                value += SPANISH_NUMBER_WORDS[words[i]]
+                i += 1
+            if value % 10 == 0 and value % 100 and i + 1 < len(words) and words[i] in ("y", "i") and \
+                    1 <= SPANISH_NUMBER_WORDS.get(words[i + 1], 0) <= 9:
+                value += SPANISH_NUMBER_WORDS[words[i + 1]]
+                i += 2
+        while i < len(words) and words[i] in SPANISH_MULTIPLIERS:
+            value *= SPANISH_MULTIPLIERS[words[i]]
+            i += 1
+        numbers.append(value)
+    return numbers
+
+def onboarding_certainty(unknown: int, total: int) -> float:
+    """Misma escala que classify_reply_local: con palabras que no conocemos, mejor que decida DeepSeek."""
+    if total > 12:
+        return 0.5
+    return 0.95 if unknown == 0 else 0.9 if unknown == 1 and total >= 4 else 0.5
+
+def extract_name_local(text: str) -> tuple[str, float]:
+    """Nombre de la respuesta a "¿cómo te llamas?", con las etiquetas del prompt "nombre"."""
+    normalized = normalize_text(text)
+    if NAME_REFUSAL_PATTERN.search(normalized):
+        return "NOMBRE_INVALIDO", 0.9
+    tokens = re.findall(r"[^\W\d_]+", text)
+    words = [normalize_text(token) for token in tokens]
+    start = 0
+    while start < len(words):
+        if words[start] in NAME_SKIP_WORDS:
+            start += 1
+            continue
+        phrase = next((p for p in NAME_INTRO_PHRASES if words[start:start + len(p)] == p), None)
+        if phrase is None:
+            break
+        start += len(phrase)
+    end = len(words)
+    while end > start and (words[end - 1] in NAME_SKIP_WORDS or words[end - 1] in ("y", "tu", "usted", "servirle", "servirte", "para")):
+        end -= 1
+    candidate, candidate_words = tokens[start:end], words[start:end]
+    if not candidate:
+        # "123", "👍": no es un nombre; "si", "ok", "hola": no dijo el nombre todavía
+        return ("NOMBRE_CONFUSO", 0.9) if words else ("NOMBRE_INVALIDO", 0.9)
+    if re.search(r"\d", text) or "?" in text or len(candidate) > 4 or candidate_words[0] not in NAME_GAZETTEER \
+            or candidate_words[-1] in NAME_PARTICLES:
+        return "NOMBRE_CONFUSO", 0.5
+    # Después del nombre de pila solo se aceptan otros nombres, partículas o hasta dos apellidos
+    unknown = [w for w in candidate_words if w not in NAME_GAZETTEER and w not in NAME_PARTICLES]
+    if len(unknown) > 2 or any(w in REPLY_WORD_CLASS or w in INTENT_GREETING_TOKENS for w in unknown):
+        return "NOMBRE_CONFUSO", 0.5
+    name = " ".join(token if word in NAME_PARTICLES else token.title() for token, word in zip(candidate, candidate_words))
+    return f"NOMBRE_VALIDO:{name}", 0.95 if not unknown else 0.9
+
+def extract_age_local(text: str) -> tuple[str, float]:
+    """Edad en cifras o en palabras ("tengo sesenta y dos años"), con las etiquetas del prompt "edad"."""
+    normalized = normalize_text(text)
+    words = ONBOARDING_WORD_PATTERN.findall(normalized)
+    numbers = parse_spanish_numbers(words)
+    if not numbers:
+        if AGE_EVASIVE_PATTERN.search(normalized):
+            return "EDAD_NO_CLARA", 0.9
+        return "EDAD_NO_CLARA", 0.0
+    # Varios números distintos ("40, y dos hijos"), un año o una cédula, o una edad aproximada
+    if len(set(numbers)) > 1 or numbers[0] >= 1000 or "?" in text or any(w in AGE_APPROXIMATE_WORDS for w in words):
+        return "EDAD_NO_CLARA", 0.5
+    unknown = sum(1 for w in words if not (w.isdigit() or w in SPANISH_NUMBER_WORDS or w in AGE_CONTEXT_WORDS))
+    return f"EDAD_VALIDA:{numbers[0]}", onboarding_certainty(unknown, len(words))
+
+def classify_knowledge_local(text: str) -> tuple[str, float]:
+    """Respuesta a "¿qué tanto sabes de ciberseguridad?": "Sí", "No", "Poco" o "CONOCIMIENTO_AMBIGUO"."""
+    normalized = normalize_text(text)
+    labels = Counter()
+    for pattern, label in KNOWLEDGE_PHRASES:
+        normalized, found = pattern.subn(" ", normalized)
+        if found:
+            labels[label] += found
+    words = ONBOARDING_WORD_PATTERN.findall(normalized)
+    unknown = 0
+    for word in words:
+        label = KNOWLEDGE_WORD_CLASS.get(word) or KNOWLEDGE_WORD_CLASS.get(REPLY_REPEATED_LETTERS.sub(r"\1", word)) # "siii", "nooo"
+        if label:
+            labels[label] += 1
+        elif word not in KNOWLEDGE_FILLER_WORDS:
+            unknown += 1
+    if labels["ambiguo"]:
+        return "CONOCIMIENTO_AMBIGUO", 0.9
+    if "?" in text or "¿" in text:
+        # "¿qué?", "¿cómo así?": no entendió la pregunta; "¿sí?" con algo más lo decide DeepSeek
+        return "CONOCIMIENTO_AMBIGUO", 0.9 if not labels else 0.5
+    certainty = onboarding_certainty(unknown, len(words))
+    if labels["Poco"]:
+        return "Poco", certainty # "sí, un poco", "no, poquito"
+    if labels["Sí"] and labels["No"]:
+        return "CONOCIMIENTO_AMBIGUO", 0.3
+    if labels["Sí"] or labels["No"]:
+        return ("Sí" if labels["Sí"] else "No"), certainty
+    return "CONOCIMIENTO_AMBIGUO", 0.0
+
+ONBOARDING_LOCAL_EXTRACTORS = {"nombre": extract_name_local, "edad": extract_age_local, "conocimiento": classify_knowledge_local}
+
+async def extract_onboarding_field(text: str, field: str) -> str | None:
+    """Respuesta al paso de registro: local si es clara, si no con DeepSeek (mismo formato)."""
+    result, confidence = ONBOARDING_LOCAL_EXTRACTORS[field](text)
+    if confidence >= ONBOARDING_LOCAL_MIN_CONFIDENCE:
+        onboarding_extractor_stats[f"{field}_local"] += 1
+        return result
+    onboarding_extractor_stats[f"{field}_llm"] += 1
+    return await analyze_with_deepseek(text, field)
+
 # --- Funciones de Base de Datos ---
-def get_db_connection():
-    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+class Database:
+    """Capa de acceso a SQLite.
+
+    Mantiene una única conexión persistente en modo WAL que solo se usa desde un hilo
+    dedicado: las consultas no bloquean el event loop, no se abre/cierra una conexión
+    por operación y sqlite3 reutiliza las sentencias preparadas (cached_statements).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-db")
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=256)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+
+    async def run(self, func, *args):
+        """Ejecuta func(*args) en el hilo de la base de datos."""
+        with STAGE_DB.time(): # Incluye la espera detrás de otras consultas en el hilo único
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def write_many(self, statements: list[tuple[str, tuple]]):
+        """Ejecuta varias escrituras en una sola transacción (llamar desde el hilo de la DB)."""
+        self.conn.execute("BEGIN")
+        try:
+            for query, params in statements:
+                self.conn.execute(query, params)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+db = Database(DB_NAME)
 
 IMAGES_DIR = "imagenes_recibidas"
 if not os.path.exists(IMAGES_DIR):
     os.makedirs(IMAGES_DIR)
 
 def setup_database(): # MODIFICADO
-    conn_setup = get_db_connection()
-    cursor_setup = conn_setup.cursor()
-    cursor_setup.execute("""
+    db.conn.execute("""
     CREATE TABLE IF NOT EXISTS usuarios (
         telefono TEXT PRIMARY KEY,
         nombre TEXT,
@@ -133,7 +1480,7 @@ def setup_database(): # MODIFICADO
     );
     """)
     # La tabla imagenes_procesadas puede mantenerse si se desea un log separado de solo imágenes
-    cursor_setup.execute("""
+    db.conn.execute("""
     CREATE TABLE IF NOT EXISTS imagenes_procesadas (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         telefono_usuario TEXT,
@@ -142,329 +1489,1530 @@ def setup_database(): # MODIFICADO
         FOREIGN KEY (telefono_usuario) REFERENCES usuarios(telefono)
     );
     """)
-    conn_setup.commit()
-    conn_setup.close()
+    columns = {row[1] for row in db.conn.execute("PRAGMA table_info(imagenes_procesadas)")}
+    if "sha256" not in columns: # Tablas creadas antes del almacén por contenido
+        db.conn.execute("ALTER TABLE imagenes_procesadas ADD COLUMN sha256 TEXT")
+    db.conn.execute("CREATE INDEX IF NOT EXISTS idx_imagenes_procesadas_sha256 ON imagenes_procesadas (sha256)")
+    db.conn.execute("CREATE INDEX IF NOT EXISTS idx_imagenes_procesadas_timestamp ON imagenes_procesadas (timestamp)")
+    # Archivos del almacén de imágenes; referencias = filas de imagenes_procesadas que lo usan (ver ImageStore)
+    db.conn.execute("""
+    CREATE TABLE IF NOT EXISTS imagenes_almacenadas (
+        sha256 TEXT PRIMARY KEY,
+        ruta TEXT NOT NULL,
+        formato TEXT NOT NULL,
+        bytes INTEGER NOT NULL,
+        bytes_originales INTEGER NOT NULL,
+        referencias INTEGER NOT NULL DEFAULT 0,
+        creado_en REAL NOT NULL,
+        usado_en REAL NOT NULL
+    );
+    """)
+    db.conn.execute("CREATE INDEX IF NOT EXISTS idx_imagenes_almacenadas_usado ON imagenes_almacenadas (usado_en)")
+    # Veredictos de phishing por huella del mensaje y segmento de perfil (ver VerdictCache)
+    db.conn.execute("""
+    CREATE TABLE IF NOT EXISTS cache_veredictos (
+        huella TEXT PRIMARY KEY,
+        segmento TEXT NOT NULL,
+        simhash INTEGER NOT NULL,
+        banda0 INTEGER NOT NULL,
+        banda1 INTEGER NOT NULL,
+        banda2 INTEGER NOT NULL,
+        banda3 INTEGER NOT NULL,
+        banda4 INTEGER NOT NULL,
+        banda5 INTEGER NOT NULL,
+        banda6 INTEGER NOT NULL,
+        banda7 INTEGER NOT NULL,
+        resumen TEXT NOT NULL,
+        detalles TEXT NOT NULL,
+        creado_en REAL NOT NULL,
+        usado_en REAL NOT NULL,
+        aciertos INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+    for band in range(8):
+        db.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_cache_veredictos_banda{band} ON cache_veredictos (segmento, banda{band})")
+    db.conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_veredictos_usado ON cache_veredictos (usado_en)")
+    # Texto OCR de imágenes ya procesadas por sha256 y dHash (ver OCRCache)
+    db.conn.execute("""
+    CREATE TABLE IF NOT EXISTS cache_ocr_imagenes (
+        sha256 TEXT PRIMARY KEY,
+        dhash INTEGER NOT NULL,
+        banda0 INTEGER NOT NULL,
+        banda1 INTEGER NOT NULL,
+        banda2 INTEGER NOT NULL,
+        banda3 INTEGER NOT NULL,
+        banda4 INTEGER NOT NULL,
+        banda5 INTEGER NOT NULL,
+        banda6 INTEGER NOT NULL,
+        banda7 INTEGER NOT NULL,
+        miniatura BLOB NOT NULL,
+        texto_ocr TEXT NOT NULL,
+        nombre_archivo_imagen TEXT NOT NULL,
+        ocr_segundos REAL NOT NULL,
+        creado_en REAL NOT NULL,
+        usado_en REAL NOT NULL,
+        aciertos INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+    for band in range(8):
+        db.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_cache_ocr_imagenes_banda{band} ON cache_ocr_imagenes (banda{band})")
+    db.conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_ocr_imagenes_usado ON cache_ocr_imagenes (usado_en)")
 
 setup_database()
 
-def db_get_user(telefono: str) -> sqlite3.Row | None:
-    conn_db = get_db_connection()
-    cursor_db = conn_db.cursor()
-    cursor_db.execute("SELECT * FROM usuarios WHERE telefono = ?", (telefono,))
-    user = cursor_db.fetchone()
-    conn_db.close()
-    return user
+class UserLockTimeoutError(Exception):
+    """El lock del usuario siguió tomado durante USER_LOCK_TIMEOUT_SECONDS."""
+
+class KeyedLockManager:
+    """Un asyncio.Lock por clave (teléfono), creado al pedirlo y borrado cuando nadie lo usa.
+
+    Cada entrada lleva un contador de referencias (quien lo tiene + quienes esperan); al
+    llegar a cero se elimina, así que el diccionario solo crece con los usuarios activos en
+    este momento y no con todos los que alguna vez escribieron.
+    """
+
+    def __init__(self, timeout_seconds: float, wait_stage: MetricStage):
+        self.timeout_seconds = timeout_seconds
+        self.wait_stage = wait_stage # Histograma de espera por el lock (compartido con /metrics)
+        self.entries: dict[str, list] = {} # clave -> [asyncio.Lock, referencias]
+        self.peak_entries = 0
+        self.stats = Counter()
+
+    @asynccontextmanager
+    async def acquire(self, key: str, timeout: float | None = None):
+        timeout = self.timeout_seconds if timeout is None else timeout
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [asyncio.Lock(), 0]
+            self.peak_entries = max(self.peak_entries, len(self.entries))
+        lock = entry[0]
+        entry[1] += 1
+        acquired = False
+        try:
+            started = time.monotonic()
+            if entry[1] == 1: # Nadie más lo tiene ni lo espera: se toma sin esperar
+                await lock.acquire()
+            else:
+                self.stats["contended"] += 1
+                try:
+                    if timeout > 0:
+                        await asyncio.wait_for(lock.acquire(), timeout)
+                    else:
+                        await lock.acquire()
+                except asyncio.TimeoutError:
+                    self.stats["timeouts"] += 1
+                    self.wait_stage.observe(time.monotonic() - started)
+                    self.wait_stage.errors["UserLockTimeoutError"] += 1
+                    raise UserLockTimeoutError(f"Lock de {key} ocupado por más de {timeout:g}s")
+            acquired = True
+            waited = time.monotonic() - started
+            self.stats["acquired"] += 1
+            self.wait_stage.observe(waited)
+            yield
+        finally:
+            if acquired:
+                lock.release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.entries[key]
+
+    def held_count(self) -> int:
+        return sum(1 for lock, _ in self.entries.values() if lock.locked())
+
+    def snapshot(self) -> dict:
+        held = self.held_count()
+        return {
+            "entries": len(self.entries),
+            "held": held,
+            "waiting": sum(refs for _, refs in self.entries.values()) - held,
+            "peak_entries": self.peak_entries,
+            "stats": dict(self.stats),
+            "wait_seconds": round(self.wait_stage.total, 3),
+            "wait_histogram": dict(self.wait_stage.cumulative()),
+        }
+
+user_locks = KeyedLockManager(USER_LOCK_TIMEOUT_SECONDS, STAGE_LOCK_WAIT)
+
+class UserCache:
+    """Caché LRU con TTL de perfiles de usuario (la fila de usuarios como dict), por teléfono.
+
+    Es write-through: db_update_user aplica los cambios aquí al mismo tiempo que los
+    escribe (o los deja pendientes en el turno), así que un usuario registrado no
+    necesita leer la base de datos en cada mensaje. Siempre devuelve copias.
+    Con varios procesos sin leases se crea con max_entries=0 (ver PROCESS_LOCAL_USER_STATE).
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, telefono: str) -> dict | None:
+        item = self.entries.get(telefono)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self.entries[telefono]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(telefono)
+        self.hits += 1
+        return dict(item[1])
+
+    def put(self, telefono: str, user: dict):
+        if self.max_entries <= 0:
+            return
+        self.entries[telefono] = (time.monotonic() + self.ttl_seconds, dict(user))
+        self.entries.move_to_end(telefono)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def apply(self, telefono: str, data: dict):
+        """Aplica una actualización parcial si el usuario está en caché (no crea entradas parciales)."""
+        item = self.entries.get(telefono)
+        if item is not None:
+            item[1].update(data)
+
+    def invalidate(self, telefono: str):
+        self.entries.pop(telefono, None)
+
+    def invalidate_where(self, predicate) -> int:
+        stale = [telefono for telefono in self.entries if predicate(telefono)]
+        for telefono in stale:
+            del self.entries[telefono]
+        return len(stale)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
 
-def db_create_user(telefono: str):
-    conn_db = get_db_connection()
-    cursor_db = conn_db.cursor()
+user_cache = UserCache(USER_CACHE_MAX_ENTRIES if PROCESS_LOCAL_USER_STATE else 0, USER_CACHE_TTL_SECONDS)
+
+class TurnWrites:
+    """Escrituras pendientes de un turno de conversación (teléfono -> columnas a actualizar)."""
+
+    def __init__(self):
+        self.pending: dict[str, dict] = {}
+        self.active = True
+
+current_turn_writes: contextvars.ContextVar[TurnWrites | None] = contextvars.ContextVar("current_turn_writes", default=None)
+
+@asynccontextmanager
+async def db_turn():
+    """Agrupa los db_update_user de un turno en una sola transacción al salir del bloque.
+
+    Debe abrirse dentro de user_locks.acquire(telefono) para que el commit ocurra antes de liberar el lock.
+    """
+    turn = TurnWrites()
+    token = current_turn_writes.set(turn)
     try:
-        cursor_db.execute("INSERT INTO usuarios (telefono, acepto_terminos, estado) VALUES (?, ?, ?)",
-                          (telefono, 0, ESTADO_PENDIENTE_TERMINOS))
-        conn_db.commit()
-    except sqlite3.IntegrityError:
-        print(f"Intento de crear usuario duplicado: {telefono}")
+        yield turn
     finally:
-        conn_db.close()
-
-def db_update_user(telefono: str, data: dict):
-    if not data:
-        print(f"DEBUG: db_update_user llamado para {telefono} sin datos. Retornando.")
-        return
+        turn.active = False
+        current_turn_writes.reset(token)
+        if turn.pending:
+            await _db_write_user_updates(list(turn.pending.items()))
 
-    fields = ", ".join([f"{key} = ?" for key in data])
-    values = list(data.values())
-    values.append(telefono)
+def _db_get_user_sync(telefono: str) -> dict | None:
+    row = db.conn.execute("SELECT * FROM usuarios WHERE telefono = ?", (telefono,)).fetchone()
+    return dict(row) if row else None
 
-    conn_db = None
-    query = f"UPDATE usuarios SET {fields} WHERE telefono = ?"
+def _db_create_user_sync(telefono: str):
     try:
-        conn_db = get_db_connection()
-        cursor_db = conn_db.cursor()
-        print(f"DEBUG: Ejecutando SQL: {query} con valores (excepto el último que es el teléfono): {tuple(values[:-1])} para tel: {telefono}")
-        cursor_db.execute(query, tuple(values))
-        conn_db.commit()
-        print(f"DEBUG: Commit exitoso para {telefono} en db_update_user.")
-    except sqlite3.Error as e_sqlite:
-        print(f"ERROR SQLITE en db_update_user para {telefono}: {e_sqlite}. Query: {query}, Values (sin token): {[(v[:20] + '...' if isinstance(v, str) and len(v) > 50 else v) for v in tuple(values)]}")
-        if conn_db:
-            conn_db.rollback()
-        raise
-    except Exception as e_general:
-        print(f"ERROR GENERAL en db_update_user para {telefono}: {e_general}. Query: {query}, Values (sin token): {[(v[:20] + '...' if isinstance(v, str) and len(v) > 50 else v) for v in tuple(values)]}")
-        if conn_db:
-            conn_db.rollback()
+        db.conn.execute("INSERT INTO usuarios (telefono, acepto_terminos, estado) VALUES (?, ?, ?)",
+                        (telefono, 0, ESTADO_PENDIENTE_TERMINOS))
+    except sqlite3.IntegrityError:
+        db_log.warning("Intento de crear usuario duplicado: %s", telefono)
+
+def _db_update_users_sync(updates: list[tuple[str, dict]]):
+    statements = []
+    for telefono, data in updates:
+        fields = ", ".join([f"{key} = ?" for key in data])
+        statements.append((f"UPDATE usuarios SET {fields} WHERE telefono = ?", (*data.values(), telefono)))
+    db.write_many(statements)
+
+def _db_save_image_record_sync(telefono_usuario: str, nombre_archivo_imagen: str, sha256: str | None = None):
+    statements = [(
+        "INSERT INTO imagenes_procesadas (telefono_usuario, nombre_archivo_imagen, sha256) VALUES (?, ?, ?)",
+        (telefono_usuario, nombre_archivo_imagen, sha256)
+    )]
+    if sha256: # Cada fila es una referencia al archivo del almacén
+        statements.append(("UPDATE imagenes_almacenadas SET referencias = referencias + 1, usado_en = ? WHERE sha256 = ?", (time.time(), sha256)))
+    db.write_many(statements)
+
+async def _db_write_user_updates(updates: list[tuple[str, dict]]):
+    telefonos = [telefono for telefono, _ in updates]
+    try:
+        await db.run(_db_update_users_sync, updates)
+        db_log.debug("Commit exitoso de %s actualización(es) de usuario para %s.", len(updates), telefonos)
+    except Exception as e:
+        for telefono, data in updates:
+            user_cache.invalidate(telefono) # La caché ya tenía el cambio aplicado: descartarla.
+            db_log.error("Error en db_update_user para %s: %s. Valores: %s", telefono, e, data)
         raise
-    finally:
-        if conn_db:
-            conn_db.close()
-            print(f"DEBUG: Conexión DB cerrada para {telefono} en db_update_user.")
-
-def db_save_image_record(telefono_usuario: str, nombre_archivo_imagen: str):
-    conn_db = get_db_connection()
-    cursor_db = conn_db.cursor()
-    cursor_db.execute(
-        "INSERT INTO imagenes_procesadas (telefono_usuario, nombre_archivo_imagen) VALUES (?, ?)",
-        (telefono_usuario, nombre_archivo_imagen)
-    )
-    conn_db.commit()
-    conn_db.close()
+
+async def db_get_user(telefono: str) -> dict | None:
+    cached_user = user_cache.get(telefono)
+    if cached_user is not None:
+        return cached_user
+    turn = current_turn_writes.get()
+    if turn is not None and turn.active and telefono in turn.pending:
+        # Leer después de escribir dentro del mismo turno: aplicar primero lo pendiente.
+        await _db_write_user_updates([(telefono, turn.pending.pop(telefono))])
+    user = await db.run(_db_get_user_sync, telefono)
+    if user is not None:
+        user_cache.put(telefono, user)
+    return user
+
+async def db_create_user(telefono: str):
+    user_cache.invalidate(telefono)
+    await db.run(_db_create_user_sync, telefono)
+
+async def db_update_user(telefono: str, data: dict):
+    if not data:
+        db_log.debug("db_update_user llamado para %s sin datos. Retornando.", telefono)
+        return
+    user_cache.apply(telefono, data)
+    turn = current_turn_writes.get()
+    if turn is not None and turn.active:
+        turn.pending.setdefault(telefono, {}).update(data)
+        return
+    await _db_write_user_updates([(telefono, data)])
+
+async def db_save_image_record(telefono_usuario: str, nombre_archivo_imagen: str, sha256: str | None = None):
+    await db.run(_db_save_image_record_sync, telefono_usuario, nombre_archivo_imagen, sha256)
+
+# --- Caché de veredictos de phishing ---
+PHISHING_DETAILS_SEPARATOR = "---DETALLES_SIGUEN---"
+VERDICT_NAME_PLACEHOLDER = "{{NOMBRE_USUARIO}}"
+VERDICT_URL_PATTERN = re.compile(r"(https?://\S+|www\.\S+|\b[a-z0-9-]+(\.[a-z0-9-]+)*\.(com|co|net|org|ly|me|info|xyz|site|online|io)(/\S*)?)")
+VERDICT_EMAIL_PATTERN = re.compile(r"\b\S+@\S+\.\w+\b")
+VERDICT_NUMBER_PATTERN = re.compile(r"\d[\d.,\s]*\d|\d")
+VERDICT_SALUTATION_PATTERN = re.compile(r"\b(hola|estimad[oa]|senor[a]?|sr|sra|querid[oa]|apreciad[oa])\s+[a-z]+")
+VERDICT_URL_TOKEN_PATTERN = re.compile(r"<url(?::([^>]+))?>")
+
+def without_accents(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+def mask_user_name(text: str, nombre_usuario: str, marker: str) -> str:
+    """Reemplaza el nombre del usuario cuando está escrito como nombre propio (con mayúscula y no al inicio de una frase)."""
+    nombre = without_accents(nombre_usuario.strip())
+    if not nombre:
+        return text
+    pattern = re.compile(rf"\b{re.escape(nombre[:1].upper() + nombre[1:])}\b")
+    text = without_accents(text)
+    def replace(match: re.Match) -> str:
+        before = text[:match.start()].rstrip()
+        return match.group() if not before or before[-1] in ".!?¡¿:\n" else marker
+    return pattern.sub(replace, text)
+
+def verdict_prompt_profile(user_profile: dict) -> dict:
+    """Perfil para el prompt de phishing con el marcador en lugar del nombre.
+
+    DeepSeek escribe {{NOMBRE_USUARIO}} donde va el nombre; el análisis se cachea así, tal
+    cual, y render_verdict_name pone el nombre de quien lo recibe.
+    """
+    return {**user_profile, "nombre": VERDICT_NAME_PLACEHOLDER}
+
+def render_verdict_name(analisis: str, nombre_usuario: str | None) -> str:
+    return analisis.replace(VERDICT_NAME_PLACEHOLDER, nombre_usuario or "usuario")
+
+def canonicalize_message_for_verdict(text: str, nombre_usuario: str | None = None) -> str:
+    """Normaliza un mensaje para que las copias de una misma campaña den la misma huella.
+
+    Correos, números y nombres (el del usuario y el que sigue a un saludo) se reemplazan
+    por marcadores, y cada enlace por <url:dominio registrable>: un link de rastreo o un
+    monto distinto no cambian el resultado, pero un enlace a otro sitio sí. El nombre del
+    usuario solo se reemplaza escrito con mayúscula y fuera del inicio de una frase: muchos
+    nombres son también palabras ("la alerta es clara", "Rosa", "Luz").
+    """
+    if nombre_usuario:
+        text = mask_user_name(text, nombre_usuario, "<nombre>")
+    canonical = normalize_text(text)
+    link_domains = []
+    def url_token(match: re.Match) -> str:
+        host = canonical_host(match.group())
+        link_domains.append(registrable_domain(host) if host and not is_ip_host(host) else host or "")
+        return " <url> "
+    canonical = VERDICT_URL_PATTERN.sub(url_token, canonical)
+    canonical = VERDICT_EMAIL_PATTERN.sub(" <email> ", canonical)
+    canonical = VERDICT_NUMBER_PATTERN.sub(" <num> ", canonical)
+    canonical = VERDICT_SALUTATION_PATTERN.sub(lambda m: f"{m.group(1)} <nombre>", canonical)
+    canonical = re.sub(r"[^\w<>\s]", " ", canonical)
+    # El dominio se pone al final para que los pasos anteriores no lo partan ni le cambien los dígitos
+    domains = iter(link_domains)
+    canonical = re.sub(r"<url>", lambda m: f"<url:{next(domains, '')}>", canonical)
+    return re.sub(r"\s+", " ", canonical).strip()
+
+def simhash64(text: str) -> int:
+    """SimHash de 64 bits sobre las palabras del texto (como entero con signo para SQLite).
+
+    Se usan palabras sueltas y no n-gramas: en mensajes cortos (SMS) un cambio de una
+    palabra movía demasiados bits con trigramas.
+    """
+    weights = [0] * 64
+    for word in text.split():
+        h = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    value = sum(1 << bit for bit in range(64) if weights[bit] > 0)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def simhash_bands(value: int) -> list[int]:
+    unsigned = value & 0xFFFFFFFFFFFFFFFF
+    return [(unsigned >> (8 * band)) & 0xFF for band in range(8)]
+
+def verdict_profile_segment(user_profile: dict) -> str:
+    """El veredicto se adapta a edad y conocimiento, así que se cachea por segmento de perfil."""
+    edad = user_profile.get("edad")
+    grupo_edad = "mayor" if isinstance(edad, int) and edad >= 60 else "general"
+    return f"{user_profile.get('conocimiento') or 'desconocido'}|{grupo_edad}"
+
+def verdict_segment(canonical: str, user_profile: dict) -> str:
+    """Segmento de perfil más los dominios de los enlaces del mensaje.
+
+    Los casi-duplicados solo se buscan dentro del segmento: sin esto, la copia de un mensaje
+    legítimo con el enlace cambiado a otro sitio quedaría a un par de bits del original.
+    """
+    domains = sorted({match.group(1) or "" for match in VERDICT_URL_TOKEN_PATTERN.finditer(canonical)})
+    return f"{verdict_profile_segment(user_profile)}|{','.join(domains)}"
+
+class VerdictCache:
+    """Caché persistente (tabla cache_veredictos) de análisis de phishing.
+
+    La clave es la huella del mensaje canonicalizado más el segmento (perfil y dominios de
+    los enlaces, ver verdict_segment). Si no hay coincidencia exacta se busca un casi-duplicado
+    del mismo segmento por SimHash (8 bandas de 8 bits: dos hashes a distancia <= 7
+    comparten al menos una banda). Los análisis llegan ya con el marcador del nombre
+    (verdict_prompt_profile) y el nombre se pone al devolver el resultado.
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+        self.stats = Counter()
+        self.stores_since_eviction = 0
+
+    def _key(self, canonical: str, segment: str) -> str:
+        return hashlib.sha256(f"{segment}\n{canonical}".encode()).hexdigest()
+
+    def _lookup_sync(self, key: str, segment: str, simhash_value: int) -> tuple[str, str, str] | None:
+        now = time.time()
+        min_created = now - VERDICT_CACHE_TTL_SECONDS
+        row = self.db.conn.execute(
+            "SELECT huella, resumen, detalles FROM cache_veredictos WHERE huella = ? AND creado_en >= ?",
+            (key, min_created)
+        ).fetchone()
+        kind = "exact"
+        if row is None:
+            kind = "near"
+            bands = simhash_bands(simhash_value)
+            candidates = self.db.conn.execute(
+                "SELECT huella, resumen, detalles, simhash FROM cache_veredictos WHERE segmento = ? AND creado_en >= ? "
+                "AND (banda0 = ? OR banda1 = ? OR banda2 = ? OR banda3 = ? OR banda4 = ? OR banda5 = ? OR banda6 = ? OR banda7 = ?) "
+                "ORDER BY usado_en DESC LIMIT 500",
+                (segment, min_created, *bands)
+            ).fetchall()
+            best_distance = VERDICT_CACHE_SIMHASH_MAX_DISTANCE + 1
+            for candidate in candidates:
+                distance = bin((candidate["simhash"] ^ simhash_value) & 0xFFFFFFFFFFFFFFFF).count("1")
+                if distance < best_distance:
+                    row, best_distance = candidate, distance
+        if row is None:
+            return None
+        self.db.conn.execute("UPDATE cache_veredictos SET usado_en = ?, aciertos = aciertos + 1 WHERE huella = ?", (now, row["huella"]))
+        return kind, row["resumen"], row["detalles"]
+
+    def _store_sync(self, key: str, segment: str, simhash_value: int, resumen: str, detalles: str, evict: bool):
+        now = time.time()
+        self.db.conn.execute(
+            "INSERT OR REPLACE INTO cache_veredictos (huella, segmento, simhash, banda0, banda1, banda2, banda3, banda4, banda5, banda6, banda7, "
+            "resumen, detalles, creado_en, usado_en) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, segment, simhash_value, *simhash_bands(simhash_value), resumen, detalles, now, now)
+        )
+        if evict:
+            self.db.conn.execute("DELETE FROM cache_veredictos WHERE creado_en < ?", (now - VERDICT_CACHE_TTL_SECONDS,))
+            excess = self.db.conn.execute("SELECT COUNT(*) FROM cache_veredictos").fetchone()[0] - VERDICT_CACHE_MAX_ENTRIES
+            if excess > 0:
+                self.db.conn.execute(
+                    "DELETE FROM cache_veredictos WHERE huella IN (SELECT huella FROM cache_veredictos ORDER BY usado_en LIMIT ?)",
+                    (excess,)
+                )
+
+    async def lookup(self, text: str, user_profile: dict) -> str | None:
+        """Devuelve el análisis completo (resumen + separador + detalles) personalizado, o None."""
+        nombre = user_profile.get("nombre")
+        canonical = canonicalize_message_for_verdict(text, nombre)
+        if len(canonical) < VERDICT_CACHE_MIN_TEXT_LENGTH:
+            return None
+        segment = verdict_segment(canonical, user_profile)
+        try:
+            result = await self.db.run(self._lookup_sync, self._key(canonical, segment), segment, simhash64(canonical))
+        except sqlite3.Error as e:
+            cache_log.error("Error al consultar la caché de veredictos: %s", e)
+            return None
+        if result is None:
+            self.stats["misses"] += 1
+            return None
+        kind, resumen, detalles = result
+        self.stats[f"hits_{kind}"] += 1
+        return render_verdict_name(f"{resumen}\n{PHISHING_DETAILS_SEPARATOR}\n{detalles}", nombre)
+
+    async def store(self, text: str, user_profile: dict, analisis_completo: str):
+        """Guarda un análisis escrito con el marcador del nombre (pedido con verdict_prompt_profile)."""
+        if PHISHING_DETAILS_SEPARATOR not in analisis_completo:
+            return # Respuestas de error o mal formadas no se cachean.
+        canonical = canonicalize_message_for_verdict(text, user_profile.get("nombre"))
+        if len(canonical) < VERDICT_CACHE_MIN_TEXT_LENGTH:
+            return
+        resumen, detalles = (part.strip() for part in analisis_completo.split(PHISHING_DETAILS_SEPARATOR, 1))
+        segment = verdict_segment(canonical, user_profile)
+        self.stores_since_eviction += 1
+        evict = self.stores_since_eviction >= 100
+        if evict:
+            self.stores_since_eviction = 0
+        try:
+            await self.db.run(self._store_sync, self._key(canonical, segment), segment, simhash64(canonical), resumen, detalles, evict)
+            self.stats["stores"] += 1
+        except sqlite3.Error as e:
+            cache_log.error("Error al guardar en la caché de veredictos: %s", e)
+
+    def hit_rate(self) -> float:
+        hits = self.stats["hits_exact"] + self.stats["hits_near"]
+        total = hits + self.stats["misses"]
+        return round(hits / total, 4) if total else 0.0
+
+verdict_cache = VerdictCache(db)
+
+# --- Cola persistente de webhooks ---
+def sender_shard(telefono: str) -> int:
+    return zlib.crc32(telefono.encode()) % WEBHOOK_SHARDS
+
+class WebhookQueue:
+    """Cola durable en SQLite: el webhook guarda el payload y los workers lo procesan.
+
+    Los trabajos que fallan se reintentan con backoff exponencial y, al agotar
+    WEBHOOK_QUEUE_MAX_ATTEMPTS, pasan a la tabla cola_webhook_fallidos (dead-letter).
+    Vive en su propio archivo (WEBHOOK_QUEUE_DB) para no competir por el lock de escritura
+    con los datos de usuarios. Igual que Database, usa una conexión persistente en modo WAL
+    desde un hilo propio (run()): las operaciones suelen ser sub-milisegundo, pero si otro
+    proceso tiene el lock de escritura busy_timeout puede esperar hasta 5 s, y eso no debe
+    congelar el event loop. Los métodos síncronos se llaman solo desde ese hilo;
+    enqueue() y refresh_leases() son la entrada desde el event loop.
+
+    enqueue() es la excepción medida: el POST del webhook intenta el INSERT en el propio loop
+    con una segunda conexión sin espera (busy_timeout=0, sin checkpoints) y solo si el archivo
+    está bloqueado pasa al hilo. Con 200 remitentes a la vez el salto al hilo costaba ~190 ms
+    de p99 en el POST esperando una vuelta del loop, y el INSERT directo cuesta ~0,5 ms.
+
+    Cada payload se guarda como un trabajo por remitente. claim() solo entrega el trabajo
+    más antiguo de cada remitente (los siguientes esperan aunque el primero esté en backoff),
+    así que el orden por usuario se mantiene aunque varios procesos compartan la cola. En modo
+    "lease" cada proceso además solo toma trabajos de los shards que tiene arrendados: un
+    usuario siempre lo atiende el mismo proceso, y la caché de perfiles y los detalles de
+    análisis pendientes (ambos en memoria) siguen siendo correctos.
+    """
+
+    def __init__(self, db_path: str):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-cola")
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.ingest_conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.ingest_conn.execute("PRAGMA synchronous=NORMAL")
+        self.ingest_conn.execute("PRAGMA busy_timeout=0") # Nunca espera un lock desde el event loop
+        self.ingest_conn.execute("PRAGMA wal_autocheckpoint=0") # Los checkpoints los hace la conexión del hilo
+        self.event = asyncio.Event()
+        self.stats = Counter()
+        self.owner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.owned_shards: set[int] = set(range(WEBHOOK_SHARDS)) if WEBHOOK_SHARD_MODE != "lease" else set()
+
+    async def run(self, func, *args):
+        """Ejecuta func(*args) en el hilo de la cola."""
+        with STAGE_WEBHOOK_QUEUE.time():
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def setup(self):
+        # Varios procesos pueden arrancar a la vez: el esquema se crea/migra en una sola transacción.
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cola_webhook (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                disponible_en REAL NOT NULL,
+                creado_en REAL NOT NULL,
+                ultimo_error TEXT,
+                remitente TEXT NOT NULL DEFAULT '',
+                shard INTEGER NOT NULL DEFAULT 0,
+                dueno TEXT
+            );
+            """)
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(cola_webhook)")}
+            for column, definition in (("remitente", "TEXT NOT NULL DEFAULT ''"), ("shard", "INTEGER NOT NULL DEFAULT 0"), ("dueno", "TEXT")):
+                if column not in columns: # Colas creadas antes del reparto por remitente
+                    self.conn.execute(f"ALTER TABLE cola_webhook ADD COLUMN {column} {definition}")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_cola_webhook_pendientes ON cola_webhook (estado, disponible_en, id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_cola_webhook_remitente ON cola_webhook (remitente, id)")
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cola_webhook_fallidos (
+                id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                intentos INTEGER NOT NULL,
+                ultimo_error TEXT,
+                creado_en REAL NOT NULL,
+                fallido_en REAL NOT NULL
+            );
+            """)
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS shards_webhook (
+                shard INTEGER PRIMARY KEY,
+                dueno TEXT,
+                vence_en REAL NOT NULL DEFAULT 0
+            );
+            """)
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS procesos_webhook (
+                dueno TEXT PRIMARY KEY,
+                visto_en REAL NOT NULL
+            );
+            """)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        if WEBHOOK_SHARD_MODE == "lease":
+            return # Los trabajos de dueños caídos se recuperan al tomar su shard (refresh_leases).
+        # Trabajos que quedaron a medias por un reinicio vuelven a estar pendientes.
+        recovered = self.conn.execute("UPDATE cola_webhook SET estado = 'pendiente' WHERE estado = 'procesando'").rowcount
+        if recovered:
+            queue_log.info("Cola de webhooks: %s trabajo(s) recuperado(s) tras reinicio.", recovered)
+
+    async def refresh_leases(self) -> set[int]:
+        """Renueva los leases propios y toma o cede shards hasta quedar con la parte justa.
+
+        La parte justa es ceil(WEBHOOK_SHARDS / procesos vivos). Al tomar un shard cuyo lease
+        venció (su dueño se cayó) sus trabajos 'procesando' vuelven a estar pendientes; un
+        shard cedido por un proceso vivo no, porque ese proceso termina lo que tiene en curso.
+        """
+        previous = set(self.owned_shards)
+        self.owned_shards = await self.run(self._renew_leases)
+        gained = self.owned_shards - previous
+        if gained:
+            # Otro proceso pudo haber cambiado a estos usuarios mientras no eran nuestros.
+            user_cache.invalidate_where(lambda telefono: sender_shard(telefono) in gained)
+        if gained or previous - self.owned_shards:
+            queue_log.info("Cola de webhooks: proceso %s atiende %s shard(s) de %s.", self.owner_id, len(self.owned_shards), WEBHOOK_SHARDS)
+        return self.owned_shards
+
+    def _renew_leases(self) -> set[int]:
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute("INSERT OR REPLACE INTO procesos_webhook (dueno, visto_en) VALUES (?, ?)", (self.owner_id, now))
+            self.conn.execute("DELETE FROM procesos_webhook WHERE visto_en < ?", (now - WEBHOOK_SHARD_LEASE_SECONDS,))
+            self.conn.executemany("INSERT OR IGNORE INTO shards_webhook (shard) VALUES (?)", ((shard,) for shard in range(WEBHOOK_SHARDS)))
+            live_processes = self.conn.execute("SELECT COUNT(*) FROM procesos_webhook").fetchone()[0]
+            fair_share = math.ceil(WEBHOOK_SHARDS / max(1, live_processes))
+            lease_until = now + WEBHOOK_SHARD_LEASE_SECONDS
+            self.conn.execute("UPDATE shards_webhook SET vence_en = ? WHERE dueno = ?", (lease_until, self.owner_id))
+            owned = [row[0] for row in self.conn.execute("SELECT shard FROM shards_webhook WHERE dueno = ? ORDER BY shard", (self.owner_id,))]
+            if len(owned) > fair_share:
+                for shard in owned[fair_share:]:
+                    self.conn.execute("UPDATE shards_webhook SET dueno = NULL, vence_en = 0 WHERE shard = ?", (shard,))
+                owned = owned[:fair_share]
+            elif len(owned) < fair_share:
+                free = self.conn.execute(
+                    "SELECT shard, dueno FROM shards_webhook WHERE dueno IS NULL OR vence_en < ? ORDER BY shard LIMIT ?",
+                    (now, fair_share - len(owned))
+                ).fetchall()
+                for shard, previous_owner in free:
+                    self.conn.execute("UPDATE shards_webhook SET dueno = ?, vence_en = ? WHERE shard = ?", (self.owner_id, lease_until, shard))
+                    if previous_owner is not None:
+                        recovered = self.conn.execute(
+                            "UPDATE cola_webhook SET estado = 'pendiente' WHERE shard = ? AND estado = 'procesando' AND dueno IS NOT ?",
+                            (shard, self.owner_id)
+                        ).rowcount
+                        if recovered:
+                            queue_log.info("Cola de webhooks: %s trabajo(s) del shard %s recuperado(s) de %s.", recovered, shard, previous_owner)
+                    owned.append(shard)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return set(owned)
+
+    def release_leases(self):
+        if WEBHOOK_SHARD_MODE != "lease":
+            return
+        # Un shard liberado no pasa por la recuperación de dueños caídos: lo que los workers
+        # cancelados dejaron 'procesando' vuelve a pendiente aquí (claim() los reconoce por trabajo).
+        self.conn.execute("UPDATE cola_webhook SET estado = 'pendiente' WHERE estado = 'procesando' AND dueno = ?", (self.owner_id,))
+        self.conn.execute("UPDATE shards_webhook SET dueno = NULL, vence_en = 0 WHERE dueno = ?", (self.owner_id,))
+        self.conn.execute("DELETE FROM procesos_webhook WHERE dueno = ?", (self.owner_id,))
+        self.owned_shards = set()
+
+    INSERT_JOB = "INSERT INTO cola_webhook (payload, remitente, shard, disponible_en, creado_en) VALUES (?, ?, ?, ?, ?)"
+
+    @staticmethod
+    def job_rows(payload: dict) -> list[tuple]:
+        """Un trabajo por remitente del payload, listo para INSERT_JOB."""
+        messages_by_sender: dict[str, list[dict]] = {}
+        for message_object in extract_webhook_messages(payload):
+            messages_by_sender.setdefault(str(message_object.get("from") or ""), []).append(message_object)
+        now = time.time()
+        return [
+            (json.dumps({"entry": [{"changes": [{"value": {"messages": sender_messages}}]}]}, ensure_ascii=False),
+             remitente, sender_shard(remitente), now, now)
+            for remitente, sender_messages in messages_by_sender.items()
+        ]
+
+    def put(self, payload: dict) -> int:
+        """Guarda un trabajo por remitente del payload y devuelve cuántos se crearon."""
+        rows = self.job_rows(payload)
+        self.conn.executemany(self.INSERT_JOB, rows)
+        return len(rows)
+
+    async def enqueue(self, payload: dict) -> int:
+        """Guarda el payload desde el event loop sin esperar locks y despierta a los workers."""
+        rows = self.job_rows(payload)
+        try:
+            self.ingest_conn.executemany(self.INSERT_JOB, rows)
+            self.stats["enqueued_inline"] += 1
+        except sqlite3.OperationalError: # Archivo bloqueado (otro proceso escribiendo): se espera en el hilo
+            self.stats["enqueued_deferred"] += 1
+            await self.run(self.conn.executemany, self.INSERT_JOB, rows)
+        self.event.set()
+        return len(rows)
+
+    def claim(self) -> tuple[int, dict, int] | None:
+        """Toma el trabajo pendiente más antiguo cuyo remitente no tenga otro anterior sin terminar."""
+        now = time.time()
+        shard_filter, params = "", [self.owner_id, now]
+        if WEBHOOK_SHARD_MODE == "lease":
+            if not self.owned_shards:
+                return None
+            # Se verifica el lease en la base y no solo en owned_shards: si este proceso estuvo
+            # bloqueado y otro ya tomó el shard, no debe seguir sacando trabajos de él.
+            shard_filter = "AND c.shard IN (SELECT shard FROM shards_webhook WHERE dueno = ? AND vence_en > ?) "
+            params.extend((self.owner_id, now))
+        # Un solo UPDATE ... RETURNING: dos procesos no pueden tomar el mismo trabajo.
+        row = self.conn.execute(
+            "UPDATE cola_webhook SET estado = 'procesando', dueno = ? WHERE id = ("
+            "SELECT c.id FROM cola_webhook c WHERE c.estado = 'pendiente' AND c.disponible_en <= ? " + shard_filter +
+            "AND NOT EXISTS (SELECT 1 FROM cola_webhook anterior WHERE anterior.remitente = c.remitente AND anterior.id < c.id) "
+            "ORDER BY c.id LIMIT 1) RETURNING id, payload, intentos",
+            params
+        ).fetchone()
+        if not row:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def complete(self, job_id: int):
+        self.conn.execute("DELETE FROM cola_webhook WHERE id = ?", (job_id,))
+
+    def fail(self, job_id: int, attempts: int, error: str) -> bool:
+        """Reprograma el trabajo con backoff. Devuelve False si se movió a dead-letter."""
+        if attempts >= WEBHOOK_QUEUE_MAX_ATTEMPTS:
+            self.conn.execute("BEGIN")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cola_webhook_fallidos (id, payload, intentos, ultimo_error, creado_en, fallido_en) "
+                "SELECT id, payload, ?, ?, creado_en, ? FROM cola_webhook WHERE id = ?",
+                (attempts, error, time.time(), job_id)
+            )
+            self.conn.execute("DELETE FROM cola_webhook WHERE id = ?", (job_id,))
+            self.conn.execute("COMMIT")
+            return False
+        delay = min(WEBHOOK_QUEUE_RETRY_MAX_SECONDS, WEBHOOK_QUEUE_RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+        delay *= random.uniform(0.8, 1.2)
+        self.conn.execute(
+            "UPDATE cola_webhook SET estado = 'pendiente', intentos = ?, disponible_en = ?, ultimo_error = ? WHERE id = ?",
+            (attempts, time.time() + delay, error, job_id)
+        )
+        return True
+
+    def pending_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM cola_webhook").fetchone()[0]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.ingest_conn.close()
+        self.conn.close()
+
+webhook_queue: WebhookQueue | None = None
+webhook_queue_workers: list[asyncio.Task] = []
+
+async def webhook_shard_lease_task():
+    while True:
+        await asyncio.sleep(WEBHOOK_SHARD_LEASE_SECONDS / 3)
+        try:
+            await webhook_queue.refresh_leases()
+        except sqlite3.Error as e:
+            queue_log.error("Error al renovar los leases de la cola de webhooks: %s", e)
+# Trabajo de la cola que se está procesando (None en modo inline); lo usa MessageDedupe.claim
+current_webhook_job_id: contextvars.ContextVar[int | None] = contextvars.ContextVar("current_webhook_job_id", default=None)
+
+async def webhook_queue_worker(worker_num: int):
+    while True:
+        # Limpiar el evento antes de consultar evita perder un aviso de put().
+        webhook_queue.event.clear()
+        job = await webhook_queue.run(webhook_queue.claim)
+        if job is None:
+            try:
+                await asyncio.wait_for(webhook_queue.event.wait(), timeout=WEBHOOK_QUEUE_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        job_id, payload, intentos = job
+        job_token = current_webhook_job_id.set(job_id)
+        correlation_token = current_correlation_id.set(f"job-{job_id}")
+        try:
+            await process_webhook_payload(payload)
+            await webhook_queue.run(webhook_queue.complete, job_id)
+        except asyncio.CancelledError:
+            raise # El trabajo queda 'procesando' y se recupera en el próximo arranque.
+        except Exception as e:
+            intentos += 1
+            if await webhook_queue.run(webhook_queue.fail, job_id, intentos, repr(e)):
+                queue_log.warning("Cola de webhooks (worker %s): trabajo %s falló (intento %s), se reintentará. Error: %s", worker_num, job_id, intentos, e)
+            else:
+                queue_log.error("Cola de webhooks (worker %s): trabajo %s movido a dead-letter tras %s intentos. Error: %s", worker_num, job_id, intentos, e)
+        finally:
+            current_correlation_id.reset(correlation_token)
+            current_webhook_job_id.reset(job_token)
+
+class MessageDedupe:
+    """Registro de message_id ya procesados, compartido por todos los workers.
+
+    La fuente de verdad es la tabla mensajes_procesados (archivo propio en WAL, usado desde
+    un hilo propio como WebhookQueue): claim() hace un INSERT OR IGNORE sobre la clave
+    primaria, que a la vez consulta y reserva el id de forma atómica entre procesos.
+    Delante hay un set con un anillo (deque) de los últimos MESSAGE_DEDUPE_LOCAL_SIZE ids
+    para que los reintentos inmediatos de Meta no toquen SQLite. Los ids se borran tras
+    MESSAGE_DEDUPE_TTL_SECONDS.
+
+    Cada id guarda el trabajo de la cola que lo reservó: si ese mismo trabajo se vuelve a
+    ejecutar (recuperado tras una caída) puede reclamar los ids que no alcanzó a terminar.
+    """
+
+    SWEEP_EVERY_CLAIMS = 1000
+
+    def __init__(self, db_path: str, local_size: int):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-dedupe")
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS mensajes_procesados (
+            message_id TEXT PRIMARY KEY,
+            visto_en REAL NOT NULL,
+            trabajo INTEGER,
+            terminado INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_procesados_visto ON mensajes_procesados (visto_en)")
+        self.local_ids: set[str] = set()
+        self.local_ring: deque[str] = deque()
+        self.local_size = local_size
+        self.claims_since_sweep = 0
+        self.stats = Counter()
+
+    async def run(self, func, *args):
+        """Ejecuta func(*args) en el hilo del registro."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _remember(self, message_id: str):
+        self.local_ids.add(message_id)
+        self.local_ring.append(message_id)
+        if len(self.local_ring) > self.local_size:
+            self.local_ids.discard(self.local_ring.popleft())
+
+    async def claim(self, message_id: str, job_id: int | None = None) -> bool:
+        """True si el mensaje es nuevo (y queda registrado); False si ya se procesó."""
+        if message_id in self.local_ids:
+            self.stats["duplicates_local"] += 1
+            return False
+        now = time.time()
+        inserted = await self.run(self._reserve, message_id, job_id, now)
+        self._remember(message_id)
+        if not inserted:
+            self.stats["duplicates_shared"] += 1
+            return False
+        self.stats["claimed"] += 1
+        self.claims_since_sweep += 1
+        if self.claims_since_sweep >= self.SWEEP_EVERY_CLAIMS:
+            self.claims_since_sweep = 0
+            self.stats["swept"] += await self.run(self.sweep, now)
+        return True
+
+    def _reserve(self, message_id: str, job_id: int | None, now: float) -> bool:
+        inserted = self.conn.execute(
+            "INSERT OR IGNORE INTO mensajes_procesados (message_id, visto_en, trabajo) VALUES (?, ?, ?)", (message_id, now, job_id)
+        ).rowcount
+        if not inserted and job_id is not None:
+            # Mismo trabajo de la cola ejecutándose otra vez tras una caída: el mensaje sigue siendo suyo
+            inserted = self.conn.execute(
+                "SELECT 1 FROM mensajes_procesados WHERE message_id = ? AND trabajo = ? AND terminado = 0", (message_id, job_id)
+            ).fetchone() is not None
+            if inserted:
+                self.stats["reclaimed_same_job"] += 1
+        return bool(inserted)
+
+    async def complete(self, message_id: str):
+        await self.run(self.conn.execute, "UPDATE mensajes_procesados SET terminado = 1 WHERE message_id = ?", (message_id,))
+
+    async def release(self, message_id: str):
+        """Olvida un id para que un reintento pueda volver a procesarlo."""
+        self.local_ids.discard(message_id) # El anillo conserva la entrada; al salir solo hace discard.
+        await self.run(self.conn.execute, "DELETE FROM mensajes_procesados WHERE message_id = ?", (message_id,))
+
+    def sweep(self, now: float | None = None) -> int:
+        cutoff = (now or time.time()) - MESSAGE_DEDUPE_TTL_SECONDS
+        return self.conn.execute(
+            "DELETE FROM mensajes_procesados WHERE message_id IN "
+            "(SELECT message_id FROM mensajes_procesados WHERE visto_en < ? LIMIT 5000)", (cutoff,)
+        ).rowcount
+
+    def snapshot(self) -> dict:
+        return {"local_ids": len(self.local_ids), "stats": dict(self.stats)}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.conn.close()
+
+message_dedupe = MessageDedupe(MESSAGE_DEDUPE_DB, MESSAGE_DEDUPE_LOCAL_SIZE)
+
+class TokenBucket:
+    """Límite de tasa: rate tokens por segundo con ráfagas de hasta burst.
+
+    acquire() reserva su token aunque el balance quede negativo y duerme lo que le toca,
+    así que varios que esperan a la vez salen espaciados en vez de todos juntos.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+
+    async def acquire(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        if self.tokens >= 0 or self.rate <= 0:
+            return 0.0
+        wait = -self.tokens / self.rate
+        await asyncio.sleep(wait)
+        return wait
+
+class WhatsAppSender:
+    """Envía los mensajes salientes en segundo plano para no alargar el turno del usuario.
+
+    - Cola FIFO por destinatario y un solo envío en vuelo por destinatario: el orden se
+      conserva, mientras que destinatarios distintos se envían en paralelo (hasta `workers`,
+      multiplexados sobre HTTP/2 cuando está disponible).
+    - TokenBucket global para no pasar el límite de mensajes por segundo del número.
+    - 429/5xx y errores de red se reintentan con backoff (respetando Retry-After) sin ocupar
+      un worker; el resto de mensajes del destinatario espera detrás para no desordenarse.
+    - Con WHATSAPP_SEND_COALESCE los textos que ya esperan al mismo destinatario se unen.
+    """
+
+    RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, client_getter, workers: int, rate: float, burst: int):
+        self.client_getter = client_getter
+        self.workers = max(1, workers)
+        self.bucket = TokenBucket(rate, burst)
+        self.pending: dict[str, deque] = {} # destinatario -> [(texto, encolado_en, intento, correlation id)]
+        self.ready: asyncio.Queue = asyncio.Queue() # destinatarios con mensajes y nada en vuelo
+        self.dispatchers: list[asyncio.Task] = []
+        self.unfinished = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.stats = Counter()
+        self.seconds = Counter() # Sumas de tiempos: throttle, upstream
+        self.latencies = deque(maxlen=1000) # Segundos desde encolar hasta la respuesta de Graph
+
+    def start(self):
+        self.dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+
+    async def stop(self, drain_seconds: float):
+        if self.unfinished:
+            try:
+                await asyncio.wait_for(self.idle.wait(), drain_seconds)
+            except asyncio.TimeoutError:
+                whatsapp_log.warning("%s mensaje(s) de WhatsApp sin enviar al apagar.", self.unfinished)
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        await asyncio.gather(*self.dispatchers, return_exceptions=True)
+        self.dispatchers.clear()
+
+    def enqueue(self, to: str, text: str):
+        if not self.dispatchers:
+            self.start()
+        self.stats["enqueued"] += 1
+        self.unfinished += 1
+        self.idle.clear()
+        recipient_queue = self.pending.get(to)
+        if recipient_queue is None:
+            recipient_queue = self.pending[to] = deque()
+            self.ready.put_nowait(to)
+        recipient_queue.append((text, time.monotonic(), 0, current_correlation_id.get()))
+
+    def _finish(self, to: str, messages: int):
+        self.unfinished -= messages
+        if self.pending[to]:
+            self.ready.put_nowait(to)
+        else:
+            del self.pending[to]
+        if not self.unfinished:
+            self.idle.set()
+
+    def _retry_delay(self, attempt: int, response: httpx.Response | None) -> float:
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), 60.0)
+        return random.uniform(0, WHATSAPP_SEND_RETRY_BASE_SECONDS * (2 ** attempt)) # full jitter
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            to = await self.ready.get()
+            recipient_queue = self.pending[to]
+            text, enqueued_at, attempt, correlation_id = recipient_queue.popleft()
+            messages = 1
+            while WHATSAPP_SEND_COALESCE and recipient_queue and len(text) + 2 + len(recipient_queue[0][0]) <= WHATSAPP_TEXT_MAX_CHARS:
+                text = f"{text}\n\n{recipient_queue.popleft()[0]}"
+                messages += 1
+                self.stats["coalesced"] += 1
+            self.seconds["throttle"] += await self.bucket.acquire()
+            correlation_token = current_correlation_id.set(correlation_id) # Los registros del envío van con el mensaje que lo originó
+            try:
+                retry_in = await self._post(to, text, attempt)
+            finally:
+                current_correlation_id.reset(correlation_token)
+            if retry_in is None:
+                self.latencies.append(time.monotonic() - enqueued_at)
+                STAGE_WHATSAPP_DELIVERY.observe(self.latencies[-1])
+                self._finish(to, messages)
+                continue
+            # El destinatario queda fuera de `ready` hasta el reintento: nada suyo se adelanta.
+            recipient_queue.appendleft((text, enqueued_at, attempt + 1, correlation_id))
+            self.unfinished -= messages - 1
+            loop.call_later(retry_in, self.ready.put_nowait, to)
+
+    async def _post(self, to: str, text: str, attempt: int) -> float | None:
+        """Hace un intento de envío. None = terminado (enviado o descartado); si no, segundos hasta reintentar."""
+        url = f"{GRAPH_API_URL}/{PHONE_NUMBER_ID}/messages"
+        headers = {"Authorization": f"Bearer {ACCESS_TOKEN}", "Content-Type": "application/json"}
+        payload = {"messaging_product": "whatsapp", "to": to, "type": "text", "text": {"body": text}}
+        response = None
+        started = time.perf_counter()
+        try:
+            with STAGE_WHATSAPP_SEND.time():
+                response = await self.client_getter().post(url, json=payload, headers=headers)
+                self.seconds["upstream"] += time.perf_counter() - started
+                response.raise_for_status()
+            self.stats["sent"] += 1
+            whatsapp_log.debug("Mensaje enviado a %s: '%s...' (Estado: %s)", to, text[:50], response.status_code)
+            return None
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in self.RETRYABLE_STATUS:
+                self.stats["failed_rejected"] += 1
+                whatsapp_log.error("Error al enviar mensaje a WhatsApp (%s): %s - %s", to, e.response.status_code, e.response.text)
+                return None
+            error = f"{e.response.status_code} - {e.response.text}"
+        except httpx.RequestError as e:
+            error = f"error de red: {e}"
+        except Exception as e:
+            self.stats["failed_unexpected"] += 1
+            whatsapp_log.error("Error inesperado al enviar mensaje a WhatsApp (%s): %s", to, e)
+            return None
+        if attempt >= WHATSAPP_SEND_MAX_RETRIES:
+            self.stats["failed_retries_exhausted"] += 1
+            whatsapp_log.error("Error al enviar mensaje a WhatsApp (%s) tras %s intentos: %s", to, attempt + 1, error)
+            return None
+        self.stats["retries"] += 1
+        return self._retry_delay(attempt, response)
+
+    def snapshot(self) -> dict:
+        latencies = sorted(self.latencies)
+        def percentile(q):
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))], 3) if latencies else None
+        return {
+            "unfinished": self.unfinished,
+            "recipients_pending": len(self.pending),
+            "stats": dict(self.stats),
+            "seconds": {k: round(v, 3) for k, v in self.seconds.items()},
+            "latency_p50": percentile(0.5),
+            "latency_p99": percentile(0.99),
+        }
+
+whatsapp_sender = WhatsAppSender(lambda: http_client, WHATSAPP_SEND_WORKERS, WHATSAPP_SEND_RATE_PER_SECOND, WHATSAPP_SEND_BURST)
 
 async def send_whatsapp_message(to: str, text: str):
-    global http_client
+    """Encola el texto para `to` y vuelve de inmediato; whatsapp_sender lo envía en orden."""
     if not http_client:
-        print("Error: El cliente HTTP no está inicializado.")
+        whatsapp_log.error("El cliente HTTP no está inicializado.")
         return
     if not ACCESS_TOKEN or not PHONE_NUMBER_ID:
-        print("Error: ACCESS_TOKEN o PHONE_NUMBER_ID no configurados.")
+        whatsapp_log.error("ACCESS_TOKEN o PHONE_NUMBER_ID no configurados.")
         return
+    whatsapp_sender.enqueue(to, text)
 
-    url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}", "Content-Type": "application/json"}
-    payload = {"messaging_product": "whatsapp", "to": to, "type": "text", "text": {"body": text}}
 
-    try:
-        response = await http_client.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        print(f"Mensaje enviado a {to}: '{text[:50]}...' (Estado: {response.status_code})")
-    except httpx.HTTPStatusError as e:
-        print(f"Error al enviar mensaje a WhatsApp ({to}): {e.response.status_code} - {e.response.text}")
-    except httpx.RequestError as e:
-        print(f"Error de red al enviar mensaje a WhatsApp ({to}): {e}")
-    except Exception as e:
-        print(f"Error inesperado en send_whatsapp_message ({to}): {e}")
+# --- Gateway de LLM (llm.py) ---
+llm_gateway = LLMGateway(lambda: http_client, DEEPSEEK_API_URL, lambda: DEEPSEEK_API_KEY)
+
+# --- Prompts de DeepSeek ---
+class PromptTemplate:
+    """Prompt de un modo de análisis.
+
+    system_prefix es el texto de sistema estático: se arma una sola vez al importar y se
+    envía siempre como el mismo objeto str, así el prefijo es idéntico byte a byte entre
+    llamadas (el caché de prefijos de DeepSeek puede reutilizarlo). Lo que depende del
+    usuario va en profile_template (un segundo mensaje de sistema) y en user_template.
+    """
+
+    __slots__ = ("system_prefix", "profile_template", "user_template")
 
+    def __init__(self, system_prefix: str, profile_template: str | None = None, user_template: str = "{mensaje}"):
+        self.system_prefix = system_prefix
+        self.profile_template = profile_template
+        self.user_template = user_template
 
-async def analyze_with_deepseek(message_text: str, mode: str, user_profile: dict = None) -> str | None:
+    def render_messages(self, message_text: str, fields: dict) -> list[dict]:
+        messages = [{"role": "system", "content": self.system_prefix}]
+        if self.profile_template:
+            messages.append({"role": "system", "content": self.profile_template.format_map(fields)})
+        if self.user_template == "{mensaje}":
+            messages.append({"role": "user", "content": message_text})
+        else:
+            messages.append({"role": "user", "content": self.user_template.format_map({**fields, "mensaje": message_text})})
+        return messages
+
+PROMPT_PROFILE_TEMPLATE = (
+    "PERFIL DEL USUARIO ACTUAL: Nombre: {nombre}, Edad: {edad}, Nivel de conocimiento en ciberseguridad: {conocimiento}.\n"
+    "Donde las instrucciones dicen [nombre], usa el nombre del usuario: {nombre}."
+)
+
+PROMPT_PROFILE_TONE_RULES = (
+    "INSTRUCCIONES DE TONO Y LENGUAJE:\n"
+    "- Siempre dirígete al usuario por su nombre de forma natural al inicio o cuando sea apropiado.\n"
+    "- Usa un tono cálido, paciente y tranquilizador. Muchos usuarios pueden estar preocupados o no entender bien estos temas.\n"
+    "- Utiliza emojis con moderación para añadir claridad y amabilidad (ej: ✅, ⚠️, 🤔, 🛡️, 👍, 😊).\n"
+    "- Si el usuario es un adulto mayor (60+ años) o su conocimiento es 'No': Explica las cosas como si hablaras con un familiar querido, con mucha paciencia. Usa frases cortas, lenguaje MUY sencillo, ejemplos cotidianos. Evita TOTALMENTE la jerga técnica. Sé muy paso a paso.\n"
+    "- Si el conocimiento del usuario es 'Poco': Usa un lenguaje claro, intermedio, con ejemplos sencillos. Evita tecnicismos innecesarios.\n"
+    "- Si el conocimiento del usuario es 'Sí': Puedes ser un poco más directo y usar algún término técnico si es relevante, pero siempre prioriza la claridad y un tono amable y respetuoso.\n\n"
+)
+
+def build_prompt_registry() -> dict[str, PromptTemplate]:
+    """Arma (una sola vez) las plantillas de todos los modos de analyze_with_deepseek."""
+    return {
+        "nombre": PromptTemplate(
+            "Eres un experto en extraer nombres de personas de un texto. El usuario te dará un mensaje donde se espera que esté su nombre.\n"
+            "Analiza la entrada y responde SOLO con una de estas opciones:\n"
+            "- Si encuentras un nombre de persona claro y plausible, responde con: NOMBRE_VALIDO:{nombre_extraido} (ej. NOMBRE_VALIDO:Carlos, NOMBRE_VALIDO:Maria Eugenia).\n"
+            "- Si el texto NO parece ser un nombre de persona (ej. 'gato', '123', 'no quiero decirlo'), responde con: NOMBRE_INVALIDO\n"
+            "- Si el texto es ambiguo, muy corto, o no estás seguro si es un nombre real (ej. 'si', 'ok', 'xyz'), responde con: NOMBRE_CONFUSO\n"
+            "No expliques nada más. Sé estricto con los nombres, deben parecer reales."
+        ),
+        "edad": PromptTemplate(
+            "Eres un experto en procesamiento de lenguaje natural para extraer la edad de una persona de un texto. El usuario te dará un mensaje donde se espera que indique su edad.\n"
+            "La edad puede venir como número ('35'), con palabras ('sesenta años', 'tengo cuarenta y dos'), o de forma más informal.\n"
+            "Analiza la entrada y responde SOLO con una de estas opciones:\n"
+            "- Si puedes extraer un número de edad plausible (entre 5 y 120 años), responde con: EDAD_VALIDA:{numero_edad} (ej. EDAD_VALIDA:65, EDAD_VALIDA:30).\n"
+            "- Si el texto claramente indica que no es una edad o es basura (ej. 'gato', 'no sé', 'ayer comí pollo'), responde con: EDAD_INVALIDA\n"
+            "- Si el texto es ambiguo, no estás seguro de poder extraer un número de edad correcto, o parece una respuesta evasiva (ej. 'unos cuantos', 'joven', 'prefiero no decir'), responde con: EDAD_NO_CLARA\n"
+            "No expliques nada más. Intenta ser flexible con la forma en que se expresa la edad, pero asegúrate de que el número sea razonable."
+        ),
+        "conocimiento": PromptTemplate(
+            "Clasifica el siguiente texto SOLO como una de estas opciones: 'Sí', 'No', 'Poco' o 'CONOCIMIENTO_AMBIGUO'.\n"
+            "El usuario está respondiendo a la pregunta '¿qué tanto sabes sobre ciberseguridad y estafas en línea?'.\n"
+            "- 'Sí': si dice que sabe, tiene experiencia, entiende bien, etc.\n"
+            "- 'No': si dice que no sabe, no entiende, es nuevo en esto, etc.\n"
+            "- 'Poco': si dice que sabe un poquito, más o menos, algo, regular, etc.\n"
+            "- 'CONOCIMIENTO_AMBIGUO': si la respuesta es muy vaga, evasiva, una pregunta como 'qué?' o 'no entiendo la pregunta', o no se puede clasificar claramente en las anteriores (ej. 'depende', 'a veces', 'gracias'). Ten especial cuidado con respuestas cortas que no sean claramente afirmativas o negativas sobre su conocimiento.\n"
+            "No expliques nada más. Solo una de las cuatro opciones."
+        ),
+        "intencion": PromptTemplate(
+            "Eres un asistente inteligente para WhatsApp. Tu tarea es analizar el siguiente mensaje de un usuario y determinar su intención principal. "
+            "El usuario ya está registrado.\n"
+            "Si el mensaje contiene un saludo (como 'gracias', 'hola') Y TAMBIÉN una pregunta o comando claro, prioriza la pregunta o comando como la intención principal.\n"
+            "Responde SOLO con una de estas opciones (una sola palabra, en minúsculas y sin explicaciones adicionales):\n"
+            "- saludo: si el mensaje ES PRINCIPALMENTE un saludo o una interacción social simple (ej: solo 'hola', solo 'gracias', 'ok', 'de nada').\n"
+            "- analizar: si el usuario quiere que analices un mensaje de texto, el contenido de una imagen, o cualquier cosa que le parezca sospechosa de ser una estafa, phishing, fraude, o que contenga información engañosa.\n"
+            "- pregunta_seguridad: si el usuario está haciendo una pregunta específica sobre ciberseguridad, cómo protegerse, qué es un tipo de estafa, etc. (que no sea simplemente reenviar un mensaje para analizar y no sea una pregunta sobre cómo usar el bot).\n"
+            "- meta_pregunta: si el usuario está haciendo una pregunta sobre el bot mismo, sus capacidades, o cómo interactuar con él.\n"
+            "- solicitar_tip_seguridad: si el usuario pide un consejo, tip o recomendación general de seguridad.\n"
+            "- comando_reset: si el usuario quiere cancelar la operación actual y volver al inicio.\n"
+            "- irrelevante: si el mensaje no tiene relación con los temas anteriores.\n\n"
+            "Prioriza 'analizar' si el texto del mensaje parece ser el contenido de un mensaje sospechoso. "
+            "Si hay un saludo y una pregunta de seguridad, la intención es 'pregunta_seguridad'."
+        ),
+        "phishing": PromptTemplate(
+            "Eres SecurityBot-WA, un asistente de seguridad digital en Colombia, muy AMABLE, EMPÁTICO y CLARO. Te diriges al usuario cuyo perfil se indica al final.\n"
+            "Tu misión es revisar el siguiente mensaje y determinar si parece una estafa digital (phishing, smishing, etc.). Luego, crea una respuesta adaptada al perfil del usuario.\n\n"
+            + PROMPT_PROFILE_TONE_RULES +
+            "**NOTA ESPECIAL SOBRE TEXTO DE IMÁGENES (OCR)**: El mensaje que vas a analizar podría provenir de una imagen y haber sido transcrito por un sistema OCR. Esto significa que PUEDE CONTENER ERRORES, letras o palabras extrañas, o texto mal formado. Por favor, TEN MUCHA PACIENCIA con estos errores e INTENTA INTERPRETAR LA INTENCIÓN Y EL CONTENIDO PRINCIPAL del texto original a pesar de las posibles imperfecciones de la transcripción antes de realizar tu análisis de seguridad. No te enfoques en los errores de OCR, sino en el mensaje subyacente que el usuario quiso compartir.\n\n"
+            "INSTRUCCIONES PARA LA RESPUESTA:\n"
+            "Tu respuesta DEBE estar estructurada en dos partes, separadas por la cadena '---DETALLES_SIGUEN---'.\n"
+            "PARTE 1 (Resumen Breve): Antes del separador '---DETALLES_SIGUEN---', proporciona un resumen MUY BREVE y directo (1-5 frases) sobre el mensaje analizado. Indica el riesgo principal (ej: '*Resumen Breve*:\\n[nombre], este mensaje parece una estafa de tipo suplantación de identidad.' o '*Resumen Breve*:\\n[nombre], en principio, este mensaje no parece ser una estafa.'). NO DES NINGUNA EXPLICACIÓN DETALLADA AQUÍ. El bot preguntará al usuario si desea más detalles después de este resumen.\n"
+            "PARTE 2 (Análisis Completo): Después del separador '---DETALLES_SIGUEN---', incluye el análisis completo y detallado, manteniendo la siguiente estructura OBLIGATORIA:\n"
+            "🔍 *Análisis del mensaje recibido*\n"
+            "✅ *Resultado*: (Sí, parece una estafa / No, no parece una estafa / No estoy seguro, pero te doy recomendaciones)\n"
+            "⚠️ *Tipo de estafa*: (Phishing, Smishing, Vishing, Fraude de soporte técnico, Suplantación de identidad, Malware, Sorteo falso, etc. o 'No aplica si no es estafa')\n"
+            "📌 *Mi opinión detallada*: (Explica POR QUÉ llegaste a esa conclusión, adaptando la explicación al perfil del usuario. Señala las pistas o elementos sospechosos, o por qué no parece peligroso).\n"
+            "🧠 *¿Cómo suelen funcionar estos engaños?* (Si es una estafa, explica brevemente el mecanismo de forma sencilla y adaptada al perfil. Si no es estafa, puedes omitir esta parte o dar un consejo general breve).\n"
+            "🛡️ *Mis recomendaciones para ti, [nombre]*: (Consejos CLAROS, ÚTILES y FÁCILES de seguir. Si es estafa, qué hacer ahora. Si no lo es, cómo mantenerse alerta en general).\n\n"
+            "IMPORTANTE (para la PARTE 2):\n"
+            "- Si el análisis concluye que ES UNA ESTAFA (o altamente sospechoso), DEBES terminar tu respuesta (la PARTE 2) preguntando de forma amable: '[nombre], ¿llegaste a hacer clic en algún enlace de ese mensaje, descargaste algo o compartiste información personal? Puedes responderme SÍ o NO. Si necesitas ayuda más específica sobre qué hacer si interactuaste, escribe AYUDA. ¡Estoy aquí para apoyarte! 😊'\n"
+            "- Si NO ES UNA ESTAFA, finaliza la PARTE 2 con un mensaje positivo y de prevención general, por ejemplo: '¡Sigue así de alerta, [nombre]! Recuerda siempre desconfiar y verificar. 👍'\n"
+            "- No uses saludos genéricos como 'Hola'. Ya te estás dirigiendo al usuario por su nombre.\n"
+            "- El nombre del usuario viene como el marcador {{NOMBRE_USUARIO}}: escríbelo así, tal cual, cada vez que uses el nombre.",
+            PROMPT_PROFILE_TEMPLATE,
+            "Por favor, {nombre} me envió este mensaje para analizarlo: \"{mensaje}\"{pistas}"
+        ),
+        "decision_ver_detalles": PromptTemplate(
+            "Eres un clasificador de intenciones para un chatbot de WhatsApp. El bot acaba de dar un resumen de un análisis de seguridad (phishing/estafa) y preguntó al usuario si quiere ver los detalles completos.\n"
+            "El usuario ha respondido. Tu tarea es determinar si la respuesta del usuario significa que SÍ quiere ver los detalles, o si está diciendo OTRA COSA (una nueva pregunta, un comentario no relacionado, etc.).\n"
+            "Considera que el usuario podría ser una persona mayor, así que sé flexible con respuestas afirmativas.\n\n"
+            "Responde SOLO con una de estas dos opciones:\n"
+            "- QUIERE_DETALLES: Si el usuario expresa afirmativamente que quiere ver los detalles. Ejemplos: \"Sí\", \"Claro\", \"Bueno\", \"Ok\", \"Mándamelos\", \"Más información por favor\", \"Sí quiero los detalles\", \"Dale\", \"Más\", \"Bueno sí\", \"A ver\", \"Quiero saber más\", \"Explícame\", \"Sí, por favor\", \"si\", \"mas informacion\".\n"
+            "- OTRA_COSA: Si la respuesta del usuario NO es una clara afirmación para ver los detalles. Ejemplos: \"¿Y eso es peligroso?\", \"No gracias\", \"Qué es phishing?\", \"Entendido\", \"Ok gracias\", \"Y si ya abrí el enlace?\", o cualquier otra pregunta o comentario.\n\n"
+            "No expliques nada más. Solo QUIERE_DETALLES u OTRA_COSA."
+        ),
+        "decision_post_phishing_interaction": PromptTemplate(
+            "Eres un clasificador de intenciones para un chatbot de WhatsApp llamado SecurityBot-WA. El bot acaba de determinar que un mensaje era una estafa y le preguntó al usuario si interactuó con ella (SÍ/NO) o si necesita AYUDA.\n"
+            "El usuario ha respondido. Tu tarea es clasificar esta respuesta.\n\n"
+            "Responde SOLO con una de estas opciones:\n"
+            "- RESPUESTA_SI: Si el usuario indica afirmativamente que SÍ interactuó con la estafa (ej: \"Sí\", \"Sí hice clic\", \"Creo que sí\", \"si\", \"claro\").\n"
+            "- RESPUESTA_NO: Si el usuario indica que NO interactuó con la estafa (ej: \"No\", \"No, para nada\", \"No hice nada\", \"nop\").\n"
+            "- PIDE_AYUDA: Si el usuario explícitamente pide ayuda o usa la palabra \"AYUDA\" (o variaciones como \"ayudame\").\n"
+            "- ES_PREGUNTA: Si el usuario hace una pregunta en lugar de responder directamente SÍ/NO/AYUDA (ej: \"¿Qué es phishing?\", \"¿Cómo puedo evitar esto?\", \"¿Y si ya di mis datos?\").\n"
+            "- ES_COMENTARIO: Si el usuario hace un comentario, agradece, o da una respuesta corta que no es SÍ/NO/AYUDA ni una pregunta clara (ej: \"Gracias\", \"Ok\", \"Entendido\", \"Qué peligroso\", \"Es una estafa\").\n"
+            "- OTRA_COSA: Si la respuesta es muy ambigua, no relacionada, o no encaja en las categorías anteriores.\n\n"
+            "No expliques nada más. Solo una de las opciones listadas."
+        ),
+        "ayuda_post_estafa": PromptTemplate(
+            "Eres SecurityBot-WA, un asistente de seguridad digital en Colombia, muy AMABLE, EMPÁTICO y CLARO. Te diriges al usuario cuyo perfil se indica al final.\n"
+            "El usuario ha indicado que PUDO haber interactuado con una estafa (o ha pedido ayuda directamente) y necesita pasos específicos.\n\n"
+            "INSTRUCCIONES DE TONO Y LENGUAJE:\n"
+            "- Mantén la calma y transmite tranquilidad a [nombre]. Asegúrale que le ayudarás a tomar los siguientes pasos.\n"
+            "- Usa un lenguaje adaptado a su perfil (edad y conocimiento), similar a las instrucciones del modo 'phishing'.\n"
+            "- Proporciona pasos CLAROS, CONCISOS y ACCIONABLES que debe seguir INMEDIATAMENTE. Organiza la respuesta en pasos numerados (1️⃣, 2️⃣, 3️⃣...) o con viñetas claras (🔹) para fácil lectura.\n"
+            "- Usa emojis con moderación para guiar y tranquilizar (ej. 🆘, 🛡️, 🔑, 🏦, 💻).\n\n"
+            "QUÉ CUBRIR (adapta según lo que sea más relevante y comprensible para [nombre]):\n"
+            "1.  **No entrar en pánico:** Es el primer paso. 'Respira profundo, [nombre], vamos a ver esto juntos.'\n"
+            "2.  **Contraseñas:** 'Lo primero y más importante: cambia tus contraseñas INMEDIATAMENTE. Especialmente la de tu correo electrónico principal, tus bancos y redes sociales. Intenta que sean fuertes y diferentes para cada sitio.'\n"
+            "3.  **Bancos/Finanzas:** 'Si crees que compartiste datos de tu banco o tarjetas, llama YA MISMO a tu banco. Ellos te dirán cómo bloquear tus tarjetas o revisar si hay movimientos raros.'\n"
+            "4.  **Actividad Sospechosa:** 'Revisa con calma los últimos movimientos de tus cuentas bancarias y tu correo electrónico por si ves algo que no reconozcas.'\n"
+            "5.  **Autenticación de Dos Factores (2FA):** 'Una capa extra de seguridad muy buena es la \"verificación en dos pasos\" o 2FA. Si puedes, actívala en todas tus cuentas importantes (como WhatsApp, correo, bancos).'\n"
+            "6.  **Dispositivos:** 'Si descargaste algún archivo del mensaje sospechoso, sería bueno pasarle un antivirus a tu teléfono o computador.'\n"
+            "7.  **Reportar (Opcional, pero recomendado):** 'En Colombia, puedes reportar estos fraudes en el CAI Virtual de la Policía Nacional. Esto ayuda a que otros no caigan.'\n"
+            "8.  **No seguir interactuando:** 'Muy importante: no respondas más a ese mensaje o a quien te lo envió.'\n"
+            "9.  **Aprender del incidente:** 'Recuerda, [nombre], siempre es mejor desconfiar un poquito de mensajes inesperados que piden información o te apuran.'\n\n"
+            "Finaliza con un mensaje de apoyo, como: 'Sé que esto puede ser preocupante, [nombre], pero actuando rápido puedes protegerte mucho mejor. ¡No dudes en consultarme si tienes más preguntas o necesitas que te repita algo! Estoy aquí para ayudarte. 💪'",
+            PROMPT_PROFILE_TEMPLATE,
+            "{nombre} necesita ayuda específica tras interactuar con una posible estafa (o pidió AYUDA directamente). ¿Qué pasos concretos y amables debe seguir?"
+        ),
+        "cyber_pregunta": PromptTemplate(
+            "Eres SecurityBot-WA, un experto en ciberseguridad y fraudes digitales en Colombia, muy AMABLE, EDUCATIVO y PACIENTE. Te diriges al usuario cuyo perfil se indica al final.\n\n"
+            "INSTRUCCIONES DE TONO Y LENGUAJE:\n"
+            "- Dirígete al usuario por su nombre de forma natural.\n"
+            "- Adapta tu lenguaje a su perfil (edad y conocimiento), similar a las instrucciones del modo 'phishing'. Explica conceptos complejos de forma sencilla.\n"
+            "- Usa un tono positivo y alentador. El objetivo es educar y empoderar.\n"
+            "- Usa emojis con moderación para hacer la explicación más amena (ej. 💡, 🛡️, 🤔, 👍, 😊).\n\n"
+            "**NOTA ESPECIAL SOBRE TEXTO DE IMÁGENES (OCR)**: La pregunta del usuario podría provenir de una imagen y haber sido transcrita por un sistema OCR. Esto significa que PUEDE CONTENER ERRORES. Intenta inferir la pregunta real del usuario a pesar de las imperfecciones antes de responder.\n\n"
+            "ESTRUCTURA DE LA RESPUESTA:\n"
+            "1.  Empieza con un saludo amable y reconociendo su pregunta, ej: '¡Hola, [nombre]! Claro, con gusto te explico sobre [tema de la pregunta]. 😊'\n"
+            "2.  Explica el concepto o responde la pregunta de forma clara, concisa y adaptada. Si la pregunta parece referirse a la 'Última URL analizada' del perfil, considera ese contexto en tu respuesta.\n"
+            "3.  Si es apropiado, da ejemplos sencillos o analogías.\n"
+            "4.  Ofrece 1-2 consejos prácticos relacionados con la pregunta.\n"
+            "5.  Finaliza invitando al usuario a hacer más preguntas si las tiene: 'Espero que esto te sea útil, [nombre]. ¡Si tienes más dudas, no dudes en preguntar! 🛡️'",
+            PROMPT_PROFILE_TEMPLATE + "\nÚltima URL analizada (si aplica y la pregunta parece relacionada): {last_url}.",
+            "{nombre} tiene la siguiente pregunta sobre ciberseguridad: \"{mensaje}\""
+        ),
+    }
+
+PROMPT_REGISTRY = build_prompt_registry()
+
+def build_deepseek_payload(message_text: str, mode: str, user_profile: dict = None, hints: str = "") -> dict | None:
+    """Arma el payload de chat completions para el modo indicado (None si el modo no existe).
+
+    Solo se interpolan los campos del perfil y las pistas locales (hints, p. ej. la revisión
+    de los enlaces); los prompts de sistema vienen de PROMPT_REGISTRY.
+    """
+    template = PROMPT_REGISTRY.get(mode)
+    if template is None:
+        return None
+    if user_profile is None: user_profile = {}
+    fields = {
+        "nombre": user_profile.get('nombre') or 'usuario',
+        "edad": user_profile.get('edad') or 'Desconocida',
+        "conocimiento": user_profile.get('conocimiento') or 'Desconocido',
+        "last_url": user_profile.get('last_analyzed_url') or 'Ninguna', # Para el prompt de cyber_pregunta
+        "pistas": hints,
+    }
+    return {"model": "deepseek-chat", "messages": template.render_messages(message_text, fields), "temperature": 0.4, "max_tokens": 1600}
+
+async def analyze_with_deepseek(message_text: str, mode: str, user_profile: dict = None, hints: str = "") -> str | None:
     global http_client
     if not http_client:
-        print("Error: El cliente HTTP no está inicializado.")
+        llm_log.error("El cliente HTTP no está inicializado.")
         return "Lo siento, el servicio de análisis no está disponible en este momento (cliente no listo)."
     if not DEEPSEEK_API_KEY:
-        print("Error: DEEPSEEK_API_KEY no configurado.")
+        llm_log.error("DEEPSEEK_API_KEY no configurado.")
         return "Lo siento, el servicio de análisis no está disponible en este momento."
-    if user_profile is None: user_profile = {}
 
-    user_name_for_prompt = user_profile.get('nombre', 'usuario')
-    last_url_context = user_profile.get('last_analyzed_url', 'Ninguna') # Para el prompt de cyber_pregunta
-
-    prompts_config = {
-        "nombre": {
-             "system": (
-                "Eres un experto en extraer nombres de personas de un texto. El usuario te dará un mensaje donde se espera que esté su nombre.\n"
-                "Analiza la entrada y responde SOLO con una de estas opciones:\n"
-                "- Si encuentras un nombre de persona claro y plausible, responde con: NOMBRE_VALIDO:{nombre_extraido} (ej. NOMBRE_VALIDO:Carlos, NOMBRE_VALIDO:Maria Eugenia).\n"
-                "- Si el texto NO parece ser un nombre de persona (ej. 'gato', '123', 'no quiero decirlo'), responde con: NOMBRE_INVALIDO\n"
-                "- Si el texto es ambiguo, muy corto, o no estás seguro si es un nombre real (ej. 'si', 'ok', 'xyz'), responde con: NOMBRE_CONFUSO\n"
-                "No expliques nada más. Sé estricto con los nombres, deben parecer reales."
-            ),
-            "user": message_text
-        },
-        "edad": {
-            "system": (
-                "Eres un experto en procesamiento de lenguaje natural para extraer la edad de una persona de un texto. El usuario te dará un mensaje donde se espera que indique su edad.\n"
-                "La edad puede venir como número ('35'), con palabras ('sesenta años', 'tengo cuarenta y dos'), o de forma más informal.\n"
-                "Analiza la entrada y responde SOLO con una de estas opciones:\n"
-                "- Si puedes extraer un número de edad plausible (entre 5 y 120 años), responde con: EDAD_VALIDA:{numero_edad} (ej. EDAD_VALIDA:65, EDAD_VALIDA:30).\n"
-                "- Si el texto claramente indica que no es una edad o es basura (ej. 'gato', 'no sé', 'ayer comí pollo'), responde con: EDAD_INVALIDA\n"
-                "- Si el texto es ambiguo, no estás seguro de poder extraer un número de edad correcto, o parece una respuesta evasiva (ej. 'unos cuantos', 'joven', 'prefiero no decir'), responde con: EDAD_NO_CLARA\n"
-                "No expliques nada más. Intenta ser flexible con la forma en que se expresa la edad, pero asegúrate de que el número sea razonable."
-            ),
-            "user": message_text
-        },
-        "conocimiento": {
-             "system": (
-                "Clasifica el siguiente texto SOLO como una de estas opciones: 'Sí', 'No', 'Poco' o 'CONOCIMIENTO_AMBIGUO'.\n"
-                "El usuario está respondiendo a la pregunta '¿qué tanto sabes sobre ciberseguridad y estafas en línea?'.\n"
-                "- 'Sí': si dice que sabe, tiene experiencia, entiende bien, etc.\n"
-                "- 'No': si dice que no sabe, no entiende, es nuevo en esto, etc.\n"
-                "- 'Poco': si dice que sabe un poquito, más o menos, algo, regular, etc.\n"
-                "- 'CONOCIMIENTO_AMBIGUO': si la respuesta es muy vaga, evasiva, una pregunta como 'qué?' o 'no entiendo la pregunta', o no se puede clasificar claramente en las anteriores (ej. 'depende', 'a veces', 'gracias'). Ten especial cuidado con respuestas cortas que no sean claramente afirmativas o negativas sobre su conocimiento.\n"
-                "No expliques nada más. Solo una de las cuatro opciones."
-            ),
-            "user": message_text
-        },
-        "intencion": { # MODIFICADO
-            "system": (
-                "Eres un asistente inteligente para WhatsApp. Tu tarea es analizar el siguiente mensaje de un usuario y determinar su intención principal. "
-                "El usuario ya está registrado.\n"
-                "Si el mensaje contiene un saludo (como 'gracias', 'hola') Y TAMBIÉN una pregunta o comando claro, prioriza la pregunta o comando como la intención principal.\n"
-                "Responde SOLO con una de estas opciones (una sola palabra, en minúsculas y sin explicaciones adicionales):\n"
-                "- saludo: si el mensaje ES PRINCIPALMENTE un saludo o una interacción social simple (ej: solo 'hola', solo 'gracias', 'ok', 'de nada').\n"
-                "- analizar: si el usuario quiere que analices un mensaje de texto, el contenido de una imagen, o cualquier cosa que le parezca sospechosa de ser una estafa, phishing, fraude, o que contenga información engañosa.\n"
-                "- pregunta_seguridad: si el usuario está haciendo una pregunta específica sobre ciberseguridad, cómo protegerse, qué es un tipo de estafa, etc. (que no sea simplemente reenviar un mensaje para analizar y no sea una pregunta sobre cómo usar el bot).\n"
-                "- meta_pregunta: si el usuario está haciendo una pregunta sobre el bot mismo, sus capacidades, o cómo interactuar con él.\n"
-                "- solicitar_tip_seguridad: si el usuario pide un consejo, tip o recomendación general de seguridad.\n"
-                "- comando_reset: si el usuario quiere cancelar la operación actual y volver al inicio.\n"
-                "- irrelevante: si el mensaje no tiene relación con los temas anteriores.\n\n"
-                "Prioriza 'analizar' si el texto del mensaje parece ser el contenido de un mensaje sospechoso. "
-                "Si hay un saludo y una pregunta de seguridad, la intención es 'pregunta_seguridad'."
-            ),
-            "user": message_text
-        },
-        "phishing": {
-            "system": (
-                f"Eres SecurityBot-WA, un asistente de seguridad digital en Colombia, muy AMABLE, EMPÁTICO y CLARO. Te diriges al usuario {user_name_for_prompt}.\n"
-                f"Tu misión es revisar el siguiente mensaje y determinar si parece una estafa digital (phishing, smishing, etc.). Luego, crea una respuesta adaptada al perfil del usuario.\n\n"
-                f"PERFIL DEL USUARIO ACTUAL: Nombre: {user_name_for_prompt}, Edad: {user_profile.get('edad', 'Desconocida')}, Nivel de conocimiento en ciberseguridad: {user_profile.get('conocimiento', 'Desconocido')}.\n\n"
-                "INSTRUCCIONES DE TONO Y LENGUAJE:\n"
-                f"- Siempre dirígete al usuario por su nombre ({user_name_for_prompt}) de forma natural al inicio o cuando sea apropiado.\n"
-                "- Usa un tono cálido, paciente y tranquilizador. Muchos usuarios pueden estar preocupados o no entender bien estos temas.\n"
-                "- Utiliza emojis con moderación para añadir claridad y amabilidad (ej: ✅, ⚠️, 🤔, 🛡️, 👍, 😊).\n"
-                f"- Si {user_name_for_prompt} es un adulto mayor (60+ años) o su conocimiento es 'No': Explica las cosas como si hablaras con un familiar querido, con mucha paciencia. Usa frases cortas, lenguaje MUY sencillo, ejemplos cotidianos. Evita TOTALMENTE la jerga técnica. Sé muy paso a paso.\n"
-                f"- Si el conocimiento de {user_name_for_prompt} es 'Poco': Usa un lenguaje claro, intermedio, con ejemplos sencillos. Evita tecnicismos innecesarios.\n"
-                f"- Si el conocimiento de {user_name_for_prompt} es 'Sí': Puedes ser un poco más directo y usar algún término técnico si es relevante, pero siempre prioriza la claridad y un tono amable y respetuoso.\n\n"
-                "**NOTA ESPECIAL SOBRE TEXTO DE IMÁGENES (OCR)**: El mensaje que vas a analizar podría provenir de una imagen y haber sido transcrito por un sistema OCR. Esto significa que PUEDE CONTENER ERRORES, letras o palabras extrañas, o texto mal formado. Por favor, TEN MUCHA PACIENCIA con estos errores e INTENTA INTERPRETAR LA INTENCIÓN Y EL CONTENIDO PRINCIPAL del texto original a pesar de las posibles imperfecciones de la transcripción antes de realizar tu análisis de seguridad. No te enfoques en los errores de OCR, sino en el mensaje subyacente que {user_name_for_prompt} quiso compartir.\n\n"
-                "INSTRUCCIONES PARA LA RESPUESTA:\n"
-                "Tu respuesta DEBE estar estructurada en dos partes, separadas por la cadena '---DETALLES_SIGUEN---'.\n"
-                "PARTE 1 (Resumen Breve): Antes del separador '---DETALLES_SIGUEN---', proporciona un resumen MUY BREVE y directo (1-5 frases) sobre el mensaje analizado. Indica el riesgo principal (ej: '*Resumen Breve*:\\n{user_name_for_prompt}, este mensaje parece una estafa de tipo suplantación de identidad.' o '*Resumen Breve*:\\n{user_name_for_prompt}, en principio, este mensaje no parece ser una estafa.'). NO DES NINGUNA EXPLICACIÓN DETALLADA AQUÍ. El bot preguntará al usuario si desea más detalles después de este resumen.\n"
-                "PARTE 2 (Análisis Completo): Después del separador '---DETALLES_SIGUEN---', incluye el análisis completo y detallado, manteniendo la siguiente estructura OBLIGATORIA:\n"
-                "🔍 *Análisis del mensaje recibido*\n"
-                "✅ *Resultado*: (Sí, parece una estafa / No, no parece una estafa / No estoy seguro, pero te doy recomendaciones)\n"
-                "⚠️ *Tipo de estafa*: (Phishing, Smishing, Vishing, Fraude de soporte técnico, Suplantación de identidad, Malware, Sorteo falso, etc. o 'No aplica si no es estafa')\n"
-                "📌 *Mi opinión detallada*: (Explica POR QUÉ llegaste a esa conclusión, adaptando la explicación al perfil de {user_name_for_prompt}. Señala las pistas o elementos sospechosos, o por qué no parece peligroso).\n"
-                "🧠 *¿Cómo suelen funcionar estos engaños?* (Si es una estafa, explica brevemente el mecanismo de forma sencilla y adaptada al perfil. Si no es estafa, puedes omitir esta parte o dar un consejo general breve).\n"
-                "🛡️ *Mis recomendaciones para ti, {user_name_for_prompt}*: (Consejos CLAROS, ÚTILES y FÁCILES de seguir. Si es estafa, qué hacer ahora. Si no lo es, cómo mantenerse alerta en general).\n\n"
-                "IMPORTANTE (para la PARTE 2):\n"
-                "- Si el análisis concluye que ES UNA ESTAFA (o altamente sospechoso), DEBES terminar tu respuesta (la PARTE 2) preguntando de forma amable: '{user_name_for_prompt}, ¿llegaste a hacer clic en algún enlace de ese mensaje, descargaste algo o compartiste información personal? Puedes responderme SÍ o NO. Si necesitas ayuda más específica sobre qué hacer si interactuaste, escribe AYUDA. ¡Estoy aquí para apoyarte! 😊'\n"
-                "- Si NO ES UNA ESTAFA, finaliza la PARTE 2 con un mensaje positivo y de prevención general, por ejemplo: '¡Sigue así de alerta, {user_name_for_prompt}! Recuerda siempre desconfiar y verificar. 👍'\n"
-                "- No uses saludos genéricos como 'Hola'. Ya te estás dirigiendo a {user_name_for_prompt}."
-            ),
-            "user": f"Por favor, {user_name_for_prompt} me envió este mensaje para analizarlo: \"{message_text}\""
-        },
-        "decision_ver_detalles": {
-            "system": (
-                "Eres un clasificador de intenciones para un chatbot de WhatsApp. El bot acaba de dar un resumen de un análisis de seguridad (phishing/estafa) y preguntó al usuario si quiere ver los detalles completos.\n"
-                "El usuario ha respondido. Tu tarea es determinar si la respuesta del usuario significa que SÍ quiere ver los detalles, o si está diciendo OTRA COSA (una nueva pregunta, un comentario no relacionado, etc.).\n"
-                "Considera que el usuario podría ser una persona mayor, así que sé flexible con respuestas afirmativas.\n\n"
-                "Responde SOLO con una de estas dos opciones:\n"
-                "- QUIERE_DETALLES: Si el usuario expresa afirmativamente que quiere ver los detalles. Ejemplos: \"Sí\", \"Claro\", \"Bueno\", \"Ok\", \"Mándamelos\", \"Más información por favor\", \"Sí quiero los detalles\", \"Dale\", \"Más\", \"Bueno sí\", \"A ver\", \"Quiero saber más\", \"Explícame\", \"Sí, por favor\", \"si\", \"mas informacion\".\n"
-                "- OTRA_COSA: Si la respuesta del usuario NO es una clara afirmación para ver los detalles. Ejemplos: \"¿Y eso es peligroso?\", \"No gracias\", \"Qué es phishing?\", \"Entendido\", \"Ok gracias\", \"Y si ya abrí el enlace?\", o cualquier otra pregunta o comentario.\n\n"
-                "No expliques nada más. Solo QUIERE_DETALLES u OTRA_COSA."
-            ),
-            "user": message_text
-        },
-        "decision_post_phishing_interaction": {
-            "system": (
-                f"Eres un clasificador de intenciones para un chatbot de WhatsApp llamado SecurityBot-WA. El bot acaba de determinar que un mensaje era una estafa y le preguntó al usuario ({user_name_for_prompt}) si interactuó con ella (SÍ/NO) o si necesita AYUDA.\n"
-                "El usuario ha respondido. Tu tarea es clasificar esta respuesta.\n\n"
-                "Responde SOLO con una de estas opciones:\n"
-                "- RESPUESTA_SI: Si el usuario indica afirmativamente que SÍ interactuó con la estafa (ej: \"Sí\", \"Sí hice clic\", \"Creo que sí\", \"si\", \"claro\").\n" 
-                "- RESPUESTA_NO: Si el usuario indica que NO interactuó con la estafa (ej: \"No\", \"No, para nada\", \"No hice nada\", \"nop\").\n" 
-                "- PIDE_AYUDA: Si el usuario explícitamente pide ayuda o usa la palabra \"AYUDA\" (o variaciones como \"ayudame\").\n" 
-                "- ES_PREGUNTA: Si el usuario hace una pregunta en lugar de responder directamente SÍ/NO/AYUDA (ej: \"¿Qué es phishing?\", \"¿Cómo puedo evitar esto?\", \"¿Y si ya di mis datos?\").\n"
-                "- ES_COMENTARIO: Si el usuario hace un comentario, agradece, o da una respuesta corta que no es SÍ/NO/AYUDA ni una pregunta clara (ej: \"Gracias\", \"Ok\", \"Entendido\", \"Qué peligroso\", \"Es una estafa\").\n"
-                "- OTRA_COSA: Si la respuesta es muy ambigua, no relacionada, o no encaja en las categorías anteriores.\n\n"
-                "No expliques nada más. Solo una de las opciones listadas."
-            ),
-            "user": message_text
-        },
-        "ayuda_post_estafa": {
-            "system": (
-                f"Eres SecurityBot-WA, un asistente de seguridad digital en Colombia, muy AMABLE, EMPÁTICO y CLARO. Te diriges al usuario {user_name_for_prompt}.\n"
-                f"{user_name_for_prompt} ha indicado que PUDO haber interactuado con una estafa (o ha pedido ayuda directamente) y necesita pasos específicos.\n"
-                f"PERFIL DEL USUARIO ACTUAL: Nombre: {user_name_for_prompt}, Edad: {user_profile.get('edad', 'Desconocida')}, Nivel de conocimiento en ciberseguridad: {user_profile.get('conocimiento', 'Desconocido')}.\n\n"
-                "INSTRUCCIONES DE TONO Y LENGUAJE:\n"
-                "- Mantén la calma y transmite tranquilidad a {user_name_for_prompt}. Asegúrale que le ayudarás a tomar los siguientes pasos.\n"
-                "- Usa un lenguaje adaptado a su perfil (edad y conocimiento), similar a las instrucciones del modo 'phishing'.\n"
-                "- Proporciona pasos CLAROS, CONCISOS y ACCIONABLES que debe seguir INMEDIATAMENTE. Organiza la respuesta en pasos numerados (1️⃣, 2️⃣, 3️⃣...) o con viñetas claras (🔹) para fácil lectura.\n"
-                "- Usa emojis con moderación para guiar y tranquilizar (ej. 🆘, 🛡️, 🔑, 🏦, 💻).\n\n"
-                "QUÉ CUBRIR (adapta según lo que sea más relevante y comprensible para {user_name_for_prompt}):\n"
-                "1.  **No entrar en pánico:** Es el primer paso. 'Respira profundo, {user_name_for_prompt}, vamos a ver esto juntos.'\n"
-                "2.  **Contraseñas:** 'Lo primero y más importante: cambia tus contraseñas INMEDIATAMENTE. Especialmente la de tu correo electrónico principal, tus bancos y redes sociales. Intenta que sean fuertes y diferentes para cada sitio.'\n"
-                "3.  **Bancos/Finanzas:** 'Si crees que compartiste datos de tu banco o tarjetas, llama YA MISMO a tu banco. Ellos te dirán cómo bloquear tus tarjetas o revisar si hay movimientos raros.'\n"
-                "4.  **Actividad Sospechosa:** 'Revisa con calma los últimos movimientos de tus cuentas bancarias y tu correo electrónico por si ves algo que no reconozcas.'\n"
-                "5.  **Autenticación de Dos Factores (2FA):** 'Una capa extra de seguridad muy buena es la \"verificación en dos pasos\" o 2FA. Si puedes, actívala en todas tus cuentas importantes (como WhatsApp, correo, bancos).'\n"
-                "6.  **Dispositivos:** 'Si descargaste algún archivo del mensaje sospechoso, sería bueno pasarle un antivirus a tu teléfono o computador.'\n"
-                "7.  **Reportar (Opcional, pero recomendado):** 'En Colombia, puedes reportar estos fraudes en el CAI Virtual de la Policía Nacional. Esto ayuda a que otros no caigan.'\n"
-                "8.  **No seguir interactuando:** 'Muy importante: no respondas más a ese mensaje o a quien te lo envió.'\n"
-                "9.  **Aprender del incidente:** 'Recuerda, {user_name_for_prompt}, siempre es mejor desconfiar un poquito de mensajes inesperados que piden información o te apuran.'\n\n"
-                f"Finaliza con un mensaje de apoyo, como: 'Sé que esto puede ser preocupante, {user_name_for_prompt}, pero actuando rápido puedes protegerte mucho mejor. ¡No dudes en consultarme si tienes más preguntas o necesitas que te repita algo! Estoy aquí para ayudarte. 💪'"
-            ),
-            "user": f"{user_name_for_prompt} necesita ayuda específica tras interactuar con una posible estafa (o pidió AYUDA directamente). ¿Qué pasos concretos y amables debe seguir?"
-        },
-        "cyber_pregunta": { # MODIFICADO para incluir contexto de URL
-            "system": (
-                f"Eres SecurityBot-WA, un experto en ciberseguridad y fraudes digitales en Colombia, muy AMABLE, EDUCATIVO y PACIENTE. Te diriges al usuario {user_name_for_prompt}.\n"
-                f"PERFIL DEL USUARIO ACTUAL: Nombre: {user_name_for_prompt}, Edad: {user_profile.get('edad', 'Desconocida')}, "
-                f"Nivel de conocimiento en ciberseguridad: {user_profile.get('conocimiento', 'Desconocido')}, "
-                f"Última URL analizada (si aplica y la pregunta parece relacionada): {last_url_context}.\n\n" # Contexto de URL añadido
-                "INSTRUCCIONES DE TONO Y LENGUAJE:\n"
-                f"- Dirígete a {user_name_for_prompt} por su nombre de forma natural.\n"
-                "- Adapta tu lenguaje a su perfil (edad y conocimiento), similar a las instrucciones del modo 'phishing'. Explica conceptos complejos de forma sencilla.\n"
-                "- Usa un tono positivo y alentador. El objetivo es educar y empoderar.\n"
-                "- Usa emojis con moderación para hacer la explicación más amena (ej. 💡, 🛡️, 🤔, 👍, 😊).\n\n"
-                "**NOTA ESPECIAL SOBRE TEXTO DE IMÁGENES (OCR)**: La pregunta de {user_name_for_prompt} podría provenir de una imagen y haber sido transcrita por un sistema OCR. Esto significa que PUEDE CONTENER ERRORES. Intenta inferir la pregunta real del usuario a pesar de las imperfecciones antes de responder.\n\n"
-                "ESTRUCTURA DE LA RESPUESTA:\n"
-                f"1.  Empieza con un saludo amable y reconociendo su pregunta, ej: '¡Hola, {user_name_for_prompt}! Claro, con gusto te explico sobre [tema de la pregunta]. 😊'\n"
-                "2.  Explica el concepto o responde la pregunta de forma clara, concisa y adaptada. Si la pregunta parece referirse a la 'Última URL analizada', considera ese contexto en tu respuesta.\n"
-                "3.  Si es apropiado, da ejemplos sencillos o analogías.\n"
-                "4.  Ofrece 1-2 consejos prácticos relacionados con la pregunta.\n"
-                f"5.  Finaliza invitando a {user_name_for_prompt} a hacer más preguntas si las tiene: 'Espero que esto te sea útil, {user_name_for_prompt}. ¡Si tienes más dudas, no dudes en preguntar! 🛡️'"
-            ),
-            "user": f"{user_name_for_prompt} tiene la siguiente pregunta sobre ciberseguridad: \"{message_text}\""
-        }
-    }
-    if mode not in prompts_config:
-        print(f"Modo de análisis no reconocido: {mode}")
+    payload = build_deepseek_payload(message_text, mode, user_profile, hints)
+    if payload is None:
+        llm_log.error("Modo de análisis no reconocido: %s", mode)
         return "Error interno: modo de análisis no válido."
 
-    current_prompt = prompts_config[mode]
-    payload = {"model": "deepseek-chat", "messages": [{"role": "system", "content": current_prompt["system"]}, {"role": "user", "content": current_prompt["user"]}], "temperature": 0.4, "max_tokens": 1600}
-    headers = {"Authorization": f"Bearer {DEEPSEEK_API_KEY}", "Content-Type": "application/json"}
-
     try:
-        response = await http_client.post(DEEPSEEK_API_URL, json=payload, headers=headers)
-        response.raise_for_status()
-        api_response = response.json()
+        with metrics.stage("llm", mode).time():
+            api_response = await llm_gateway.complete(mode, payload)
         if api_response.get("choices") and api_response["choices"][0].get("message"):
             return api_response["choices"][0]["message"]["content"].strip()
-        print(f"Respuesta inesperada de DeepSeek API: {api_response}")
+        llm_log.error("Respuesta inesperada de DeepSeek API: %s", api_response)
         return "No se pudo obtener una respuesta del servicio de análisis."
     except httpx.HTTPStatusError as e:
-        print(f"Error de API DeepSeek ({mode}): {e.response.status_code} - {e.response.text}")
+        llm_log.error("Error de API DeepSeek (%s): %s - %s", mode, e.response.status_code, e.response.text)
         return "Hubo un problema al contactar el servicio de análisis."
-    except httpx.RequestError as e: print(f"Error de red con DeepSeek API ({mode}): {e}"); return "Problema de conexión con el servicio de análisis."
-    except Exception as e: print(f"Error inesperado en analyze_with_deepseek ({mode}): {e}"); return "Lo siento, ocurrió un error inesperado."
+    except LLMUnavailableError as e:
+        llm_log.warning("DeepSeek no disponible (%s): %s", mode, e)
+        return "Lo siento, el servicio de análisis no está disponible en este momento."
+    except httpx.RequestError as e: llm_log.error("Error de red con DeepSeek API (%s): %s", mode, e); return "Problema de conexión con el servicio de análisis."
+    except Exception as e: llm_log.error("Error inesperado en analyze_with_deepseek (%s): %s", mode, e); return "Lo siento, ocurrió un error inesperado."
+
+async def stream_deepseek(message_text: str, mode: str, user_profile: dict = None, hints: str = ""):
+    """Variante SSE de analyze_with_deepseek: produce los fragmentos de texto a medida que llegan.
+
+    A diferencia de analyze_with_deepseek no traduce los errores a mensajes: los propaga
+    (httpx.HTTPStatusError, httpx.RequestError, LLMUnavailableError, ValueError) para que
+    el llamador decida.
+    """
+    payload = build_deepseek_payload(message_text, mode, user_profile, hints)
+    if payload is None:
+        raise ValueError(f"Modo de análisis no reconocido: {mode}")
+    payload["stream"] = True
+
+    async with llm_gateway.stream(mode, payload) as response:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue # Líneas vacías y comentarios keep-alive de SSE
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            choices = json.loads(data).get("choices") or []
+            if choices:
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    yield delta
+
+async def analyze_phishing_streaming(message_text: str, user_profile: dict, hints: str = "") -> tuple[str | None, asyncio.Task | None]:
+    """Pide el análisis de phishing en streaming.
+
+    Devuelve el resumen breve en cuanto llega PHISHING_DETAILS_SEPARATOR, junto con una tarea
+    que sigue leyendo la respuesta y entrega el análisis completo. Si la respuesta no trae
+    separador, la tarea es None y el texto completo hace de resumen. Ante errores devuelve el
+    mismo tipo de mensaje que analyze_with_deepseek.
+    """
+    if not http_client:
+        llm_log.error("El cliente HTTP no está inicializado.")
+        return "Lo siento, el servicio de análisis no está disponible en este momento (cliente no listo).", None
+    if not DEEPSEEK_API_KEY:
+        llm_log.error("DEEPSEEK_API_KEY no configurado.")
+        return "Lo siento, el servicio de análisis no está disponible en este momento.", None
 
-async def download_image_from_whatsapp(media_id: str) -> bytes | None:
+    chunks = stream_deepseek(message_text, "phishing", user_profile, hints)
+    buffer = ""
+    try:
+        with metrics.stage("llm", "phishing_stream").time(): # Hasta tener el resumen
+            async for delta in chunks:
+                buffer += delta
+                if PHISHING_DETAILS_SEPARATOR in buffer:
+                    break
+            else:
+                return buffer.strip() or None, None
+    except httpx.HTTPStatusError as e:
+        llm_log.error("Error de API DeepSeek (phishing, streaming): %s", e.response.status_code)
+        return "Hubo un problema al contactar el servicio de análisis.", None
+    except httpx.RequestError as e:
+        llm_log.error("Error de red con DeepSeek API (phishing, streaming): %s", e)
+        return "Problema de conexión con el servicio de análisis.", None
+    except LLMUnavailableError as e:
+        llm_log.warning("DeepSeek no disponible (phishing, streaming): %s", e)
+        return "Lo siento, el servicio de análisis no está disponible en este momento.", None
+    except Exception as e:
+        llm_log.error("Error inesperado en analyze_phishing_streaming: %s", e)
+        return "Lo siento, ocurrió un error inesperado.", None
+
+    async def read_rest() -> tuple[str, bool]:
+        full_text, complete = buffer, True
+        try:
+            async for delta in chunks:
+                full_text += delta
+        except Exception as e:
+            complete = False
+            llm_log.error("Error leyendo el resto del análisis en streaming (se usa lo recibido): %s", e)
+        finally:
+            await chunks.aclose()
+        return full_text.strip(), complete
+
+    return buffer.split(PHISHING_DETAILS_SEPARATOR, 1)[0].strip(), asyncio.create_task(read_rest())
+
+# Detalles de phishing que siguen generándose después de enviar el resumen (teléfono -> tarea)
+pending_analysis_details: dict[str, asyncio.Task] = {}
+
+async def complete_phishing_details(telefono: str, message_text: str, user_profile: dict, rest_task: asyncio.Task, is_from_image: bool) -> str:
+    """Espera el análisis completo (con el marcador del nombre), lo cachea y lo guarda en last_analysis_details. Devuelve los detalles.
+
+    rest_task entrega (análisis, vino completo de DeepSeek): el análisis local de respaldo o una
+    respuesta cortada a mitad no se cachean, porque la caché se comparte entre usuarios.
+    """
+    analisis_marcado, from_llm = await rest_task
+    if from_llm:
+        await verdict_cache.store(message_text, user_profile, analisis_marcado)
+    analisis_completo = render_verdict_name(analisis_marcado, user_profile.get("nombre"))
+    partes = analisis_completo.split(PHISHING_DETAILS_SEPARATOR, 1)
+    detalles_completos = partes[1].strip() if len(partes) > 1 else ""
+    # Solo se escribe si el usuario sigue esperando este análisis (no cambió de tema ni reinició).
+    if pending_analysis_details.get(telefono) is asyncio.current_task():
+        db_updates = {"last_analysis_details": detalles_completos}
+        if is_from_image:
+            db_updates["last_image_analysis_raw"] = analisis_completo
+        await db_update_user(telefono, db_updates)
+        del pending_analysis_details[telefono]
+    return detalles_completos
+
+def discard_pending_analysis_details(telefono: str):
+    pending_analysis_details.pop(telefono, None)
+
+class MediaDownloadError(Exception):
+    """La imagen no se pudo descargar o no pasó las validaciones (tamaño, sha256)."""
+
+async def fetch_media_info(media_id: str, headers: dict) -> dict:
+    media_info_response = await http_client.get(f"{GRAPH_API_URL}/{media_id}", headers=headers)
+    media_info_response.raise_for_status()
+    return media_info_response.json()
+
+def media_sha256_matches(expected: str, digest: bytes) -> bool:
+    # Graph documenta el sha256 en hex, pero se han visto respuestas en base64
+    expected = expected.strip()
+    return expected.lower() == digest.hex() or expected == base64.b64encode(digest).decode()
+
+async def download_image_from_whatsapp(media_id: str, dest_path: str) -> str | None:
+    """Descarga la imagen en streaming a dest_path y devuelve su sha256 en hex (None si falla).
+
+    Los bloques se escriben directo a un archivo temporal en IMAGES_DIR (nunca se tiene la
+    imagen completa en memoria; el pico real lo mide benchmark_webhook.py --descargas), se corta al superar MEDIA_MAX_BYTES y se verifica el sha256
+    que reporta Graph. Si el enlace efímero ya expiró se pide uno nuevo y se reintenta una vez.
+    """
     global http_client
-    if not http_client: print("Error: El cliente HTTP no está inicializado."); return None
-    if not ACCESS_TOKEN: print("Error: ACCESS_TOKEN no configurado."); return None
+    if not http_client: media_log.error("El cliente HTTP no está inicializado."); return None
+    if not ACCESS_TOKEN: media_log.error("ACCESS_TOKEN no configurado."); return None
 
     headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
+    temp_path = os.path.join(IMAGES_DIR, f".{uuid.uuid4().hex}.part")
     try:
-        media_info_url = f"https://graph.facebook.com/v18.0/{media_id}"
-        media_info_response = await http_client.get(media_info_url, headers=headers)
-        media_info_response.raise_for_status()
-        image_download_url = media_info_response.json()["url"]
-        image_response = await http_client.get(image_download_url, headers=headers)
-        image_response.raise_for_status()
-        return image_response.content
-    except httpx.HTTPStatusError as e: print(f"Error HTTP al descargar imagen (media_id: {media_id}): {e.response.status_code} - {e.response.text}")
-    except httpx.RequestError as e: print(f"Error de red al descargar imagen (media_id: {media_id}): {e}")
-    except Exception as e: print(f"Error inesperado en download_image_from_whatsapp (media_id: {media_id}): {e}")
+        with STAGE_MEDIA_DOWNLOAD.time():
+            media_info = await fetch_media_info(media_id, headers)
+            declared_size = int(media_info.get("file_size") or 0)
+            if declared_size > MEDIA_MAX_BYTES:
+                raise MediaDownloadError(f"tamaño declarado {declared_size} B supera el límite de {MEDIA_MAX_BYTES} B")
+
+            for attempt in range(2):
+                async with http_client.stream("GET", media_info["url"], headers=headers) as image_response:
+                    if image_response.status_code in MEDIA_URL_EXPIRED_STATUS and attempt == 0:
+                        # Enlace expirado (mismo caso que resuelve prueba.py): pedir uno nuevo y reintentar
+                        media_log.debug("Enlace de media expirado (media_id: %s, HTTP %s). Reintentando con uno nuevo.", media_id, image_response.status_code)
+                        media_info = await fetch_media_info(media_id, headers)
+                        continue
+                    image_response.raise_for_status()
+                    content_length = int(image_response.headers.get("content-length") or 0)
+                    if content_length > MEDIA_MAX_BYTES:
+                        raise MediaDownloadError(f"Content-Length {content_length} B supera el límite de {MEDIA_MAX_BYTES} B")
+
+                    sha256 = hashlib.sha256()
+                    size = 0
+                    with open(temp_path, "wb") as f:
+                        async for chunk in image_response.aiter_bytes(MEDIA_DOWNLOAD_CHUNK_BYTES):
+                            size += len(chunk)
+                            if size > MEDIA_MAX_BYTES:
+                                raise MediaDownloadError(f"la descarga superó el límite de {MEDIA_MAX_BYTES} B")
+                            sha256.update(chunk)
+                            f.write(chunk)
+                break
+
+            expected_sha256 = media_info.get("sha256")
+            if expected_sha256 and not media_sha256_matches(expected_sha256, sha256.digest()):
+                raise MediaDownloadError("el sha256 no coincide con el reportado por Graph")
+            os.replace(temp_path, dest_path)
+            media_log.debug("Imagen descargada (media_id: %s): %s B.", media_id, size)
+            return sha256.hexdigest()
+    except MediaDownloadError as e: media_log.error("Imagen rechazada (media_id: %s): %s", media_id, e)
+    except httpx.HTTPStatusError as e: media_log.error("Error HTTP al descargar imagen (media_id: %s): %s", media_id, e.response.status_code)
+    except httpx.RequestError as e: media_log.error("Error de red al descargar imagen (media_id: %s): %s", media_id, e)
+    except Exception as e: media_log.error("Error inesperado en download_image_from_whatsapp (media_id: %s): %s", media_id, e)
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
     return None
 
-async def process_incoming_image_task(telefono: str, user_data: sqlite3.Row, image_id_whatsapp: str):
+# --- OCR (ocr.py) ---
+ocr_engine = OCREngine(OCR_WORKERS, OCR_QUEUE_MAX, STAGE_OCR_QUEUE_WAIT, STAGE_OCR)
+ocr_cache = OCRCache(db)
+
+# --- Almacén de imágenes (images.py) ---
+image_store = ImageStore(db, IMAGES_DIR, db_save_image_record)
+
+async def image_store_sweep_task():
+    while True:
+        await image_store.sweep()
+        await asyncio.sleep(IMAGE_STORE_SWEEP_SECONDS)
+
+async def process_incoming_image_task(telefono: str, user_data: dict, image_id_whatsapp: str):
     user_name_for_ocr_task = user_data["nombre"] if user_data and user_data["nombre"] else "tú"
-    print(f"Iniciando tarea de procesamiento de imagen para {telefono} ({user_name_for_ocr_task}), image_id_whatsapp: {image_id_whatsapp}")
+    ocr_log.info("Iniciando tarea de procesamiento de imagen para %s (%s), image_id_whatsapp: %s", telefono, user_name_for_ocr_task, image_id_whatsapp)
 
-    image_bytes = await download_image_from_whatsapp(image_id_whatsapp)
-    if not image_bytes:
+    download_path = image_store.incoming_path()
+    image_sha256 = await download_image_from_whatsapp(image_id_whatsapp, download_path)
+    if not image_sha256:
         await send_whatsapp_message(telefono, f"⚠️ Lo siento, {user_name_for_ocr_task}, no pude descargar la imagen que enviaste. ¿Podrías intentar enviarla de nuevo o verificar que sea válida? Por favor.")
         return
 
-    image_file_name_for_db = f"{telefono}_{uuid.uuid4().hex[:8]}.jpg"
+    new_image_file = None # Ruta en el almacén si esta imagen se guardó ahora (se re-codifica al final)
     try:
-        image_path = os.path.join(IMAGES_DIR, image_file_name_for_db)
-
-        def save_and_ocr_sync(path, data_bytes):
-            with open(path, "wb") as f: f.write(data_bytes)
-            img_pil = Image.open(BytesIO(data_bytes))
-            return pytesseract.image_to_string(img_pil, lang="spa+eng").strip()
-
-        text_ocr = await asyncio.to_thread(save_and_ocr_sync, image_path, image_bytes)
+        cached, signature = await ocr_cache.lookup(image_sha256, download_path)
+        if cached and await image_store.reuse(telefono, cached[1]):
+            # Misma captura (o casi) ya procesada y todavía en el almacén: se reutilizan el texto y el archivo
+            text_ocr, image_file_name_for_db = cached
+            os.remove(download_path)
+            ocr_log.debug("OCR desde caché para %s (archivo %s).", telefono, image_file_name_for_db)
+        else:
+            image_file_name_for_db = new_image_file = await image_store.store(telefono, download_path, image_sha256)
+            image_path = image_store.path(image_file_name_for_db)
+            if cached:
+                text_ocr = cached[0]
+                ocr_log.debug("OCR desde caché para %s (archivo %s).", telefono, image_file_name_for_db)
+            else:
+                text_ocr, ocr_seconds = await ocr_engine.ocr_timed(image_path, telefono)
+                await ocr_cache.store(image_sha256, signature, image_path, text_ocr, image_file_name_for_db, ocr_seconds)
         
         if not text_ocr:
             await send_whatsapp_message(telefono, f"🤔 {user_name_for_ocr_task}, no pude encontrar texto legible en la imagen. Para que pueda ayudarte mejor, asegúrate de que la imagen sea clara y el texto no sea muy pequeño o esté borroso. ¡Gracias!")
@@ -477,18 +3025,31 @@ async def process_incoming_image_task(telefono: str, user_data: sqlite3.Row, ima
             "ocr_text_original": text_ocr,
             "image_db_id": image_file_name_for_db
         }
-        await handle_registered_user_message(telefono, text_for_analysis, user_data, image_context=image_context_for_handler)
+        # El OCR corre sin lock; solo la respuesta se serializa con los demás mensajes del usuario.
+        # El trabajo de la cola sigue abierto (process_webhook_message espera esta tarea), así que
+        # el siguiente mensaje del remitente no se atiende antes, ni en este ni en otro proceso.
+        async with user_locks.acquire(telefono), db_turn():
+            user_data = await db_get_user(telefono) or user_data # Pudo cambiar mientras se leía la imagen
+            await handle_registered_user_message(telefono, text_for_analysis, user_data, image_context=image_context_for_handler)
         
-        print(f"Tarea de procesamiento de imagen para {telefono} ({user_name_for_ocr_task}) completada exitosamente.")
+        ocr_log.info("Tarea de procesamiento de imagen para %s (%s) completada exitosamente.", telefono, user_name_for_ocr_task)
 
+    except OCRQueueFullError as e:
+        ocr_log.warning("%s. Imagen de %s descartada.", e, telefono)
+        await send_whatsapp_message(telefono, f"⏳ {user_name_for_ocr_task}, en este momento estoy revisando muchas imágenes y no alcancé a leer la tuya. ¿Podrías enviarla de nuevo en unos minutos? ¡Gracias por tu paciencia!")
     except pytesseract.TesseractNotFoundError:
-        print("ERROR CRÍTICO: Tesseract OCR no está instalado o no en PATH.")
+        ocr_log.critical("Tesseract OCR no está instalado o no en PATH.")
         await send_whatsapp_message(telefono, f"⚠️ ¡Uy, {user_name_for_ocr_task}! Parece que tengo un problema técnico con mi sistema para leer imágenes en este momento. Lamento no poder analizarla esta vez. Puedes intentarlo más tarde o enviarme el texto directamente si es posible.")
     except Exception as e:
-        print(f"ERROR en process_incoming_image_task (tel: {telefono}, user: {user_name_for_ocr_task}, img_id_wa: {image_id_whatsapp}): {e}")
+        ocr_log.error("Error en process_incoming_image_task (tel: %s, user: %s, img_id_wa: %s): %s", telefono, user_name_for_ocr_task, image_id_whatsapp, e)
         await send_whatsapp_message(telefono, f"⚠️ Lo siento mucho, {user_name_for_ocr_task}, ocurrió un error inesperado mientras procesaba tu imagen. Ya estoy enterado del problema. Por favor, intenta más tarde. 🙏")
+    finally:
+        if os.path.exists(download_path): # No llegó al almacén por un error
+            os.remove(download_path)
+        if new_image_file:
+            await image_store.compact(image_sha256, new_image_file)
 
-async def handle_onboarding_process(telefono: str, text_received: str, user_data: sqlite3.Row):
+async def handle_onboarding_process(telefono: str, text_received: str, user_data: dict):
     estado_actual = user_data["estado"]
     user_name_onboarding = user_data["nombre"] if user_data and user_data["nombre"] else "amigo/a"
 
@@ -505,7 +3066,7 @@ async def handle_onboarding_process(telefono: str, text_received: str, user_data
                                 normalized_text == "no"
 
         if is_explicit_acceptance and not ("no" in normalized_text and "acepto" not in normalized_text): 
-            db_update_user(telefono, {"acepto_terminos": 1, "estado": ESTADO_PENDIENTE_NOMBRE})
+            await db_update_user(telefono, {"acepto_terminos": 1, "estado": ESTADO_PENDIENTE_NOMBRE})
             await send_whatsapp_message(telefono, "¡Excelente! 😊 Gracias por aceptar. Para que mis consejos sean aún mejores para ti, ¿podrías decirme tu nombre, por favor?")
         elif is_explicit_rejection:
             await send_whatsapp_message(telefono, "Entendido. Si cambias de opinión y deseas aceptar los términos para usar mis servicios, solo escribe *ACEPTO*. ¡Estaré aquí para ayudarte! 👍")
@@ -513,10 +3074,10 @@ async def handle_onboarding_process(telefono: str, text_received: str, user_data
             await send_whatsapp_message(telefono, "⚠️ Para que podamos continuar, necesito que aceptes los términos. Solo escribe *ACEPTO* si estás de acuerdo. Si no deseas continuar, puedes responder *NO ACEPTO*. ¡Gracias! 👍")
 
     elif estado_actual == ESTADO_PENDIENTE_NOMBRE:
-        ia_result_nombre = await analyze_with_deepseek(text_received, "nombre")
+        ia_result_nombre = await extract_onboarding_field(text_received, "nombre")
         if ia_result_nombre and ia_result_nombre.startswith("NOMBRE_VALIDO:"):
             nombre_extraido = ia_result_nombre.split(":", 1)[1].strip().title()
-            db_update_user(telefono, {"nombre": nombre_extraido, "estado": ESTADO_PENDIENTE_EDAD})
+            await db_update_user(telefono, {"nombre": nombre_extraido, "estado": ESTADO_PENDIENTE_EDAD})
             await send_whatsapp_message(telefono, f"¡Un placer conocerte, {nombre_extraido}! 👋 Ahora, si no es molestia, ¿me dirías cuántos años tienes? (Solo el número, por ejemplo: 35). Esto me ayuda a darte consejos más adecuados.")
         elif ia_result_nombre == "NOMBRE_INVALIDO":
             await send_whatsapp_message(telefono, "🤔 Mmm, eso no me parece un nombre de persona. ¿Podrías intentarlo de nuevo, por favor? Solo necesito tu primer nombre o cómo te gustaría que te llame. ¡Gracias!")
@@ -525,12 +3086,12 @@ async def handle_onboarding_process(telefono: str, text_received: str, user_data
 
     elif estado_actual == ESTADO_PENDIENTE_EDAD:
         user_name_for_age_prompt = user_data["nombre"] if user_data and user_data["nombre"] else "gracias"
-        ia_result_edad = await analyze_with_deepseek(text_received, "edad")
+        ia_result_edad = await extract_onboarding_field(text_received, "edad")
         if ia_result_edad and ia_result_edad.startswith("EDAD_VALIDA:"):
             try:
                 edad_num = int(ia_result_edad.split(":", 1)[1])
                 if 5 <= edad_num <= 120:
-                    db_update_user(telefono, {"edad": edad_num, "estado": ESTADO_PENDIENTE_CONOCIMIENTO})
+                    await db_update_user(telefono, {"edad": edad_num, "estado": ESTADO_PENDIENTE_CONOCIMIENTO})
                     await send_whatsapp_message(telefono, f"¡Perfecto, {user_name_for_age_prompt}! 👍 Ya casi terminamos. Cuéntame, ¿qué tanto sabes sobre ciberseguridad y estafas en línea? Puedes responder: *Sí* (si sabes bastante), *Poco*, o *No* (si no sabes mucho). ¡Tu honestidad me ayuda a ayudarte mejor! 😊")
                 else:
                     await send_whatsapp_message(telefono, f"⚠️ Entendí el número {edad_num}, pero parece una edad un poco inusual, {user_name_for_age_prompt}. ¿Podrías confirmarla o escribirla de nuevo solo con números (por ejemplo: 28, 65)? ¡Gracias!")
@@ -543,22 +3104,22 @@ async def handle_onboarding_process(telefono: str, text_received: str, user_data
 
     elif estado_actual == ESTADO_PENDIENTE_CONOCIMIENTO:
         user_name_final_step = user_data["nombre"] if user_data and user_data["nombre"] else "listo/a"
-        ia_result_conocimiento = await analyze_with_deepseek(text_received, "conocimiento")
+        ia_result_conocimiento = await extract_onboarding_field(text_received, "conocimiento")
 
         if ia_result_conocimiento in ["Sí", "No", "Poco"]:
-            db_update_user(telefono, {"conocimiento": ia_result_conocimiento, "estado": ESTADO_REGISTRADO})
+            await db_update_user(telefono, {"conocimiento": ia_result_conocimiento, "estado": ESTADO_REGISTRADO})
             await send_whatsapp_message(telefono, f"¡Genial, {user_name_final_step}! ✅ ¡Hemos completado tu registro! Muchas gracias por tu tiempo y confianza. 🙏\n\n🛡️ A partir de ahora, estoy a tu disposición. Puedes enviarme cualquier mensaje de texto o imagen que te parezca sospechosa, y la analizaré contigo. También puedes hacerme preguntas sobre seguridad digital y cómo protegerte de fraudes en línea.\n\n¡Estoy aquí para ayudarte a navegar el mundo digital de forma más segura! 😊")
         else: 
             await send_whatsapp_message(telefono, f"⚠️ Ups, {user_name_final_step}. No entendí bien tu respuesta sobre tu conocimiento. Para que pueda ayudarte mejor, ¿podrías decirme si sabes *Sí*, *Poco*, o *No* sobre ciberseguridad? ¡Una de esas tres opciones me ayuda mucho! 👍")
 
 
-async def handle_post_phishing_response(telefono: str, text_received: str, user_data: sqlite3.Row):
+async def handle_post_phishing_response(telefono: str, text_received: str, user_data: dict):
     user_profile_dict = dict(user_data)
     nombre_usuario = user_data["nombre"] if user_data and user_data["nombre"] else "tú"
     normalized_input = normalize_text(text_received) 
     
-    decision_usuario = await analyze_with_deepseek(normalized_input, "decision_post_phishing_interaction", user_profile_dict)
-    print(f"DEBUG: Decisión IA en handle_post_phishing_response ({telefono}): {decision_usuario} para texto normalizado: '{normalized_input}' (original: '{text_received}')")
+    decision_usuario = await decide_waiting_reply(text_received, "decision_post_phishing_interaction", user_profile_dict)
+    conversation_log.debug("Decisión IA en handle_post_phishing_response (%s): %s para texto normalizado: '%s' (original: '%s')", telefono, decision_usuario, normalized_input, text_received)
 
     re_prompt_after_digression = f"Espero que eso haya aclarado tu duda, {nombre_usuario}. Recordando nuestra conversación anterior sobre el mensaje sospechoso, ¿llegaste a interactuar con él (SÍ/NO) o necesitas AYUDA específica?"
     re_prompt_after_comment = f"Entendido, {nombre_usuario}. Volviendo al tema importante: sobre el mensaje que analizamos, ¿llegaste a interactuar con él (SÍ/NO) o necesitas AYUDA específica?"
@@ -572,11 +3133,11 @@ async def handle_post_phishing_response(telefono: str, text_received: str, user_
             await send_whatsapp_message(telefono, respuesta_ayuda)
         else:
             await send_whatsapp_message(telefono, f"Lo lamento, {nombre_usuario}, tuve dificultades para generar los pasos de ayuda en este momento. Si es urgente, te recomiendo contactar directamente a las autoridades o a un experto en seguridad. 🙏")
-        db_update_user(telefono, {"estado": ESTADO_REGISTRADO, "last_analyzed_url": None}) # Limpiar URL también
+        await db_update_user(telefono, {"estado": ESTADO_REGISTRADO, "last_analyzed_url": None}) # Limpiar URL también
 
     elif decision_usuario == "RESPUESTA_NO":
         await send_whatsapp_message(telefono, f"¡Excelente noticia, {nombre_usuario}! 👍 Me alegra mucho que no hayas interactuado con ese mensaje sospechoso. ¡Eso demuestra que estás muy alerta! Sigue así, desconfiando y verificando siempre. Si tienes algo más que quieras analizar o alguna otra pregunta, no dudes en decírmelo. 😊")
-        db_update_user(telefono, {"estado": ESTADO_REGISTRADO, "last_analyzed_url": None}) # Limpiar URL también
+        await db_update_user(telefono, {"estado": ESTADO_REGISTRADO, "last_analyzed_url": None}) # Limpiar URL también
 
     elif decision_usuario == "PIDE_AYUDA":
         await send_whatsapp_message(telefono, f"🆘 De acuerdo, {nombre_usuario}. Te prepararé los pasos de ayuda específicos. Un momento, por favor... 🛡️")
@@ -585,10 +3146,10 @@ async def handle_post_phishing_response(telefono: str, text_received: str, user_
             await send_whatsapp_message(telefono, respuesta_ayuda)
         else:
             await send_whatsapp_message(telefono, f"Lo lamento, {nombre_usuario}, tuve dificultades para generar los pasos de ayuda en este momento. Si es urgente, te recomiendo contactar directamente a las autoridades o a un experto en seguridad. 🙏")
-        db_update_user(telefono, {"estado": ESTADO_REGISTRADO, "last_analyzed_url": None}) # Limpiar URL también
+        await db_update_user(telefono, {"estado": ESTADO_REGISTRADO, "last_analyzed_url": None}) # Limpiar URL también
 
     elif decision_usuario == "ES_PREGUNTA":
-        print(f"DEBUG: Usuario {telefono} hizo una pregunta en estado ESPERANDO_RESPUESTA_PHISHING: '{text_received}'")
+        conversation_log.debug("Usuario %s hizo una pregunta en estado ESPERANDO_RESPUESTA_PHISHING: '%s'", telefono, text_received)
         await send_whatsapp_message(telefono, f"🤔 ¡Claro, {nombre_usuario}! Déjame responder tu pregunta sobre \"{text_received[:30]}...\". Un momento...")
         # Pasar el user_profile completo que incluye last_analyzed_url
         respuesta_a_pregunta = await analyze_with_deepseek(text_received, "cyber_pregunta", user_profile_dict)
@@ -600,7 +3161,7 @@ async def handle_post_phishing_response(telefono: str, text_received: str, user_
         # El estado sigue siendo ESTADO_ESPERANDO_RESPUESTA_PHISHING
 
     elif decision_usuario == "ES_COMENTARIO":
-        print(f"DEBUG: Usuario {telefono} hizo un comentario en estado ESPERANDO_RESPUESTA_PHISHING: '{text_received}'")
+        conversation_log.debug("Usuario %s hizo un comentario en estado ESPERANDO_RESPUESTA_PHISHING: '%s'", telefono, text_received)
         if "gracias" in normalized_input:
             await send_whatsapp_message(telefono, f"¡De nada, {nombre_usuario}! 😊 {re_prompt_after_comment}")
         elif "ok" in normalized_input or "entendido" in normalized_input:
@@ -610,11 +3171,11 @@ async def handle_post_phishing_response(telefono: str, text_received: str, user_
         # El estado sigue siendo ESTADO_ESPERANDO_RESPUESTA_PHISHING
         
     else: # OTRA_COSA o error de IA
-        print(f"DEBUG: Respuesta no clasificada ({decision_usuario}) en ESPERANDO_RESPUESTA_PHISHING para {telefono}. Texto: '{text_received}'")
+        conversation_log.debug("Respuesta no clasificada (%s) en ESPERANDO_RESPUESTA_PHISHING para %s. Texto: '%s'", decision_usuario, telefono, text_received)
         await send_whatsapp_message(telefono, re_prompt_generic)
         # El estado sigue siendo ESTADO_ESPERANDO_RESPUESTA_PHISHING
 
-async def handle_registered_user_message(telefono: str, text_received: str, user_data: sqlite3.Row, image_context: dict = None): # MODIFICADO
+async def handle_registered_user_message(telefono: str, text_received: str, user_data: dict, image_context: dict = None): # MODIFICADO
     cleaned_text = re.sub(r'\s+', ' ', text_received).strip() 
     nombre_usuario = user_data["nombre"] if user_data and user_data["nombre"] else "tú" 
 
@@ -623,12 +3184,17 @@ async def handle_registered_user_message(telefono: str, text_received: str, user
         return
 
     user_profile_dict = dict(user_data)
-    intencion = await analyze_with_deepseek(cleaned_text, "intencion", user_profile_dict) 
-    print(f"DEBUG: Intención clasificada para {telefono} ({nombre_usuario}): {intencion} para texto: '{cleaned_text[:50]}...'")
+    intencion, confianza_local = classify_intent_local(cleaned_text)
+    if confianza_local >= INTENT_LOCAL_MIN_CONFIDENCE:
+        intent_classifier_stats["local"] += 1
+    else:
+        intent_classifier_stats["llm"] += 1
+        intencion = await analyze_with_deepseek(cleaned_text, "intencion", user_profile_dict)
+    conversation_log.debug("Intención clasificada para %s (%s): %s (local: %s, confianza: %s) para texto: '%s...'", telefono, nombre_usuario, intencion, confianza_local >= INTENT_LOCAL_MIN_CONFIDENCE, confianza_local, cleaned_text[:50])
 
     if intencion == "comando_reset":
         await send_whatsapp_message(telefono, f"De acuerdo, {nombre_usuario}. Hemos vuelto al menú principal. ¿En qué te puedo ayudar ahora? 😊")
-        db_update_user(telefono, {
+        await db_update_user(telefono, {
             "estado": ESTADO_REGISTRADO,
             "last_analysis_details": None,
             "last_image_ocr_text": None,
@@ -637,14 +3203,16 @@ async def handle_registered_user_message(telefono: str, text_received: str, user
             "last_image_timestamp": None,
             "last_analyzed_url": None # Limpiar URL también
         })
+        user_cache.invalidate(telefono)
+        discard_pending_analysis_details(telefono)
         return
 
     if intencion == "saludo":
         greeting = f"¡Hola de nuevo, {nombre_usuario}! 👋"
         last_interaction_info = ""
-        if "last_image_timestamp" in user_data:  # Fix: Access directly as dictionary
+        if user_data.get("last_image_timestamp"):
             last_interaction_info = " La última vez que interactuamos fue sobre un análisis reciente."
-        elif "last_analyzed_url" in user_data:
+        elif user_data.get("last_analyzed_url"):
              last_interaction_info = " Recientemente analizamos un enlace."
         
         greeting += last_interaction_info
@@ -654,38 +3222,83 @@ async def handle_registered_user_message(telefono: str, text_received: str, user
     elif intencion == "analizar":
         await send_whatsapp_message(telefono, f"🔍 ¡Entendido, {nombre_usuario}! Estoy revisando el mensaje que me enviaste. Te aviso en un momento con mi análisis... 👍")
         
-        # Extraer URL antes de enviar a la IA de phishing, para guardarla
-        extracted_url = extract_first_url(cleaned_text)
-        if not extracted_url and image_context and image_context.get("ocr_text_original"): # Si no hay URL en texto, pero es imagen, buscar en OCR
-            extracted_url = extract_first_url(image_context.get("ocr_text_original"))
-
-        analisis_phishing_completo = await analyze_with_deepseek(cleaned_text, "phishing", user_profile_dict)
+        # Revisar los enlaces (del texto o, si no trae, del OCR de la imagen) antes de llamar a la IA
+        url_verdicts = url_reputation.check_text(cleaned_text)
+        if not url_verdicts and image_context and image_context.get("ocr_text_original"):
+            url_verdicts = url_reputation.check_text(image_context.get("ocr_text_original"))
+        extracted_url = url_verdicts[0].url if url_verdicts else None # Se guarda para preguntas posteriores
+        conclusive = [v for v in url_verdicts if v.conclusive and v.confidence >= URL_SHORT_CIRCUIT_MIN_CONFIDENCE]
+
+        is_from_image = bool(image_context and image_context.get("is_from_image_processing"))
+        rest_task = None
+        if conclusive:
+            # Enlace bloqueado o imitación clara de una marca: el veredicto no necesita a DeepSeek
+            url_reputation.stats["short_circuit"] += 1
+            verdict = max(conclusive, key=lambda v: v.confidence)
+            analisis_phishing_completo = build_url_verdict_analysis(verdict, nombre_usuario)
+            conversation_log.debug("Veredicto de phishing local para %s: %s (%s).", telefono, verdict.host, verdict.verdict)
+        else:
+            analisis_phishing_completo = await verdict_cache.lookup(cleaned_text, user_profile_dict)
+            scan = scam_signal_scanner.scan(image_context["ocr_text_original"] if is_from_image else cleaned_text)
+            hints = url_hints_for_prompt(url_verdicts) + scam_hints_for_prompt(scan)
+            if analisis_phishing_completo:
+                conversation_log.debug("Veredicto de phishing servido desde caché para %s.", telefono)
+            elif scan.score >= SCAM_SIGNAL_FAST_REPLY_SCORE:
+                # Estafa evidente por sus señales: el resumen sale ya y DeepSeek escribe los detalles en segundo plano
+                scam_signal_scanner.stats["fast_reply"] += 1
+                local_analysis = build_scam_signal_analysis(scan, VERDICT_NAME_PLACEHOLDER)
+                analisis_phishing_completo = render_verdict_name(local_analysis, nombre_usuario)
+                rest_task = asyncio.create_task(analyze_phishing_details(cleaned_text, verdict_prompt_profile(user_profile_dict), hints, local_analysis))
+            elif scan.score <= SCAM_SIGNAL_BENIGN_MAX_SCORE and not url_verdicts and not is_from_image:
+                scam_signal_scanner.stats["benign_skip"] += 1
+                analisis_phishing_completo = build_benign_scan_analysis(nombre_usuario)
+            elif DEEPSEEK_STREAMING:
+                # El resumen se envía apenas llega el separador; los detalles siguen en segundo plano.
+                # Con el marcador en lugar del nombre el análisis se puede cachear para otros usuarios.
+                resumen_marcado, rest_task = await analyze_phishing_streaming(cleaned_text, verdict_prompt_profile(user_profile_dict), hints)
+                analisis_phishing_completo = resumen_marcado and render_verdict_name(resumen_marcado, nombre_usuario)
+            else:
+                analisis_marcado = await analyze_with_deepseek(cleaned_text, "phishing", verdict_prompt_profile(user_profile_dict), hints)
+                if analisis_marcado:
+                    await verdict_cache.store(cleaned_text, user_profile_dict, analisis_marcado)
+                    analisis_phishing_completo = render_verdict_name(analisis_marcado, nombre_usuario)
 
         if analisis_phishing_completo:
-            partes = analisis_phishing_completo.split("---DETALLES_SIGUEN---", 1)
+            partes = analisis_phishing_completo.split(PHISHING_DETAILS_SEPARATOR, 1)
             resumen_breve = partes[0].strip()
             detalles_completos = partes[1].strip() if len(partes) > 1 else ""
 
+            if rest_task is not None:
+                details_task = pending_analysis_details[telefono] = asyncio.create_task(
+                    complete_phishing_details(telefono, cleaned_text, user_profile_dict, rest_task, is_from_image)
+                )
+
             await send_whatsapp_message(telefono, resumen_breve)
             await send_whatsapp_message(telefono, f"{nombre_usuario}, ¿quieres que te dé más detalles y mis recomendaciones sobre esto? 😊") 
+            if rest_task is not None and not PROCESS_LOCAL_USER_STATE:
+                # La respuesta puede atenderla otro proceso, que solo ve la base de datos: los
+                # detalles se terminan dentro de este turno (el resumen ya salió) y no en segundo plano.
+                await details_task
 
             db_updates = {
                 "estado": ESTADO_ESPERANDO_MAS_DETALLES,
-                "last_analysis_details": detalles_completos,
                 "last_analyzed_url": extracted_url # Guardar la URL extraída
             }
-            if image_context and image_context.get("is_from_image_processing"):
+            if rest_task is None: # En streaming los escribe complete_phishing_details al terminar
+                db_updates["last_analysis_details"] = detalles_completos
+            if is_from_image:
                 db_updates["last_image_ocr_text"] = image_context.get("ocr_text_original")
-                db_updates["last_image_analysis_raw"] = analisis_phishing_completo
+                if rest_task is None:
+                    db_updates["last_image_analysis_raw"] = analisis_phishing_completo
                 db_updates["last_image_id_processed"] = image_context.get("image_db_id")
                 db_updates["last_image_timestamp"] = datetime.datetime.now().isoformat()
             
-            print(f"DEBUG: Intentando actualizar DB para {telefono} con los siguientes datos: {db_updates}")
+            conversation_log.debug("Intentando actualizar DB para %s con los siguientes datos: %s", telefono, db_updates)
             try:
-                db_update_user(telefono, db_updates)
-                print(f"DEBUG: Actualización de DB para {telefono} (estado a ESPERANDO_MAS_DETALLES) parece exitosa.")
+                await db_update_user(telefono, db_updates)
+                conversation_log.debug("Actualización de DB para %s (estado a ESPERANDO_MAS_DETALLES) parece exitosa.", telefono)
             except Exception as e_db_update:
-                print(f"ERROR CRÍTICO: Falló db_update_user tras enviar resumen para {telefono}. Datos: {db_updates}. Error: {e_db_update}")
+                conversation_log.critical("Falló db_update_user tras enviar resumen para %s. Datos: %s. Error: %s", telefono, db_updates, e_db_update)
                 raise e_db_update
         else:
             await send_whatsapp_message(telefono, f"Lo siento mucho, {nombre_usuario}, tuve un problema al intentar analizar tu mensaje. ¿Podrías intentarlo de nuevo un poco más tarde, por favor? 🙏")
@@ -716,34 +3329,230 @@ async def handle_registered_user_message(telefono: str, text_received: str, user
         await send_whatsapp_message(telefono, f"¡Claro, {nombre_usuario}! Aquí tienes un consejo de seguridad para ti:\n\n{tip}\n\nEspero te sea útil. 😊")
 
     elif intencion == "irrelevante" or not intencion : 
-        print(f"Intención clasificada como '{intencion}' o no clasificada para '{cleaned_text[:50]}...' de {nombre_usuario}.")
+        conversation_log.info("Intención clasificada como '%s' o no clasificada para '%s...' de %s.", intencion, cleaned_text[:50], nombre_usuario)
         await send_whatsapp_message(telefono, f"Vaya, {nombre_usuario}, no estoy completamente seguro de cómo ayudarte con eso. 🤔\nRecuerda que puedo:\n1. Analizar un mensaje o imagen sospechosa 🔍\n2. Responder preguntas sobre ciberseguridad 🛡️\n3. Darte un consejo de seguridad rápido 💡\n\n¿Qué te gustaría hacer? Puedes enviar el mensaje/imagen a analizar, tu pregunta, o escribir 'consejo'.")
     
     else: 
-        print(f"Intención NO MANEJADA o error de IA para '{cleaned_text[:50]}...' de {nombre_usuario}: {intencion}")
+        conversation_log.warning("Intención NO MANEJADA o error de IA para '%s...' de %s: %s", cleaned_text[:50], nombre_usuario, intencion)
         await send_whatsapp_message(telefono, f"Vaya, {nombre_usuario}, no estoy completamente seguro de cómo ayudarte con eso. 🧐 ¿Podrías intentar expresarlo de otra manera o enviarme un mensaje sospechoso para que lo analice? Estoy aquí para los temas de ciberseguridad. 😊")
 
 
+def collect_component_metrics() -> list[tuple[str, str, str, list[tuple[dict, float]]]]:
+    """Gauges y contadores que ya llevan los componentes; se leen solo al hacer scrape."""
+    queue_depths = [
+        ({"queue": "webhook"}, webhook_queue.pending_count() if webhook_queue else 0),
+        ({"queue": "ocr"}, ocr_engine.queue.qsize()),
+        ({"queue": "whatsapp_send"}, whatsapp_sender.unfinished),
+        ({"queue": "log"}, log_handler.queue.qsize()),
+    ]
+    held_locks = user_locks.held_count()
+    components = {
+        "llm_gateway": llm_gateway.stats, "ocr_engine": ocr_engine.stats, "ocr_cache": ocr_cache.stats, "image_store": image_store.stats,
+        "verdict_cache": verdict_cache.stats, "message_dedupe": message_dedupe.stats,
+        "webhook_queue": webhook_queue.stats if webhook_queue else Counter(),
+        "user_locks": user_locks.stats, "whatsapp_sender": whatsapp_sender.stats,
+        "intent_classifier": intent_classifier_stats, "reply_classifier": reply_classifier_stats,
+        "onboarding_extractor": onboarding_extractor_stats, "url_reputation": url_reputation.stats,
+        "scam_signal_scanner": scam_signal_scanner.stats,
+    }
+    events = [({"component": name, "event": event}, count) for name, stats in components.items() for event, count in sorted(stats.items())]
+    events += [({"component": "user_cache", "event": key}, user_cache.stats()[key]) for key in ("hits", "misses", "evictions")]
+    return [
+        ("bot_inflight_tasks", "gauge", "Tareas de asyncio vivas en este proceso.", [({}, len(asyncio.all_tasks()))]),
+        ("bot_queue_depth", "gauge", "Elementos pendientes en cada cola.", queue_depths),
+        ("bot_user_locks", "gauge", "Locks de usuario tomados y tareas esperando uno.",
+         [({"state": "held"}, held_locks), ({"state": "waiting"}, sum(refs for _, refs in user_locks.entries.values()) - held_locks)]),
+        ("bot_user_cache_entries", "gauge", "Perfiles de usuario en la caché en memoria.", [({}, len(user_cache.entries))]),
+        ("bot_image_store_files", "gauge", "Imágenes guardadas en el almacén por contenido.", [({}, image_store.files)]),
+        ("bot_image_store_bytes", "gauge", "Bytes que ocupan en disco las imágenes del almacén.", [({}, image_store.total_bytes)]),
+        ("bot_scam_lexicon_info", "gauge", "Versión del léxico de señales de estafa en uso.", [({"version": scam_signal_scanner.version}, 1)]),
+        ("bot_llm_breaker_open", "gauge", "1 si el circuit breaker hacia DeepSeek está abierto.", [({}, int(llm_gateway.breaker_state == "open"))]),
+        ("bot_webhook_messages_total", "counter", "Mensajes de WhatsApp recibidos por webhook.", [({}, webhook_messages_handled_total)]),
+        ("bot_log_records_dropped_total", "counter", "Registros de log descartados por cola llena.", [({}, log_handler.dropped)]),
+        ("bot_component_events_total", "counter", "Contadores internos de cada componente.", events),
+    ]
+
+metrics.collectors.append(collect_component_metrics)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/webhook", response_class=PlainTextResponse)
 async def verify_webhook_subscription(request: Request):
     if request.query_params.get("hub.mode") == "subscribe" and \
        request.query_params.get("hub.verify_token") == VERIFY_TOKEN:
-        print("Verificación de Webhook exitosa.")
+        webhook_log.info("Verificación de Webhook exitosa.")
         return PlainTextResponse(request.query_params.get("hub.challenge", ""), status_code=200)
-    print(f"Fallo en verificación de Webhook. Token: {request.query_params.get('hub.verify_token')}")
+    webhook_log.warning("Fallo en verificación de Webhook. Token: %s", request.query_params.get('hub.verify_token'))
     raise HTTPException(status_code=403, detail="Verification token mismatch.")
 
-@app.post("/webhook") # MODIFICADO para manejo de feedback y reset
-async def whatsapp_webhook_handler(request: Request):
-    data = await request.json()
+async def handle_incoming_message(telefono_remitente: str, message_object: dict, message_type: str, text_recibido_original: str) -> asyncio.Task | None:
+    """Atiende un mensaje ya deduplicado. Debe llamarse con user_locks.acquire(telefono_remitente) tomado.
+
+    Si el mensaje es una imagen devuelve la tarea que la analiza: corre fuera del lock, pero
+    quien llama debe esperarla antes de dar el mensaje por terminado.
+    """
+    current_user = await db_get_user(telefono_remitente)
+
+    if not current_user:
+        await db_create_user(telefono_remitente)
+        current_user = await db_get_user(telefono_remitente)
+        if not current_user:
+             conversation_log.critical("No se pudo crear/leer usuario %s.", telefono_remitente)
+             raise RuntimeError(f"No se pudo crear/leer usuario {telefono_remitente}")
+
+        await send_whatsapp_message(telefono_remitente,
+            "👋 ¡Hola! Soy SecurityBot-WA, tu asistente virtual para ayudarte a navegar seguro en el mundo digital en Colombia. 😊\n\n"
+            "Para darte la mejor orientación y cumplir con la Ley 1581 de 2012 (protección de datos personales), necesito tu autorización para guardar algunos datos como tu número de teléfono, y más adelante, tu nombre, edad y nivel de conocimiento en ciberseguridad.\n\n"
+            "🔒 Tu información será confidencial y se usará exclusivamente para mejorar tu experiencia. ¡Nunca la compartiré con terceros!\n\n"
+            "📄 Puedes conocer más detalles en nuestros Términos y Política de Privacidad: https://drive.google.com/file/d/1x7fp9FO3vRGaRcpEeJTbVa050B5aordr/view?usp=sharing\n\n"
+            "👉 Si estás de acuerdo, por favor responde con: ACEPTO"
+        )
+        return
+
+    user_state = current_user["estado"]
+    user_name_for_handler = current_user["nombre"] if current_user and current_user["nombre"] else "tú"
+    conversation_log.debug("Handler para %s, Estado: %s", telefono_remitente, user_state)
+
+    if user_state == ESTADO_ESPERANDO_MAS_DETALLES:
+        if message_type == "text":
+            conversation_log.debug("%s en ESPERANDO_MAS_DETALLES, recibió: '%s'", telefono_remitente, text_recibido_original)
+            user_profile_dict = dict(current_user)
+            decision_ia = await decide_waiting_reply(text_recibido_original, "decision_ver_detalles", user_profile_dict)
+            conversation_log.debug("Decisión de IA para ver detalles (%s): %s", telefono_remitente, decision_ia)
+
+            if decision_ia == "QUIERE_DETALLES":
+                detalles_a_enviar = current_user["last_analysis_details"]
+                pending_details_task = pending_analysis_details.pop(telefono_remitente, None)
+                if pending_details_task is not None: # Los detalles aún se están generando (streaming)
+                    try:
+                        detalles_a_enviar = await asyncio.wait_for(pending_details_task, timeout=DEEPSEEK_DETAILS_WAIT_SECONDS)
+                    except Exception as e_details:
+                        conversation_log.error("Error esperando los detalles del análisis para %s: %s", telefono_remitente, e_details)
+                        detalles_a_enviar = None
+                if detalles_a_enviar:
+                    await send_whatsapp_message(telefono_remitente, detalles_a_enviar)
+                    # Pregunta de feedback
+                    await send_whatsapp_message(telefono_remitente, f"{user_name_for_handler}, ¿te fue útil este análisis? Puedes responder con un 👍 o 👎, o simplemente seguir con otra consulta.")
+                    
+                    new_state_after_details = ESTADO_REGISTRADO
+                    analisis_lower = detalles_a_enviar.lower()
+                    cond_pregunta_hecha = "¿llegaste a hacer clic" in analisis_lower
+                    cond_opciones_claras = ("sí o no" in analisis_lower or "si o no" in analisis_lower)
+                    cond_opcion_ayuda = "escribe ayuda" in analisis_lower
+
+                    if cond_pregunta_hecha and cond_opciones_claras and cond_opcion_ayuda:
+                        new_state_after_details = ESTADO_ESPERANDO_RESPUESTA_PHISHING
+                        conversation_log.info("Usuario %s movido a estado ESPERANDO_RESPUESTA_PHISHING después de ver detalles.", telefono_remitente)
+                    await db_update_user(telefono_remitente, {"estado": new_state_after_details, "last_analysis_details": None}) 
+                else:
+                    await send_whatsapp_message(telefono_remitente, "Parece que no tengo los detalles guardados. Por favor, envía el mensaje original de nuevo para analizarlo.")
+                    await db_update_user(telefono_remitente, {"estado": ESTADO_REGISTRADO, "last_analysis_details": None})
+            elif decision_ia == "OTRA_COSA":
+                conversation_log.debug("%s dijo OTRA_COSA. Tratando como nueva consulta.", telefono_remitente)
+                discard_pending_analysis_details(telefono_remitente)
+                await db_update_user(telefono_remitente, {"estado": ESTADO_REGISTRADO, "last_analysis_details": None}) 
+                current_user_reloaded = await db_get_user(telefono_remitente) 
+                if current_user_reloaded: 
+                     await handle_registered_user_message(telefono_remitente, text_recibido_original, current_user_reloaded)
+                else: 
+                    conversation_log.error("No se pudo recargar el usuario %s después de OTRA_COSA.", telefono_remitente)
+                    await send_whatsapp_message(telefono_remitente, "Hubo un pequeño problema, ¿podrías enviar tu consulta de nuevo, por favor?")
+            else: 
+                conversation_log.warning("Respuesta no esperada de IA para decision_ver_detalles (%s): %s", telefono_remitente, decision_ia)
+                await send_whatsapp_message(telefono_remitente, f"🤔 {user_name_for_handler}, no estoy seguro de cómo proceder. Si querías ver los detalles, puedes intentarlo de nuevo diciendo 'sí, quiero verlos'. Si era otra consulta, por favor envíamela de nuevo.")
+        else: 
+            await send_whatsapp_message(telefono_remitente, f"Hola {user_name_for_handler}, esperaba un mensaje de texto para saber si querías más detalles. Si es así, por favor, escribe algo como 'sí, muéstrame'. Si era otra cosa, puedes enviármelo.")
+
+    elif user_state == ESTADO_ESPERANDO_RESPUESTA_PHISHING:
+        if message_type == "text":
+            if text_recibido_original:
+                await handle_post_phishing_response(telefono_remitente, text_recibido_original, current_user)
+            else: 
+                await send_whatsapp_message(telefono_remitente, f"Por favor, {user_name_for_handler}, responde SÍ, NO o AYUDA a mi pregunta anterior. ¡Gracias! 😊")
+        else: 
+            await send_whatsapp_message(telefono_remitente, f"Hola {user_name_for_handler}, estaba esperando una respuesta de SÍ, NO o AYUDA en texto. Si quieres analizar otra cosa, envíala después de responder, por favor. 👍")
+
+    elif user_state < ESTADO_REGISTRADO: 
+        if message_type == "text":
+            if text_recibido_original:
+                await handle_onboarding_process(telefono_remitente, text_recibido_original, current_user)
+            else: await send_whatsapp_message(telefono_remitente, f"Hola {user_name_for_handler}, parece que no escribiste nada. Por favor, envía una respuesta para que podamos continuar. 😊")
+        else: await send_whatsapp_message(telefono_remitente, f"¡Hola, {user_name_for_handler}! 😊 Para que podamos configurar tu perfil, necesito que me respondas con mensajes de texto a las preguntas anteriores. ¡Gracias!")
+
+    elif user_state == ESTADO_REGISTRADO:
+        if message_type == "text":
+            if text_recibido_original:
+                await handle_registered_user_message(telefono_remitente, text_recibido_original, current_user)
+            else: await send_whatsapp_message(telefono_remitente, f"Hola {user_name_for_handler}, ¿necesitas ayuda con algo? Puedes enviarme un mensaje que te parezca sospechoso o hacerme una pregunta sobre seguridad. ¡Estoy aquí para ti! 👍")
+        elif message_type == "image":
+            image_id_wa = message_object.get("image", {}).get("id")
+            if image_id_wa:
+                await send_whatsapp_message(telefono_remitente, f"🖼️ ¡Recibí tu imagen, {user_name_for_handler}! La voy a revisar con cuidado y te envío mi análisis en un momento. 🧐")
+                return asyncio.create_task(process_incoming_image_task(telefono_remitente, current_user, image_id_wa))
+            else: await send_whatsapp_message(telefono_remitente, f"⚠️ Vaya, {user_name_for_handler}, parece que hubo un problema con la imagen que enviaste. ¿Podrías intentar mandarla de nuevo, por favor?")
+        elif message_type == "audio": await send_whatsapp_message(telefono_remitente, f"¡Hola, {user_name_for_handler}! Recibí tu mensaje de audio. 🎤 Aún estoy aprendiendo a procesarlos, ¡pero espero poder ayudarte con ellos muy pronto! 😊")
+        else: await send_whatsapp_message(telefono_remitente, f"Recibí un tipo de mensaje ({message_type}) que aún no sé cómo procesar del todo, {user_name_for_handler}. Por ahora, mi especialidad son los mensajes de texto e imágenes. 📄🖼️")
+
+    else:
+        conversation_log.error("Usuario %s en estado desconocido: %s", telefono_remitente, user_state)
+        await send_whatsapp_message(telefono_remitente, f"¡Hola {user_name_for_handler}! Parece que hubo un pequeño error con mi memoria. ¿Podrías intentar enviarme tu mensaje de nuevo? Gracias. 😊")
+        await db_update_user(telefono_remitente, {"estado": ESTADO_REGISTRADO})
+
+def extract_webhook_messages(data: dict) -> list[dict]:
+    """Devuelve todos los mensajes de todas las entradas y cambios del payload, en orden."""
+    messages = []
+    for entry in data.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            messages.extend(m for m in value.get("messages") or [] if m)
+    return messages
+
+async def process_webhook_payload(data: dict):
+    """Procesa un payload de webhook completo (lo llaman los workers de la cola o el modo inline).
+
+    Meta puede agrupar varios mensajes/entradas en un mismo POST: los remitentes distintos
+    se atienden en paralelo y los mensajes de un mismo remitente en orden.
+    """
+    global webhook_messages_handled_total
     try:
-        entry = data.get("entry", [{}])[0]
-        changes = entry.get("changes", [{}])[0]
-        value = changes.get("value", {})
-        message_object = value.get("messages", [{}])[0]
+        messages = extract_webhook_messages(data)
+    except (AttributeError, TypeError) as e:
+        webhook_log.error("Error al parsear estructura básica del webhook: %s - Data: %s", e, data)
+        return
+    if not messages:
+        return
 
-        if not message_object: return JSONResponse(content={}, status_code=200)
+    webhook_messages_handled_total += len(messages)
 
+    messages_by_sender: dict[str, list[dict]] = {}
+    for message_object in messages:
+        messages_by_sender.setdefault(message_object.get("from"), []).append(message_object)
+    if len(messages) > 1:
+        webhook_log.debug("Webhook en lote: %s mensajes de %s remitente(s).", len(messages), len(messages_by_sender))
+
+    results = await asyncio.gather(
+        *(process_sender_messages(sender_messages) for sender_messages in messages_by_sender.values()),
+        return_exceptions=True
+    )
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        # Reintentar el payload completo es seguro: los mensajes ya atendidos quedan deduplicados.
+        raise errors[0]
+
+async def process_sender_messages(sender_messages: list[dict]):
+    # Si un mensaje falla se detiene el resto del remitente para no alterar el orden en el reintento.
+    for message_object in sender_messages:
+        correlation_token = current_correlation_id.set(str(message_object.get("id") or current_correlation_id.get()))
+        try:
+            await process_webhook_message(message_object)
+        finally:
+            current_correlation_id.reset(correlation_token)
+
+async def process_webhook_message(message_object: dict):
+    claimed = False # Solo se libera un message_id que esta llamada reclamó (el de otro worker sigue vivo)
+    try:
         telefono_remitente = message_object.get("from")
         message_type = message_object.get("type")
         whatsapp_message_id = message_object.get("id")
@@ -751,15 +3560,17 @@ async def whatsapp_webhook_handler(request: Request):
         if message_type == "text":
             text_recibido_original = message_object.get("text", {}).get("body", "").strip()
 
-        print(f"DEBUG: Webhook IN: Tel: {telefono_remitente}, MsgID: {whatsapp_message_id}, Type: {message_type}, Text: '{text_recibido_original[:50]}...'")
+        webhook_log.debug("Webhook IN: Tel: %s, MsgID: %s, Type: %s, Text: '%s...'", telefono_remitente, whatsapp_message_id, message_type, text_recibido_original[:50])
 
         if not telefono_remitente or not whatsapp_message_id:
-            print(f"Webhook ignorado: falta telefono_remitente o whatsapp_message_id. Tel: {telefono_remitente}, MsgID: {whatsapp_message_id}")
-            return JSONResponse(content={}, status_code=200)
+            webhook_log.warning("Webhook ignorado: falta telefono_remitente o whatsapp_message_id. Tel: %s, MsgID: %s", telefono_remitente, whatsapp_message_id)
+            return
 
-        if whatsapp_message_id in processed_message_ids:
-            print(f"Webhook duplicado ignorado para message_id: {whatsapp_message_id}")
-            return JSONResponse(content={}, status_code=200)
+        with STAGE_DEDUPE.time():
+            claimed = await message_dedupe.claim(whatsapp_message_id, current_webhook_job_id.get())
+        if not claimed:
+            webhook_log.info("Webhook duplicado ignorado para message_id: %s", whatsapp_message_id)
+            return
         
         normalized_text_for_cmd_check = normalize_text(text_recibido_original)
         reset_commands = ["empezar de nuevo", "reset", "cancelar", "olvidalo", "ya no", "detente"]
@@ -767,12 +3578,12 @@ async def whatsapp_webhook_handler(request: Request):
                            (len(normalized_text_for_cmd_check) < 30 or normalized_text_for_cmd_check in reset_commands)
 
         if is_reset_command:
-            async with user_locks[telefono_remitente]: # Asegurar acceso a DB
-                current_user_for_reset = db_get_user(telefono_remitente)
+            async with user_locks.acquire(telefono_remitente), db_turn(): # Asegurar acceso a DB
+                current_user_for_reset = await db_get_user(telefono_remitente)
                 user_name_for_reset = current_user_for_reset["nombre"] if current_user_for_reset and current_user_for_reset["nombre"] else "tú"
                 
                 await send_whatsapp_message(telefono_remitente, f"De acuerdo, {user_name_for_reset}. Hemos cancelado la operación actual y volvemos al inicio. ¿En qué te puedo ayudar? 😊")
-                db_update_user(telefono_remitente, {
+                await db_update_user(telefono_remitente, {
                     "estado": ESTADO_REGISTRADO,
                     "last_analysis_details": None,
                     "last_image_ocr_text": None,
@@ -781,130 +3592,78 @@ async def whatsapp_webhook_handler(request: Request):
                     "last_image_timestamp": None,
                     "last_analyzed_url": None
                 })
-                processed_message_ids.append(whatsapp_message_id) 
-            return JSONResponse(content={}, status_code=200)
+                user_cache.invalidate(telefono_remitente)
+                discard_pending_analysis_details(telefono_remitente)
+            await message_dedupe.complete(whatsapp_message_id)
+            return
         
         # Manejo de feedback simple (pulgares)
         if message_type == "text" and (text_recibido_original == "👍" or text_recibido_original == "👎"):
-            async with user_locks[telefono_remitente]: # Asegurar acceso a DB
-                current_user_for_feedback = db_get_user(telefono_remitente)
+            async with user_locks.acquire(telefono_remitente), db_turn(): # Asegurar acceso a DB
+                current_user_for_feedback = await db_get_user(telefono_remitente)
                 if current_user_for_feedback and current_user_for_feedback["estado"] == ESTADO_REGISTRADO: # Solo si está en estado general
-                    print(f"FEEDBACK recibido de {telefono_remitente}: {text_recibido_original}")
+                    webhook_log.info("FEEDBACK recibido de %s: %s", telefono_remitente, text_recibido_original)
                     await send_whatsapp_message(telefono_remitente, "¡Gracias por tu feedback! 😊")
                     # Aquí podrías añadir lógica para guardar el feedback en la DB si lo deseas.
                     # Por ejemplo: db_log_feedback(telefono_remitente, text_recibido_original)
-                    processed_message_ids.append(whatsapp_message_id)
-                    return JSONResponse(content={}, status_code=200)
-        
-        processed_message_ids.append(whatsapp_message_id)
+                    await message_dedupe.complete(whatsapp_message_id)
+                    return
 
-    except (KeyError, IndexError, TypeError) as e:
-        print(f"Error al parsear estructura básica del webhook: {e} - Data: {data}")
-        return JSONResponse(content={}, status_code=200)
+    except (KeyError, IndexError, TypeError, AttributeError) as e:
+        webhook_log.error("Error al parsear mensaje del webhook: %s - Mensaje: %s", e, message_object)
+        return
+    except Exception:
+        if claimed:
+            await message_dedupe.release(whatsapp_message_id)
+        raise
 
-    async with user_locks[telefono_remitente]:
-        current_user = db_get_user(telefono_remitente)
+    try:
+        async with user_locks.acquire(telefono_remitente), db_turn():
+            image_task = await handle_incoming_message(telefono_remitente, message_object, message_type, text_recibido_original)
+        if image_task:
+            # La descarga y el OCR van sin el lock del usuario, pero dentro del trabajo de la cola:
+            # hasta que terminen ningún proceso toma el siguiente mensaje de este remitente, aunque
+            # el shard cambie de dueño mientras tanto.
+            await image_task
+        await message_dedupe.complete(whatsapp_message_id)
+    except Exception:
+        # Liberar el message_id para que el reintento de la cola pueda volver a procesarlo.
+        await message_dedupe.release(whatsapp_message_id)
+        raise
 
-        if not current_user:
-            db_create_user(telefono_remitente)
-            current_user = db_get_user(telefono_remitente)
-            if not current_user:
-                 print(f"Error CRÍTICO: No se pudo crear/leer usuario {telefono_remitente}.")
-                 return JSONResponse(content={"status": "error interno"}, status_code=500)
-
-            await send_whatsapp_message(telefono_remitente,
-                "👋 ¡Hola! Soy SecurityBot-WA, tu asistente virtual para ayudarte a navegar seguro en el mundo digital en Colombia. 😊\n\n"
-                "Para darte la mejor orientación y cumplir con la Ley 1581 de 2012 (protección de datos personales), necesito tu autorización para guardar algunos datos como tu número de teléfono, y más adelante, tu nombre, edad y nivel de conocimiento en ciberseguridad.\n\n"
-                "🔒 Tu información será confidencial y se usará exclusivamente para mejorar tu experiencia. ¡Nunca la compartiré con terceros!\n\n"
-                "📄 Puedes conocer más detalles en nuestros Términos y Política de Privacidad: https://drive.google.com/file/d/1x7fp9FO3vRGaRcpEeJTbVa050B5aordr/view?usp=sharing\n\n"
-                "👉 Si estás de acuerdo, por favor responde con: ACEPTO"
-            )
-            return JSONResponse(content={}, status_code=200)
-
-        user_state = current_user["estado"]
-        user_name_for_handler = current_user["nombre"] if current_user and current_user["nombre"] else "tú"
-        print(f"DEBUG: Handler para {telefono_remitente}, Estado: {user_state}")
-
-        if user_state == ESTADO_ESPERANDO_MAS_DETALLES:
-            if message_type == "text":
-                print(f"DEBUG: {telefono_remitente} en ESPERANDO_MAS_DETALLES, recibió: '{text_recibido_original}'")
-                user_profile_dict = dict(current_user)
-                decision_ia = await analyze_with_deepseek(normalize_text(text_recibido_original), "decision_ver_detalles", user_profile_dict)
-                print(f"DEBUG: Decisión de IA para ver detalles ({telefono_remitente}): {decision_ia}")
-
-                if decision_ia == "QUIERE_DETALLES":
-                    detalles_a_enviar = current_user["last_analysis_details"]
-                    if detalles_a_enviar:
-                        await send_whatsapp_message(telefono_remitente, detalles_a_enviar)
-                        # Pregunta de feedback
-                        await send_whatsapp_message(telefono_remitente, f"{user_name_for_handler}, ¿te fue útil este análisis? Puedes responder con un 👍 o 👎, o simplemente seguir con otra consulta.")
-                        
-                        new_state_after_details = ESTADO_REGISTRADO
-                        analisis_lower = detalles_a_enviar.lower()
-                        cond_pregunta_hecha = "¿llegaste a hacer clic" in analisis_lower
-                        cond_opciones_claras = ("sí o no" in analisis_lower or "si o no" in analisis_lower)
-                        cond_opcion_ayuda = "escribe ayuda" in analisis_lower
-
-                        if cond_pregunta_hecha and cond_opciones_claras and cond_opcion_ayuda:
-                            new_state_after_details = ESTADO_ESPERANDO_RESPUESTA_PHISHING
-                            print(f"INFO: Usuario {telefono_remitente} movido a estado ESPERANDO_RESPUESTA_PHISHING después de ver detalles.")
-                        db_update_user(telefono_remitente, {"estado": new_state_after_details, "last_analysis_details": None}) 
-                    else:
-                        await send_whatsapp_message(telefono_remitente, "Parece que no tengo los detalles guardados. Por favor, envía el mensaje original de nuevo para analizarlo.")
-                        db_update_user(telefono_remitente, {"estado": ESTADO_REGISTRADO, "last_analysis_details": None})
-                elif decision_ia == "OTRA_COSA":
-                    print(f"DEBUG: {telefono_remitente} dijo OTRA_COSA. Tratando como nueva consulta.")
-                    db_update_user(telefono_remitente, {"estado": ESTADO_REGISTRADO, "last_analysis_details": None}) 
-                    current_user_reloaded = db_get_user(telefono_remitente) 
-                    if current_user_reloaded: 
-                         await handle_registered_user_message(telefono_remitente, text_recibido_original, current_user_reloaded)
-                    else: 
-                        print(f"ERROR: No se pudo recargar el usuario {telefono_remitente} después de OTRA_COSA.")
-                        await send_whatsapp_message(telefono_remitente, "Hubo un pequeño problema, ¿podrías enviar tu consulta de nuevo, por favor?")
-                else: 
-                    print(f"WARN: Respuesta no esperada de IA para decision_ver_detalles ({telefono_remitente}): {decision_ia}")
-                    await send_whatsapp_message(telefono_remitente, f"🤔 {user_name_for_handler}, no estoy seguro de cómo proceder. Si querías ver los detalles, puedes intentarlo de nuevo diciendo 'sí, quiero verlos'. Si era otra consulta, por favor envíamela de nuevo.")
-            else: 
-                await send_whatsapp_message(telefono_remitente, f"Hola {user_name_for_handler}, esperaba un mensaje de texto para saber si querías más detalles. Si es así, por favor, escribe algo como 'sí, muéstrame'. Si era otra cosa, puedes enviármelo.")
+@app.post("/webhook") # MODIFICADO: encola el payload y responde de inmediato
+async def whatsapp_webhook_handler(request: Request):
+    correlation_token = current_correlation_id.set(f"post-{uuid.uuid4().hex[:12]}")
+    try:
+        return await handle_webhook_post(request)
+    finally:
+        current_correlation_id.reset(correlation_token)
 
-        elif user_state == ESTADO_ESPERANDO_RESPUESTA_PHISHING:
-            if message_type == "text":
-                if text_recibido_original:
-                    await handle_post_phishing_response(telefono_remitente, text_recibido_original, current_user)
-                else: 
-                    await send_whatsapp_message(telefono_remitente, f"Por favor, {user_name_for_handler}, responde SÍ, NO o AYUDA a mi pregunta anterior. ¡Gracias! 😊")
-            else: 
-                await send_whatsapp_message(telefono_remitente, f"Hola {user_name_for_handler}, estaba esperando una respuesta de SÍ, NO o AYUDA en texto. Si quieres analizar otra cosa, envíala después de responder, por favor. 👍")
-
-        elif user_state < ESTADO_REGISTRADO: 
-            if message_type == "text":
-                if text_recibido_original:
-                    await handle_onboarding_process(telefono_remitente, text_recibido_original, current_user)
-                else: await send_whatsapp_message(telefono_remitente, f"Hola {user_name_for_handler}, parece que no escribiste nada. Por favor, envía una respuesta para que podamos continuar. 😊")
-            else: await send_whatsapp_message(telefono_remitente, f"¡Hola, {user_name_for_handler}! 😊 Para que podamos configurar tu perfil, necesito que me respondas con mensajes de texto a las preguntas anteriores. ¡Gracias!")
-
-        elif user_state == ESTADO_REGISTRADO:
-            if message_type == "text":
-                if text_recibido_original:
-                    await handle_registered_user_message(telefono_remitente, text_recibido_original, current_user)
-                else: await send_whatsapp_message(telefono_remitente, f"Hola {user_name_for_handler}, ¿necesitas ayuda con algo? Puedes enviarme un mensaje que te parezca sospechoso o hacerme una pregunta sobre seguridad. ¡Estoy aquí para ti! 👍")
-            elif message_type == "image":
-                image_id_wa = message_object.get("image", {}).get("id")
-                if image_id_wa:
-                    await send_whatsapp_message(telefono_remitente, f"🖼️ ¡Recibí tu imagen, {user_name_for_handler}! La voy a revisar con cuidado y te envío mi análisis en un momento. 🧐")
-                    asyncio.create_task(process_incoming_image_task(telefono_remitente, current_user, image_id_wa))
-                else: await send_whatsapp_message(telefono_remitente, f"⚠️ Vaya, {user_name_for_handler}, parece que hubo un problema con la imagen que enviaste. ¿Podrías intentar mandarla de nuevo, por favor?")
-            elif message_type == "audio": await send_whatsapp_message(telefono_remitente, f"¡Hola, {user_name_for_handler}! Recibí tu mensaje de audio. 🎤 Aún estoy aprendiendo a procesarlos, ¡pero espero poder ayudarte con ellos muy pronto! 😊")
-            else: await send_whatsapp_message(telefono_remitente, f"Recibí un tipo de mensaje ({message_type}) que aún no sé cómo procesar del todo, {user_name_for_handler}. Por ahora, mi especialidad son los mensajes de texto e imágenes. 📄🖼️")
+async def handle_webhook_post(request: Request):
+    parse_started = time.perf_counter()
+    try:
+        data = await request.json()
+    except ValueError as e:
+        STAGE_WEBHOOK_PARSE.record_error(e)
+        webhook_log.warning("Webhook ignorado: el cuerpo no es JSON válido.")
+        return JSONResponse(content={}, status_code=200)
 
-        else:
-            print(f"Error: Usuario {telefono_remitente} en estado desconocido: {user_state}")
-            await send_whatsapp_message(telefono_remitente, f"¡Hola {user_name_for_handler}! Parece que hubo un pequeño error con mi memoria. ¿Podrías intentar enviarme tu mensaje de nuevo? Gracias. 😊")
-            db_update_user(telefono_remitente, {"estado": ESTADO_REGISTRADO})
+    try:
+        message_count = len(extract_webhook_messages(data)) if isinstance(data, dict) else 0
+    except (AttributeError, TypeError):
+        message_count = 0
+    STAGE_WEBHOOK_PARSE.observe(time.perf_counter() - parse_started)
+    if not message_count: # Notificaciones de estado (entregado/leído) y similares no se procesan.
+        return JSONResponse(content={}, status_code=200)
+    webhook_messages_per_post[message_count] += 1
 
+    if WEBHOOK_INGEST_MODE == "queue" and webhook_queue:
+        await webhook_queue.enqueue(data)
+    else:
+        await process_webhook_payload(data)
     return JSONResponse(content={}, status_code=200)
 
 if __name__ == "__main__":
     import uvicorn
-    print("Iniciando servidor FastAPI localmente con Uvicorn...")
+    log.info("Iniciando servidor FastAPI localmente con Uvicorn...")
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,348 @@
+"""OCR de las imágenes recibidas: preprocesamiento para tesseract, pool dedicado con cola
+de prioridad (OCREngine) y caché del texto por sha256 y huella perceptual (OCRCache).
+main.py crea las instancias (ocr_engine, ocr_cache) con sus métricas y su base de datos.
+"""
+import os
+import time
+import zlib
+import sqlite3
+import asyncio
+import logging
+import itertools
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+import pytesseract
+from PIL import Image, ImageChops, ImageFilter, ImageOps, ImageStat
+from dotenv import load_dotenv
+
+if TYPE_CHECKING:
+    from main import Database, MetricStage
+
+load_dotenv()
+
+# Motor de OCR: pool de procesos (o hilos) dedicado y cola acotada de imágenes pendientes
+OCR_EXECUTOR = os.getenv("OCR_EXECUTOR", "process").lower() # "process" o "thread"
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))
+OCR_QUEUE_MAX = int(os.getenv("OCR_QUEUE_MAX", "64"))
+OCR_QUEUE_PUT_TIMEOUT_SECONDS = float(os.getenv("OCR_QUEUE_PUT_TIMEOUT_SECONDS", "30"))
+# Preprocesamiento antes de tesseract; pasos en orden: escalar, grises, binarizar, recortar
+OCR_PREPROCESS_STEPS = tuple(step.strip() for step in os.getenv("OCR_PREPROCESS_STEPS", "escalar,grises,binarizar,recortar").split(",") if step.strip())
+OCR_PREPROCESS_MAX_WIDTH = int(os.getenv("OCR_PREPROCESS_MAX_WIDTH", "900")) # Ancho al que se reducen las capturas
+OCR_TARGET_DPI = int(os.getenv("OCR_TARGET_DPI", "300")) # Se le indica a tesseract para que no tenga que estimarlo
+OCR_BINARIZE_RADIUS = int(os.getenv("OCR_BINARIZE_RADIUS", "12")) # Ventana del umbral adaptativo (px)
+OCR_BINARIZE_OFFSET = int(os.getenv("OCR_BINARIZE_OFFSET", "12")) # Cuánto más oscuro que su entorno debe ser un pixel de texto
+OCR_CROP_MARGIN = 16
+# Caché de OCR por huella perceptual de la imagen (capturas de estafa reenviadas una y otra vez)
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "20000"))
+OCR_CACHE_MEMORY_ENTRIES = int(os.getenv("OCR_CACHE_MEMORY_ENTRIES", "512"))
+OCR_CACHE_DHASH_MAX_DISTANCE = int(os.getenv("OCR_CACHE_DHASH_MAX_DISTANCE", "7"))
+# Diferencia máxima (0-255) en cualquier celda de la miniatura para aceptar un casi-duplicado
+OCR_CACHE_MAX_CELL_DIFF = int(os.getenv("OCR_CACHE_MAX_CELL_DIFF", "30"))
+OCR_CACHE_THUMBNAIL_SIZE = (96, 192)
+
+ocr_log = logging.getLogger("bot.ocr")
+cache_log = logging.getLogger("bot.cache")
+
+def dhash_bands(value: int) -> list[int]:
+    # Mismas 8 bandas de 8 bits que simhash_bands en main.py (VerdictCache)
+    unsigned = value & 0xFFFFFFFFFFFFFFFF
+    return [(unsigned >> (8 * band)) & 0xFF for band in range(8)]
+
+def preprocess_image_for_ocr(img: Image.Image, steps: tuple = OCR_PREPROCESS_STEPS) -> Image.Image:
+    """Prepara una captura de pantalla para tesseract según los pasos indicados.
+
+    - escalar: reduce el ancho a OCR_PREPROCESS_MAX_WIDTH (las capturas de 1080-1440 px
+      tienen texto de sobra para tesseract y el costo crece con los pixeles).
+    - grises: un solo canal; en modo oscuro se invierte para que el texto quede oscuro.
+    - binarizar: umbral adaptativo contra la media local, así el fondo de las burbujas
+      de chat (verde, gris, azul) queda blanco sin importar su tono.
+    - recortar: se queda con la caja que contiene texto (más un margen).
+    """
+    if img.getexif().get(0x0112, 1) != 1: # Fotos de pantalla tomadas con el teléfono girado
+        img = ImageOps.exif_transpose(img)
+    # Pasar a grises antes de escalar: redimensionar un solo canal cuesta la mitad
+    if "grises" in steps or "binarizar" in steps:
+        img = img.convert("L")
+        if ImageStat.Stat(img).mean[0] < 110: # Modo oscuro: texto claro sobre fondo oscuro
+            img = ImageOps.invert(img)
+    if "escalar" in steps and img.width > OCR_PREPROCESS_MAX_WIDTH:
+        img = img.resize((OCR_PREPROCESS_MAX_WIDTH, round(img.height * OCR_PREPROCESS_MAX_WIDTH / img.width)), Image.Resampling.LANCZOS)
+    if "binarizar" in steps:
+        local_mean = img.filter(ImageFilter.BoxBlur(OCR_BINARIZE_RADIUS))
+        darker_than_surroundings = ImageChops.subtract(local_mean, img)
+        # Modo "1" (un bit por pixel): es lo que tesseract usa internamente y el PNG temporal
+        # que escribe pytesseract sale mucho más pequeño y rápido
+        img = darker_than_surroundings.point(lambda v: 0 if v > OCR_BINARIZE_OFFSET else 255, "1")
+    if "recortar" in steps:
+        bbox = ImageChops.invert(img if img.mode in ("1", "L") else img.convert("L")).getbbox()
+        if bbox:
+            left, top, right, bottom = bbox
+            img = img.crop((max(0, left - OCR_CROP_MARGIN), max(0, top - OCR_CROP_MARGIN),
+                            min(img.width, right + OCR_CROP_MARGIN), min(img.height, bottom + OCR_CROP_MARGIN)))
+    return img
+
+def ocr_image_file_sync(path: str, steps: tuple = OCR_PREPROCESS_STEPS) -> str:
+    # PIL lee directamente del archivo ya descargado; no hay copias extra en memoria
+    with Image.open(path) as img_pil:
+        img_for_ocr = preprocess_image_for_ocr(img_pil, steps)
+        return pytesseract.image_to_string(img_for_ocr, lang="spa+eng", config=f"--dpi {OCR_TARGET_DPI}").strip()
+
+def ocr_worker_run(path: str) -> str | None:
+    # Corre dentro del pool. TesseractNotFoundError no sobrevive al pickle de vuelta al
+    # proceso principal, así que se reporta como None y OCREngine la vuelve a lanzar.
+    try:
+        return ocr_image_file_sync(path)
+    except pytesseract.TesseractNotFoundError:
+        return None
+
+class OCRQueueFullError(Exception):
+    """La cola de OCR siguió llena durante OCR_QUEUE_PUT_TIMEOUT_SECONDS."""
+
+class OCREngine:
+    """Ejecuta el OCR de las imágenes recibidas en un pool dedicado de OCR_WORKERS procesos.
+
+    Las imágenes esperan en una cola de prioridad acotada (OCR_QUEUE_MAX); si sigue llena
+    tras OCR_QUEUE_PUT_TIMEOUT_SECONDS se lanza OCRQueueFullError en vez de acumular tareas.
+    La prioridad es el número de imágenes que ese usuario ya tiene en cola: la primera imagen
+    de alguien que está esperando respuesta pasa antes que la décima de quien envió una ráfaga.
+    Cada tesseract corre con OMP_THREAD_LIMIT=1 para no sobresuscribir los núcleos.
+    """
+
+    def __init__(self, workers: int, max_queue: int, queue_wait_stage: "MetricStage", ocr_stage: "MetricStage"):
+        self.workers = max(1, workers)
+        self.queue_wait_stage = queue_wait_stage
+        self.ocr_stage = ocr_stage
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue(max_queue)
+        self.executor = None
+        self.dispatchers: list[asyncio.Task] = []
+        self.sequence = itertools.count()
+        self.queued_per_user = Counter()
+        self.stats = Counter()
+        self.seconds = Counter() # Sumas de tiempos: queue_wait, ocr
+        self.latencies = deque(maxlen=1000) # (espera en cola, OCR) de las últimas imágenes
+
+    def start(self):
+        os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+        if OCR_EXECUTOR == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ocr")
+        else:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+        ocr_log.info("Motor de OCR iniciado: %s workers (%s), cola máxima %s.", self.workers, OCR_EXECUTOR, self.queue.maxsize)
+
+    async def stop(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        await asyncio.gather(*self.dispatchers, return_exceptions=True)
+        self.dispatchers.clear()
+        while not self.queue.empty():
+            future = self.queue.get_nowait()[3]
+            if not future.done():
+                future.cancel()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def ocr(self, path: str, user_key: str) -> str:
+        return (await self.ocr_timed(path, user_key))[0]
+
+    async def ocr_timed(self, path: str, user_key: str) -> tuple[str, float]:
+        """Como ocr(), pero devuelve también los segundos de OCR (sin contar la espera en cola)."""
+        if not self.dispatchers:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        priority = self.queued_per_user[user_key]
+        self.queued_per_user[user_key] += 1
+        try:
+            try:
+                await asyncio.wait_for(self.queue.put((priority, next(self.sequence), path, future, time.monotonic())), OCR_QUEUE_PUT_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                self.stats["rejected_queue_full"] += 1
+                raise OCRQueueFullError(f"Cola de OCR llena ({self.queue.qsize()} imágenes)")
+            return await future
+        finally:
+            self.queued_per_user[user_key] -= 1
+            if self.queued_per_user[user_key] <= 0:
+                del self.queued_per_user[user_key]
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, path, future, enqueued_at = await self.queue.get()
+            if future.done(): # El que la pidió ya no espera (tarea cancelada)
+                continue
+            started_at = time.monotonic()
+            try:
+                text = await loop.run_in_executor(self.executor, ocr_worker_run, path)
+                if text is None:
+                    raise pytesseract.TesseractNotFoundError()
+            except Exception as e:
+                self.stats["failed"] += 1
+                self.ocr_stage.record_error(e)
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.stats["processed"] += 1
+                if not future.done():
+                    future.set_result((text, time.monotonic() - started_at))
+            finally:
+                queue_wait, ocr_time = started_at - enqueued_at, time.monotonic() - started_at
+                self.seconds["queue_wait"] += queue_wait
+                self.seconds["ocr"] += ocr_time
+                self.queue_wait_stage.observe(queue_wait)
+                self.ocr_stage.observe(ocr_time)
+                self.latencies.append((queue_wait, ocr_time))
+
+    def snapshot(self) -> dict:
+        ocr_times = sorted(ocr_time for _, ocr_time in self.latencies)
+        waits = sorted(queue_wait for queue_wait, _ in self.latencies)
+        def percentile(values, q):
+            return round(values[min(len(values) - 1, int(q * len(values)))], 3) if values else None
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize(),
+            "users_waiting": len(self.queued_per_user),
+            "stats": dict(self.stats),
+            "seconds": {k: round(v, 3) for k, v in self.seconds.items()},
+            "ocr_seconds_p50": percentile(ocr_times, 0.5),
+            "ocr_seconds_p95": percentile(ocr_times, 0.95),
+            "queue_wait_seconds_p95": percentile(waits, 0.95),
+        }
+
+def image_signature_sync(path: str) -> tuple[int, bytes]:
+    """dHash de 64 bits (con signo, para SQLite) y miniatura en grises de la imagen."""
+    # Sin img.draft(): el decodificado reducido de JPEG cambia demasiado la miniatura entre
+    # una imagen y su versión reescalada, y los casi-duplicados dejan de coincidir.
+    with Image.open(path) as img:
+        gray = img.convert("L")
+    thumbnail = gray.resize(OCR_CACHE_THUMBNAIL_SIZE, Image.Resampling.BOX)
+    pixels = thumbnail.resize((9, 8), Image.Resampling.BOX).tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    value = value - (1 << 64) if value >= (1 << 63) else value
+    return value, thumbnail.tobytes()
+
+def thumbnail_max_cell_diff(a: bytes, b: bytes) -> int:
+    return max(abs(x - y) for x, y in zip(a, b)) if len(a) == len(b) else 255
+
+class OCRCache:
+    """Caché del texto OCR de imágenes ya procesadas (tabla cache_ocr_imagenes).
+
+    Primero se busca el sha256 exacto (reenvíos del mismo archivo), en memoria y luego en
+    SQLite. Si no está, se buscan candidatos por dHash (8 bandas de 8 bits, como en
+    VerdictCache). El dHash solo no distingue dos capturas con el mismo diseño y distinto
+    texto, así que un candidato se acepta únicamente si su miniatura de 96x192 no difiere
+    en más de OCR_CACHE_MAX_CELL_DIFF en ninguna celda: la recompresión o el reescalado de
+    WhatsApp quedan por debajo, cambiar un solo carácter de una URL queda por encima.
+    """
+
+    def __init__(self, database: "Database"):
+        self.db = database
+        self.memory: OrderedDict[str, tuple[str, str, float]] = OrderedDict() # sha256 -> (texto, archivo, segundos)
+        self.stats = Counter()
+        self.seconds = Counter() # ocr_saved: segundos de OCR que se evitaron
+        self.stores_since_eviction = 0
+
+    def _remember(self, sha256: str, entry: tuple[str, str, float]):
+        self.memory[sha256] = entry
+        self.memory.move_to_end(sha256)
+        while len(self.memory) > OCR_CACHE_MEMORY_ENTRIES:
+            self.memory.popitem(last=False)
+
+    def _lookup_exact_sync(self, sha256: str):
+        row = self.db.conn.execute(
+            "SELECT texto_ocr, nombre_archivo_imagen, ocr_segundos FROM cache_ocr_imagenes WHERE sha256 = ?", (sha256,)
+        ).fetchone()
+        if row is not None:
+            self.db.conn.execute("UPDATE cache_ocr_imagenes SET usado_en = ?, aciertos = aciertos + 1 WHERE sha256 = ?", (time.time(), sha256))
+        return row
+
+    def _lookup_near_sync(self, dhash: int, thumbnail: bytes):
+        candidates = self.db.conn.execute(
+            "SELECT sha256, dhash, miniatura, texto_ocr, nombre_archivo_imagen, ocr_segundos FROM cache_ocr_imagenes "
+            "WHERE banda0 = ? OR banda1 = ? OR banda2 = ? OR banda3 = ? OR banda4 = ? OR banda5 = ? OR banda6 = ? OR banda7 = ? "
+            "ORDER BY usado_en DESC LIMIT 200",
+            dhash_bands(dhash)
+        ).fetchall()
+        for candidate in candidates:
+            if bin((candidate["dhash"] ^ dhash) & 0xFFFFFFFFFFFFFFFF).count("1") > OCR_CACHE_DHASH_MAX_DISTANCE:
+                continue
+            if thumbnail_max_cell_diff(zlib.decompress(candidate["miniatura"]), thumbnail) <= OCR_CACHE_MAX_CELL_DIFF:
+                self.db.conn.execute("UPDATE cache_ocr_imagenes SET usado_en = ?, aciertos = aciertos + 1 WHERE sha256 = ?", (time.time(), candidate["sha256"]))
+                return candidate
+        return None
+
+    def _store_sync(self, sha256: str, dhash: int, thumbnail: bytes, text: str, file_name: str, ocr_seconds: float, evict: bool):
+        now = time.time()
+        self.db.conn.execute(
+            "INSERT OR REPLACE INTO cache_ocr_imagenes (sha256, dhash, banda0, banda1, banda2, banda3, banda4, banda5, banda6, banda7, "
+            "miniatura, texto_ocr, nombre_archivo_imagen, ocr_segundos, creado_en, usado_en) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (sha256, dhash, *dhash_bands(dhash), zlib.compress(thumbnail), text, file_name, ocr_seconds, now, now)
+        )
+        if evict:
+            excess = self.db.conn.execute("SELECT COUNT(*) FROM cache_ocr_imagenes").fetchone()[0] - OCR_CACHE_MAX_ENTRIES
+            if excess > 0:
+                self.db.conn.execute(
+                    "DELETE FROM cache_ocr_imagenes WHERE sha256 IN (SELECT sha256 FROM cache_ocr_imagenes ORDER BY usado_en LIMIT ?)",
+                    (excess,)
+                )
+
+    async def lookup(self, sha256: str, path: str) -> tuple[tuple[str, str] | None, tuple[int, bytes] | None]:
+        """Devuelve ((texto, archivo ya guardado) o None, firma calculada o None) para pasarla a store()."""
+        entry = self.memory.get(sha256)
+        kind = "memory"
+        try:
+            if entry is None:
+                kind = "exact"
+                row = await self.db.run(self._lookup_exact_sync, sha256)
+                if row is not None:
+                    entry = (row["texto_ocr"], row["nombre_archivo_imagen"], row["ocr_segundos"])
+            signature = None
+            if entry is None:
+                kind = "near"
+                signature = await asyncio.to_thread(image_signature_sync, path)
+                row = await self.db.run(self._lookup_near_sync, *signature)
+                if row is not None:
+                    entry = (row["texto_ocr"], row["nombre_archivo_imagen"], row["ocr_segundos"])
+        except (sqlite3.Error, OSError) as e:
+            cache_log.error("Error al consultar la caché de OCR: %s", e)
+            return None, None
+        if entry is None:
+            self.stats["misses"] += 1
+            return None, signature
+        self.stats[f"hits_{kind}"] += 1
+        self.seconds["ocr_saved"] += entry[2]
+        self._remember(sha256, entry)
+        return (entry[0], entry[1]), signature
+
+    async def store(self, sha256: str, signature: tuple[int, bytes] | None, path: str, text: str, file_name: str, ocr_seconds: float):
+        self.stores_since_eviction += 1
+        evict = self.stores_since_eviction >= 100
+        if evict:
+            self.stores_since_eviction = 0
+        try:
+            if signature is None:
+                signature = await asyncio.to_thread(image_signature_sync, path)
+            await self.db.run(self._store_sync, sha256, *signature, text, file_name, ocr_seconds, evict)
+            self.stats["stores"] += 1
+        except (sqlite3.Error, OSError) as e:
+            cache_log.error("Error al guardar en la caché de OCR: %s", e)
+            return
+        self._remember(sha256, (text, file_name, ocr_seconds))
+
+    def hit_rate(self) -> float:
+        hits = self.stats["hits_memory"] + self.stats["hits_exact"] + self.stats["hits_near"]
+        total = hits + self.stats["misses"]
+        return round(hits / total, 4) if total else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "hit_rate": self.hit_rate(),
+            "memory_entries": len(self.memory),
+            "stats": dict(self.stats),
+            "seconds": {k: round(v, 3) for k, v in self.seconds.items()},
+        }
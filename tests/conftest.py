@@ -0,0 +1,12 @@
+"""Antes de importar main: bases SQLite e imágenes en un directorio temporal y credenciales falsas."""
+import atexit
+import os
+import shutil
+import tempfile
+
+WORKDIR = tempfile.mkdtemp(prefix="tests_bot_")
+atexit.register(shutil.rmtree, WORKDIR, True)
+os.chdir(WORKDIR)
+for variable in ("VERIFY_TOKEN", "ACCESS_TOKEN", "PHONE_NUMBER_ID", "DEEPSEEK_API_KEY"):
+    os.environ.setdefault(variable, "test")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
@@ -0,0 +1,98 @@
+"""Mensajes etiquetados con lo que esperamos de DeepSeek en cada paso.
+
+Los usan los tests de los clasificadores locales (test_local_classifiers.py) y benchmark_webhook.py,
+que los manda como textos de los usuarios y como respuestas del DeepSeek simulado.
+"""
+
+# (texto, intención esperada). Mensajes reales en el estilo de los usuarios del bot.
+LABELED_INTENTS = [
+    ("hola", "saludo"), ("Hola!", "saludo"), ("buenas tardes", "saludo"), ("gracias", "saludo"),
+    ("muchas gracias 🙏", "saludo"), ("ok", "saludo"), ("de nada", "saludo"), ("buenos días", "saludo"),
+    ("listo, gracias", "saludo"), ("👍👍", "saludo"), ("hola que tal", "saludo"), ("chao", "saludo"),
+    ("dame un consejo", "solicitar_tip_seguridad"), ("consejo", "solicitar_tip_seguridad"),
+    ("quiero un tip de seguridad", "solicitar_tip_seguridad"), ("tienes alguna recomendación?", "solicitar_tip_seguridad"),
+    ("otro consejo por favor", "solicitar_tip_seguridad"),
+    ("https://bit.ly/3xYz", "analizar"), ("me llegó esto http://bancolombia-seguro.co/login", "analizar"),
+    ("www.nequi.com.co es seguro?", "analizar"),
+    ("Estimado cliente, su cuenta Bancolombia ha sido bloqueada por seguridad. Para desbloquearla ingrese sus datos en el "
+     "siguiente enlace antes de 24 horas o perderá el acceso definitivamente", "analizar"),
+    ("FELICITACIONES! Usted ha sido seleccionado como ganador de un premio de 5000000 pesos. Para reclamar consigne 150000 "
+     "a la cuenta Nequi 3001234567 por concepto de impuestos y envíe el comprobante", "analizar"),
+    ("DIAN: Usted tiene una multa pendiente por 850000. Evite embargos pagando hoy mismo. Comuníquese al 3109876543 o "
+     "responda este mensaje con su número de cédula y datos de la tarjeta", "analizar"),
+    ("Servientrega: su paquete no pudo ser entregado por dirección incompleta, actualice sus datos y pague 3500 de reenvío "
+     "respondiendo con el código que le llegará por SMS urgente", "analizar"),
+    ("qué es phishing?", "pregunta_seguridad"), ("cómo puedo proteger mi cuenta de whatsapp?", "pregunta_seguridad"),
+    ("es seguro usar wifi público para el banco?", "pregunta_seguridad"), ("como me protejo de estafas por llamada", "pregunta_seguridad"),
+    ("qué hago si me hackearon el facebook?", "pregunta_seguridad"), ("por qué es importante la verificación en dos pasos?", "pregunta_seguridad"),
+    ("que es un virus", "pregunta_seguridad"), ("cómo sé si una contraseña es segura?", "pregunta_seguridad"),
+    ("qué haces?", "meta_pregunta"), ("para qué sirves", "meta_pregunta"), ("puedo enviarte una imagen?", "meta_pregunta"),
+    ("entiendes audios?", "meta_pregunta"), ("quién eres", "meta_pregunta"), ("como funcionas?", "meta_pregunta"),
+    ("volver al menú principal", "comando_reset"), ("quiero reiniciar", "comando_reset"),
+    ("me gusta el fútbol", "irrelevante"), ("cuál es la capital de Francia", "irrelevante"), ("mañana llueve?", "irrelevante"),
+    ("jajaja", "irrelevante"),
+    ("me llamaron diciendo que eran del banco y me pidieron la clave, qué hago?", "pregunta_seguridad"),
+    ("me escribió un número desconocido diciendo que era mi hijo y que le consignara plata urgente", "analizar"),
+    ("hola, me llegó este mensaje: su cuenta ha sido suspendida, verifique sus datos", "analizar"),
+]
+# Respuestas a "¿quieres más detalles?" (D) y a "¿llegaste a hacer clic?" (P) con la etiqueta que esperamos del LLM
+LABELED_REPLIES = [(text, "decision_ver_detalles", label) for text, label in [
+    ("sí", "QUIERE_DETALLES"), ("si", "QUIERE_DETALLES"), ("Sí", "QUIERE_DETALLES"), ("siii", "QUIERE_DETALLES"),
+    ("claro", "QUIERE_DETALLES"), ("claro que sí", "QUIERE_DETALLES"), ("bueno", "QUIERE_DETALLES"), ("Ok", "QUIERE_DETALLES"),
+    ("dale", "QUIERE_DETALLES"), ("sí, por favor", "QUIERE_DETALLES"), ("si porfa", "QUIERE_DETALLES"),
+    ("sí quiero los detalles", "QUIERE_DETALLES"), ("más información por favor", "QUIERE_DETALLES"), ("mas", "QUIERE_DETALLES"),
+    ("a ver", "QUIERE_DETALLES"), ("explícame", "QUIERE_DETALLES"), ("quiero saber más", "QUIERE_DETALLES"),
+    ("mándamelos", "QUIERE_DETALLES"), ("bueno sí", "QUIERE_DETALLES"), ("sí, gracias", "QUIERE_DETALLES"), ("👍", "QUIERE_DETALLES"),
+    ("sip", "QUIERE_DETALLES"), ("claroo", "QUIERE_DETALLES"), ("Si señora", "QUIERE_DETALLES"),
+    ("no", "OTRA_COSA"), ("no gracias", "OTRA_COSA"), ("No, así está bien", "OTRA_COSA"), ("nada", "OTRA_COSA"),
+    ("ok gracias", "OTRA_COSA"), ("entendido", "OTRA_COSA"), ("gracias", "OTRA_COSA"), ("👎", "OTRA_COSA"),
+    ("¿y eso es peligroso?", "OTRA_COSA"), ("qué es phishing?", "OTRA_COSA"), ("y si ya abrí el enlace?", "OTRA_COSA"),
+    ("noo", "OTRA_COSA"), ("no, ya entendí", "OTRA_COSA"),
+    ("me llegó otro mensaje igual de mi banco, se lo reenvío ahora mismo", "OTRA_COSA"),
+]] + [(text, "decision_post_phishing_interaction", label) for text, label in [
+    ("sí", "RESPUESTA_SI"), ("si", "RESPUESTA_SI"), ("Sí hice clic", "RESPUESTA_SI"), ("si le di click", "RESPUESTA_SI"),
+    ("claro", "RESPUESTA_SI"), ("creo que sí", "RESPUESTA_SI"), ("sí, abrí el enlace", "RESPUESTA_SI"), ("siii", "RESPUESTA_SI"),
+    ("✅", "RESPUESTA_SI"), ("si compartí mis datos", "RESPUESTA_SI"),
+    ("no", "RESPUESTA_NO"), ("No, para nada", "RESPUESTA_NO"), ("No hice nada", "RESPUESTA_NO"), ("nop", "RESPUESTA_NO"),
+    ("no, no hice nada", "RESPUESTA_NO"), ("nooo", "RESPUESTA_NO"), ("nunca", "RESPUESTA_NO"), ("no gracias", "RESPUESTA_NO"),
+    ("claro que no", "RESPUESTA_NO"), ("no, no abrí nada", "RESPUESTA_NO"), ("❌", "RESPUESTA_NO"), ("negativo", "RESPUESTA_NO"),
+    ("ayuda", "PIDE_AYUDA"), ("AYUDA", "PIDE_AYUDA"), ("ayúdame", "PIDE_AYUDA"), ("ayudaaa por favor", "PIDE_AYUDA"),
+    ("ayda", "PIDE_AYUDA"), ("🆘", "PIDE_AYUDA"), ("necesito ayuda", "PIDE_AYUDA"), ("sí, ayuda", "PIDE_AYUDA"),
+    ("¿qué es phishing?", "ES_PREGUNTA"), ("cómo puedo evitar esto?", "ES_PREGUNTA"), ("¿y si ya di mis datos?", "ES_PREGUNTA"),
+    ("qué hago ahora", "ES_PREGUNTA"), ("es grave?", "ES_PREGUNTA"),
+    ("gracias", "ES_COMENTARIO"), ("Ok", "ES_COMENTARIO"), ("entendido", "ES_COMENTARIO"), ("qué peligroso", "ES_COMENTARIO"),
+    ("es una estafa", "ES_COMENTARIO"), ("muchas gracias 🙏", "ES_COMENTARIO"), ("listo", "ES_COMENTARIO"),
+]]
+# Respuestas a los pasos del registro (nombre, edad, conocimiento) con lo que esperamos del LLM
+LABELED_ONBOARDING = [(text, "nombre", label) for text, label in [
+    ("Ana", "NOMBRE_VALIDO:Ana"), ("carlos", "NOMBRE_VALIDO:Carlos"), ("María", "NOMBRE_VALIDO:María"),
+    ("me llamo Luis", "NOMBRE_VALIDO:Luis"), ("soy Gloria", "NOMBRE_VALIDO:Gloria"), ("mi nombre es Jorge", "NOMBRE_VALIDO:Jorge"),
+    ("Hola, me llamo Rosa", "NOMBRE_VALIDO:Rosa"), ("Hernán", "NOMBRE_VALIDO:Hernán"), ("Beatriz Gómez", "NOMBRE_VALIDO:Beatriz Gómez"),
+    ("Camilo, mucho gusto", "NOMBRE_VALIDO:Camilo"), ("Esperanza", "NOMBRE_VALIDO:Esperanza"), ("andres felipe", "NOMBRE_VALIDO:Andres Felipe"),
+    ("María Eugenia", "NOMBRE_VALIDO:María Eugenia"), ("Doña Luz Marina", "NOMBRE_VALIDO:Luz Marina"),
+    ("yo soy Martha Lucía Restrepo", "NOMBRE_VALIDO:Martha Lucía Restrepo"), ("me dicen Pacho", "NOMBRE_VALIDO:Pacho"),
+    ("Yeison", "NOMBRE_VALIDO:Yeison"), ("Leidy Johana", "NOMBRE_VALIDO:Leidy Johana"), ("María de los Ángeles", "NOMBRE_VALIDO:María de los Ángeles"),
+    ("Xiomara", "NOMBRE_VALIDO:Xiomara"), ("gato", "NOMBRE_INVALIDO"), ("123", "NOMBRE_INVALIDO"),
+    ("no quiero decirlo", "NOMBRE_INVALIDO"), ("prefiero no decirte", "NOMBRE_INVALIDO"), ("para qué quieres mi nombre?", "NOMBRE_INVALIDO"),
+    ("si", "NOMBRE_CONFUSO"), ("ok", "NOMBRE_CONFUSO"), ("hola", "NOMBRE_CONFUSO"), ("xyz", "NOMBRE_CONFUSO"),
+    ("qué es esto", "NOMBRE_CONFUSO"),
+]] + [(text, "edad", label) for text, label in [
+    ("35", "EDAD_VALIDA:35"), ("62", "EDAD_VALIDA:62"), ("tengo 45 años", "EDAD_VALIDA:45"), ("71 años", "EDAD_VALIDA:71"),
+    ("sesenta y dos", "EDAD_VALIDA:62"), ("tengo cuarenta años", "EDAD_VALIDA:40"), ("Tengo setenta y cinco años", "EDAD_VALIDA:75"),
+    ("veintiocho", "EDAD_VALIDA:28"), ("dieciocho años", "EDAD_VALIDA:18"), ("ochenta y un años", "EDAD_VALIDA:81"),
+    ("cincuentaicinco", "EDAD_VALIDA:55"), ("ya tengo 68", "EDAD_VALIDA:68"), ("mi edad es 30", "EDAD_VALIDA:30"),
+    ("tengo 33 años señora", "EDAD_VALIDA:33"), ("Sesenta", "EDAD_VALIDA:60"), ("tengo 52 años y medio", "EDAD_VALIDA:52"),
+    ("ciento dos", "EDAD_VALIDA:102"), ("casi 40", "EDAD_NO_CLARA"), ("cuarenta y pico", "EDAD_NO_CLARA"),
+    ("más de 60", "EDAD_NO_CLARA"), ("joven", "EDAD_NO_CLARA"), ("prefiero no decir", "EDAD_NO_CLARA"),
+    ("unos cuantos", "EDAD_NO_CLARA"), ("nací en 1958", "EDAD_VALIDA:68"), ("gato", "EDAD_INVALIDA"),
+    ("ayer comí pollo", "EDAD_INVALIDA"), ("no sé", "EDAD_INVALIDA"), ("tengo 40 y dos hijos", "EDAD_VALIDA:40"),
+]] + [(text, "conocimiento", label) for text, label in [
+    ("poco", "Poco"), ("Poco", "Poco"), ("algo", "Poco"), ("un poquito", "Poco"), ("más o menos", "Poco"), ("regular", "Poco"),
+    ("sí, un poco", "Poco"), ("lo básico", "Poco"), ("muy poco", "Poco"),
+    ("sí", "Sí"), ("si", "Sí"), ("sí, bastante", "Sí"), ("bastante", "Sí"), ("sé mucho", "Sí"), ("claro que sí", "Sí"),
+    ("no", "No"), ("No", "No"), ("no mucho", "No"), ("nada", "No"), ("no sé nada", "No"), ("ni idea", "No"),
+    ("casi nada", "No"), ("nada de nada", "No"), ("noo", "No"),
+    ("qué?", "CONOCIMIENTO_AMBIGUO"), ("no entiendo la pregunta", "CONOCIMIENTO_AMBIGUO"), ("depende", "CONOCIMIENTO_AMBIGUO"),
+    ("a veces", "CONOCIMIENTO_AMBIGUO"), ("gracias", "CONOCIMIENTO_AMBIGUO"), ("soy ingeniero de sistemas", "Sí"),
+    ("trabajo en un banco y nos dan capacitaciones", "Poco"),
+]]
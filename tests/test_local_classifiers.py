@@ -0,0 +1,66 @@
+"""Clasificadores locales contra los mensajes etiquetados.
+
+Cada clasificador puede no decidir (confianza por debajo de su umbral, y entonces pregunta a
+DeepSeek), pero cuando decide tiene que dar la etiqueta esperada.
+"""
+import pytest
+
+import main
+from tests.labeled_messages import LABELED_INTENTS, LABELED_ONBOARDING, LABELED_REPLIES
+
+@pytest.mark.parametrize("text, expected", LABELED_INTENTS)
+def test_classify_intent_local(text, expected):
+    intent, confidence = main.classify_intent_local(text)
+    assert confidence < main.INTENT_LOCAL_MIN_CONFIDENCE or intent == expected, (intent, confidence)
+
+@pytest.mark.parametrize("text, expected", [("hola", "saludo"), ("https://bit.ly/3xYz", "analizar"), ("dame un consejo", "solicitar_tip_seguridad")])
+def test_classify_intent_local_decides_clear_cases(text, expected):
+    intent, confidence = main.classify_intent_local(text)
+    assert intent == expected and confidence >= main.INTENT_LOCAL_MIN_CONFIDENCE
+
+@pytest.mark.parametrize("text, mode, expected", LABELED_REPLIES)
+def test_classify_reply_local(text, mode, expected):
+    label, confidence = main.classify_reply_local(text, mode)
+    assert confidence < main.REPLY_LOCAL_MIN_CONFIDENCE or label == expected, (label, confidence)
+
+@pytest.mark.parametrize("text, mode, expected", [
+    ("sí", "decision_ver_detalles", "QUIERE_DETALLES"), ("no gracias", "decision_ver_detalles", "OTRA_COSA"),
+    ("No hice nada", "decision_post_phishing_interaction", "RESPUESTA_NO"), ("ayuda", "decision_post_phishing_interaction", "PIDE_AYUDA"),
+])
+def test_classify_reply_local_decides_clear_cases(text, mode, expected):
+    label, confidence = main.classify_reply_local(text, mode)
+    assert label == expected and confidence >= main.REPLY_LOCAL_MIN_CONFIDENCE
+
+def onboarding_cases(field: str) -> list[tuple[str, str]]:
+    return [(text, expected) for text, case_field, expected in LABELED_ONBOARDING if case_field == field]
+
+@pytest.mark.parametrize("text, expected", onboarding_cases("nombre"))
+def test_extract_name_local(text, expected):
+    label, confidence = main.extract_name_local(text)
+    assert confidence < main.ONBOARDING_LOCAL_MIN_CONFIDENCE or label == expected, (label, confidence)
+
+@pytest.mark.parametrize("text, expected", onboarding_cases("edad"))
+def test_extract_age_local(text, expected):
+    label, confidence = main.extract_age_local(text)
+    assert confidence < main.ONBOARDING_LOCAL_MIN_CONFIDENCE or label == expected, (label, confidence)
+
+@pytest.mark.parametrize("text, expected", onboarding_cases("conocimiento"))
+def test_classify_knowledge_local(text, expected):
+    label, confidence = main.classify_knowledge_local(text)
+    assert confidence < main.ONBOARDING_LOCAL_MIN_CONFIDENCE or label == expected, (label, confidence)
+
+@pytest.mark.parametrize("text, expected", [
+    ("62", [62]), ("sesenta y dos", [62]), ("cincuentaicinco", [55]), ("ciento cinco", [105]), ("ciento dos", [102]),
+    ("veintiocho", [28]), ("35 mil", [35000]), ("un millon", [1000000]), ("dos millones", [2000000]),
+    ("una hija de 30", [30]), ("tengo 40 y dos hijos", [40, 2]),
+])
+def test_parse_spanish_numbers(text, expected):
+    assert main.parse_spanish_numbers(main.ONBOARDING_WORD_PATTERN.findall(main.normalize_text(text))) == expected
+
+@pytest.mark.parametrize("text, field, expected", [
+    ("me llamo Luis", "nombre", "NOMBRE_VALIDO:Luis"), ("tengo sesenta y dos años", "edad", "EDAD_VALIDA:62"),
+    ("71 años", "edad", "EDAD_VALIDA:71"), ("ni idea", "conocimiento", "No"),
+])
+def test_onboarding_extractors_decide_clear_cases(text, field, expected):
+    label, confidence = main.ONBOARDING_LOCAL_EXTRACTORS[field](text)
+    assert label == expected and confidence >= main.ONBOARDING_LOCAL_MIN_CONFIDENCE